@@ -8,6 +8,7 @@ load_dotenv()
 class TracingSampler(Enum):
     ALWAYS = 'always'
     PROBABILISTIC = 'probabilistic'
+    TAIL = 'tail'
 
 
 class Config:
@@ -16,6 +17,10 @@ class Config:
     # Mongo Config
     MONGO_HOST = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
     MONGO_DATABASE = os.environ.get('MONGO_DATABASE', 'default_database')
+    MONGO_SLOW_QUERY_MS = float(os.environ.get('MONGO_SLOW_QUERY_MS', 100))
+    MONGO_SLOW_QUERIES_BUFFER_SIZE = int(os.environ.get('MONGO_SLOW_QUERIES_BUFFER_SIZE', 1000))
+    # Pipeline fingerprints with their own metrics label, the ones seen after them are recorded as "other"
+    MONGO_PIPELINE_FINGERPRINT_LABELS = int(os.environ.get('MONGO_PIPELINE_FINGERPRINT_LABELS', 100))
 
     # AWS Config
     AWS_ENDPOINT_URL = os.environ.get('AWS_ENDPOINT_URL')
@@ -34,8 +39,22 @@ class Config:
     REDIS_PASSWORD = os.environ['REDIS_PASSWORD']
     REDIS_DATABASE = os.environ['REDIS_DATABASE']
 
+    # Query Engine Config
+    QUERY_PLAN_CACHE_SIZE = int(os.environ.get('QUERY_PLAN_CACHE_SIZE', 512))
+    COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', 3600))
+    COUNT_ESTIMATE_SAMPLE_SIZE = int(os.environ.get('COUNT_ESTIMATE_SAMPLE_SIZE', 10000))
+    SCHEMA_CACHE_SIZE = int(os.environ.get('SCHEMA_CACHE_SIZE', 1024))
+    SCHEMA_CACHE_TTL = int(os.environ.get('SCHEMA_CACHE_TTL', 3600))
+
     # Tracing Config
-    TRACING_SAMPLER: TracingSampler = TracingSampler.ALWAYS
+    # 'tail' buffers every trace and only exports the failed, slow or sampled ones
+    TRACING_SAMPLER = TracingSampler(os.environ.get('TRACING_SAMPLER', TracingSampler.ALWAYS.value))
+    TRACING_SAMPLE_RATE = float(os.environ.get('TRACING_SAMPLE_RATE', 1e-4))
+    TRACING_SLOW_SPAN_MS = float(os.environ.get('TRACING_SLOW_SPAN_MS', 500))
+    TRACING_SLOW_SPANS_BUFFER_SIZE = int(os.environ.get('TRACING_SLOW_SPANS_BUFFER_SIZE', 1000))
+    TRACING_EXPORT_QUEUE_SIZE = int(os.environ.get('TRACING_EXPORT_QUEUE_SIZE', 10000))
+    TRACING_EXPORT_BATCH_SIZE = int(os.environ.get('TRACING_EXPORT_BATCH_SIZE', 500))
+    TRACING_EXPORT_INTERVAL = float(os.environ.get('TRACING_EXPORT_INTERVAL', 1))
 
     # Buckets Config
     IMAGE_STORAGE_BUCKET = os.environ['IMAGE_STORAGE_BUCKET']
@@ -52,6 +71,18 @@ class Config:
     DATASET_EXPORTING_RESULTS_FOLDER = os.environ.get('DATASET_EXPORTING_RESULTS_FOLDER', 'datasets/compiled')
     DATASET_CACHE_FOLDER = os.environ.get('DATASET_CACHE_FOLDER', 'datasets/cache')
     DATASET_SNAPSHOT_FOLDER = os.environ.get('DATASET_EXPORTING_RESULTS_FOLDER', 'datasets/snapshots')
+    DATASET_IMPORT_FOLDER = os.environ.get('DATASET_IMPORT_FOLDER', 'datasets/imports')
+    SNAPSHOT_BLOCK_SIZE = int(os.environ.get('SNAPSHOT_BLOCK_SIZE', 1000))
+    SNAPSHOT_FOOTER_CACHE_SIZE = int(os.environ.get('SNAPSHOT_FOOTER_CACHE_SIZE', 1024))
+    SNAPSHOT_MAX_PAGE_SIZE = int(os.environ.get('SNAPSHOT_MAX_PAGE_SIZE', 1000))
+    SNAPSHOT_COMPACTION_INTERVAL = int(os.environ.get('SNAPSHOT_COMPACTION_INTERVAL', 10))
+    EXPORT_DOWNLOAD_CONCURRENCY = int(os.environ.get('EXPORT_DOWNLOAD_CONCURRENCY', 32))
+    EXPORT_DOWNLOAD_RETRIES = int(os.environ.get('EXPORT_DOWNLOAD_RETRIES', 3))
+    EXPORT_DOWNLOAD_RETRY_DELAY = float(os.environ.get('EXPORT_DOWNLOAD_RETRY_DELAY', 1))
+    EXPORT_UPLOAD_PART_SIZE = int(os.environ.get('EXPORT_UPLOAD_PART_SIZE', 64 * 2 ** 20))
+    # Seconds the key of an exported zip is kept for its download url, it must not exceed the
+    # expiration of the lifecycle rule of the exporting results folder
+    EXPORT_ARTIFACT_TTL = int(os.environ.get('EXPORT_ARTIFACT_TTL', 7 * 24 * 3600))
 
     # Pipelines Storage Config
     PIPELINES_LOGS_FOLDER = os.environ.get('PIPELINES_LOGS_FOLDER' 'logs')
@@ -59,6 +90,14 @@ class Config:
 
     # Rate Limiting
     POST_BULK_LIMIT = int(os.environ.get('POST_BULK_LIMIT', 1000))
+    STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+    STREAM_MAX_REPORTED_ERRORS = int(os.environ.get('STREAM_MAX_REPORTED_ERRORS', 1000))
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+    IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 1))
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 256))
+    IMPORT_MAX_REPORTED_ERRORS = int(os.environ.get('IMPORT_MAX_REPORTED_ERRORS', 1000))
+    IMPORT_JOB_TIMEOUT = int(os.environ.get('IMPORT_JOB_TIMEOUT', 24 * 3600))
+    IMPORT_JOB_RETRIES = int(os.environ.get('IMPORT_JOB_RETRIES', 3))
     VIDEO_FPS_LIMIT = int(os.environ.get('VIDEO_FPS_LIMIT', 5))
 
     THUMBNAILS_MAX_WIDTH = int(os.environ.get('THUMBNAILS_WIDTH', '500'))
@@ -68,3 +107,4 @@ class Config:
     SIGNED_GET_THUMBNAIL_URL_EXPIRATION = int(os.environ.get('SIGNED_GET_THUMBNAIL_URL_EXPIRATION ', 3600))
     SIGNED_GET_IMAGE_URL_EXPIRATION = int(os.environ.get('SIGNED_GET_IMAGE_URL_EXPIRATION ', 3600))
     SIGNED_GET_OBJECT_URL_EXPIRATION = int(os.environ.get('SIGNED_GET_OBJECT_URL_EXPIRATION ', 3600))
+    SIGNED_URLS_CACHE_SIZE = int(os.environ.get('SIGNED_URLS_CACHE_SIZE', 100000))
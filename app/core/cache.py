@@ -0,0 +1,69 @@
+from typing import Optional
+
+import orjson
+from cachetools import LRUCache
+from odmantic import ObjectId
+
+from app.config import Config
+from app.core.queue import redis
+
+# Schemas are immutable for a given generation, so every worker keeps its own copy
+_schema_cache = LRUCache(maxsize=Config.SCHEMA_CACHE_SIZE)
+
+
+def _get_generation_key(project_id: ObjectId) -> str:
+    return f'annotations:generation:{project_id}'
+
+
+def _get_count_key(project_id: ObjectId, generation: int, pipeline_hash: str, estimate: bool) -> str:
+    mode = 'estimate' if estimate else 'exact'
+    return f'annotations:count:{project_id}:{generation}:{mode}:{pipeline_hash}'
+
+
+def _get_schema_key(project_id: ObjectId, generation: int) -> str:
+    return f'annotations:schema:{project_id}:{generation}'
+
+
+def get_annotations_generation(project_id: ObjectId) -> int:
+    generation = redis.get(_get_generation_key(project_id))
+    return int(generation) if generation else 0
+
+
+def invalidate_annotations(project_id: ObjectId) -> int:
+    """
+    Bumps the generation of the project annotations, so every cached value derived
+    from the previous generation is ignored and eventually expires. Returns the new generation.
+    """
+    return redis.incr(_get_generation_key(project_id))
+
+
+def get_cached_count(project_id: ObjectId, generation: int, pipeline_hash: str, estimate: bool) -> Optional[int]:
+    count = redis.get(_get_count_key(project_id, generation, pipeline_hash, estimate))
+    return int(count) if count is not None else None
+
+
+def set_cached_count(project_id: ObjectId, generation: int, pipeline_hash: str, estimate: bool, count: int):
+    key = _get_count_key(project_id, generation, pipeline_hash, estimate)
+    redis.set(key, count, ex=Config.COUNT_CACHE_TTL)
+
+
+def get_cached_schema(project_id: ObjectId, generation: int) -> Optional[dict]:
+    key = _get_schema_key(project_id, generation)
+    schema = _schema_cache.get(key)
+
+    if schema is None:
+        schema = redis.get(key)
+
+        if schema is None:
+            return None
+
+        schema = orjson.loads(schema)
+        _schema_cache[key] = schema
+
+    return schema
+
+
+def set_cached_schema(project_id: ObjectId, generation: int, schema: dict):
+    key = _get_schema_key(project_id, generation)
+    _schema_cache[key] = schema
+    redis.set(key, orjson.dumps(schema), ex=Config.SCHEMA_CACHE_TTL)
@@ -1,10 +1,16 @@
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
 from enum import Enum
 from datumaro.components.dataset import Dataset
-from datumaro.components.extractor import Bbox, Polygon, Label, PolyLine, Points, DatasetItem, Caption
+from datumaro.components.environment import Environment
+from datumaro.components.extractor import Bbox, Polygon, Label, PolyLine, Points, DatasetItem, Caption, \
+    Extractor, AnnotationType, LabelCategories, DEFAULT_SUBSET_NAME
 from datumaro.util.image import Image
 from app.schema import ImageAnnotationsData
+from app.models import Label as DatasetLabel
+
+# Bumped whenever the exported files change, so the cached export artifacts are built again
+EXPORTER_VERSION = 3
 
 
 class DatasetExportFormat(str, Enum):
@@ -21,54 +27,115 @@ class DatasetExportFormat(str, Enum):
     VOC_SEGMENTATION = 'voc_segmentation'
     VOC_CLASSIFICATION = 'voc_classification'
     CVAT_XML = 'cvat'
+    YOLO = 'yolo'
+
+
+def get_image_filename(event_id: str) -> str:
+    return event_id.split('/')[-1]
+
+
+def get_label_names(labels: Iterable[DatasetLabel]) -> List[str]:
+    return list(dict.fromkeys(label.name for label in labels))
+
+
+def get_label_index(labels_index: Dict[str, int], label: str, event_id: str) -> int:
+    try:
+        return labels_index[label]
+    except KeyError:
+        raise ValueError(f'Label {label!r} of {event_id} is not one of the dataset labels') from None
+
+
+def get_pixel_scale(width: Optional[int], height: Optional[int]) -> Tuple[int, int]:
+    # Coordinates are stored relative to the image size, they are kept relative for images without a size
+    return width or 1, height or 1
+
+
+def to_pixels(points: Iterable[float], width: int, height: int) -> List[float]:
+    return [value * (height if i % 2 else width) for i, value in enumerate(points)]
+
+
+def _create_datumaro_item(image_annotations: ImageAnnotationsData, labels_index: Dict[str, int],
+                          images_dir: Optional[str] = None) -> DatasetItem:
+    # Datumaro formats use pixels
+    width, height = get_pixel_scale(image_annotations.image_width, image_annotations.image_height)
+    event_id = image_annotations.event_id
+    boxes = [Bbox(label=get_label_index(labels_index, det.label, event_id),
+                  attributes=det.attributes,
+                  x=det.box[0] * width,
+                  y=det.box[1] * height,
+                  w=(det.box[2] - det.box[0]) * width,
+                  h=(det.box[3] - det.box[1]) * height)
+             for det in image_annotations.detections]
+
+    tags = [Label(label=get_label_index(labels_index, tag.label, event_id), attributes=tag.attributes)
+            for tag in image_annotations.tags]
+
+    points = [Points(label=get_label_index(labels_index, points.label, event_id),
+                     points=to_pixels(points.points, width, height),
+                     attributes=points.attributes)
+              for points in image_annotations.points]
+
+    polygons = [Polygon(label=get_label_index(labels_index, polygon.label, event_id),
+                        points=to_pixels(polygon.points, width, height),
+                        attributes=polygon.attributes)
+                for polygon in image_annotations.polygons]
+
+    polylines = [PolyLine(label=get_label_index(labels_index, polyline.label, event_id),
+                          points=to_pixels(polyline.points, width, height),
+                          attributes=polyline.attributes)
+                 for polyline in image_annotations.polylines]
+
+    captions = [Caption(caption=caption) for caption in image_annotations.captions]
+
+    image = None
+
+    if image_annotations.has_image:
+        image_path = f'{images_dir}/{get_image_filename(event_id)}' if images_dir else event_id
+        image = Image(path=image_path, size=(image_annotations.image_height, image_annotations.image_width))
+
+    return DatasetItem(id=Path(image_annotations.event_id).stem,
+                       annotations=boxes + polygons + polylines + points + tags + captions,
+                       image=image)
+
+
+class AnnotationsExtractor(Extractor):
+    """
+    Converts the annotations into datumaro items every time it is iterated, so converters can consume
+    datasets of any size without holding them in memory. Label categories are given upfront.
+    """
+
+    def __init__(self, annotations: Callable[[], Iterable[ImageAnnotationsData]], labels: List[str],
+                 length: int, images_dir: Optional[str] = None):
+        super().__init__(length=length, subsets=[DEFAULT_SUBSET_NAME])
+        self._annotations = annotations
+        self._labels_index = {v: i for i, v in enumerate(labels)}
+        self._categories = {AnnotationType.label: LabelCategories.from_iterable(labels)}
+        self._images_dir = images_dir
+
+    def __iter__(self) -> Iterator[DatasetItem]:
+        for image_annotations in self._annotations():
+            yield _create_datumaro_item(image_annotations, self._labels_index, self._images_dir)
+
+    def categories(self):
+        return self._categories
+
+    def get_subset(self, name):
+        # Items always belong to the default subset, filtering them would need another pass to know the length
+        if name != DEFAULT_SUBSET_NAME:
+            return super().get_subset(name)
+        return self
+
+
+def export_annotations(extractor: AnnotationsExtractor, save_dir: str, format: DatasetExportFormat, **options):
+    """
+    Runs the datumaro converter of the format on the extractor directly, since wrapping it in a datumaro
+    Dataset would cache every item.
+    """
+    converter = Environment().converters.get(format.value)
+    converter.convert(extractor, save_dir=save_dir, **options)
 
 
 def create_datumaro_dataset(annotations: List[ImageAnnotationsData]):
-    items = []
-    labels = list(set(
-        label.name
-        for image_annotations in annotations
-        for label in image_annotations.get_labels()
-    ))
-    labels_index = {v: i for i, v in enumerate(labels)}
-
-    for image_annotations in annotations:
-        boxes = [Bbox(label=labels_index[det.label],
-                      attributes=det.attributes,
-                      x=det.box[0],
-                      y=det.box[1],
-                      w=det.box[2] - det.box[0],
-                      h=det.box[3] - det.box[1])
-                 for det in image_annotations.detections]
-
-        tags = [Label(label=labels_index[tag.label], attributes=tag.attributes)
-                for tag in image_annotations.tags]
-
-        points = [Points(label=labels_index[points.label],
-                         points=points.points,
-                         attributes=points.attributes)
-                  for points in image_annotations.points]
-
-        polygons = [Polygon(label=labels_index[polygon.label],
-                            points=polygon.points,
-                            attributes=polygon.attributes)
-                    for polygon in image_annotations.polygons]
-
-        polylines = [PolyLine(label=labels_index[polyline.label],
-                              points=polyline.points,
-                              attributes=polyline.attributes)
-                     for polyline in image_annotations.polylines]
-
-        captions = [Caption(caption=caption) for caption in image_annotations.captions]
-
-        image_path = image_annotations.event_id if image_annotations.has_image else None
-        image = image_path and Image(path=image_path,
-                                     size=(image_annotations.image_height, image_annotations.image_height))
-        item = DatasetItem(id=Path(image_annotations.event_id).stem,
-                           annotations=boxes + polygons + polylines + points + tags + captions,
-                           image=image)
-        items.append(item)
-
-    dataset = Dataset.from_iterable(items, categories=labels)
-
-    return dataset
+    labels = get_label_names(label for image_annotations in annotations for label in image_annotations.get_labels())
+    extractor = AnnotationsExtractor(lambda: annotations, labels, len(annotations))
+    return Dataset.from_extractors(extractor)
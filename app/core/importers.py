@@ -1,8 +1,15 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from enum import Enum
+import itertools
+import multiprocessing
+
+import numpy as np
 from datumaro.components.dataset import Dataset, DatasetItem, AnnotationType
 from datumaro.components.extractor import Caption as DatumaroCaption
-from app.models import ImageAnnotations, Tag, Polygon, Detection,\
-    Polyline, Keypoints, ObjectId, Caption
+
+from app.models import ImageAnnotations
 
 
 class DatasetImportFormat(str, Enum):
@@ -17,90 +24,150 @@ class DatasetImportFormat(str, Enum):
     YOLO = 'yolo'
 
 
-def _normalize_points(points, item: DatasetItem):
-    if not item.has_image:
-        return points
+# Raw data of a datumaro item, that can be sent to the worker processes
+ItemData = Tuple[str, Optional[Tuple[int, int]], dict, List[tuple]]
+
+_SHAPE_FIELDS = {
+    AnnotationType.label: +ImageAnnotations.tags,
+    AnnotationType.bbox: +ImageAnnotations.detections,
+    AnnotationType.polygon: +ImageAnnotations.polygons,
+    AnnotationType.polyline: +ImageAnnotations.polylines,
+    AnnotationType.points: +ImageAnnotations.points,
+}
+
+
+def _get_item_data(item: DatasetItem) -> ItemData:
+    event_id = item.image.path.split('/')[-1] if item.has_image else item.id
+    image_size = item.image.size if item.has_image else None
+    annotations = []
+
+    for annotation in item.annotations:
+        if isinstance(annotation, DatumaroCaption):
+            annotations.append((AnnotationType.caption, annotation.caption, annotation.attributes))
+        elif annotation.type == AnnotationType.bbox:
+            annotations.append((annotation.type, annotation.label, annotation.get_bbox(), annotation.attributes))
+        elif annotation.type == AnnotationType.label:
+            annotations.append((annotation.type, annotation.label, None, annotation.attributes))
+        elif annotation.type in _SHAPE_FIELDS:
+            annotations.append((annotation.type, annotation.label, annotation.points, annotation.attributes))
+        # TODO: Add support for segmentation masks
+
+    return event_id, image_size, item.attributes, annotations
+
+
+def _normalize_coordinates(coordinates: List[List[float]],
+                           image_sizes: List[Optional[Tuple[int, int]]]) -> Tuple[List[List[float]], np.ndarray]:
+    """
+    Divides the x and y coordinates of every list by the width and height of its image in a single
+    vectorized pass. Returns the normalized lists and the number of coordinates of each list
+    that are not finite or out of the [0, 1] range.
+    """
+    lengths = np.array([len(x) for x in coordinates], dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    values = np.fromiter(itertools.chain.from_iterable(coordinates), dtype=np.float64, count=int(lengths.sum()))
+
+    # Coordinates of items without image are not normalized
+    sizes = np.array([size or (1, 1) for size in image_sizes], dtype=np.float64).reshape(-1, 2)
+    heights, widths = np.repeat(sizes[:, 0], lengths), np.repeat(sizes[:, 1], lengths)
+    positions = np.arange(len(values)) - np.repeat(starts, lengths)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values /= np.where(positions % 2 == 0, widths, heights)
+
+    # NaN fails both comparisons, and zero image sizes give infinite values
+    out_of_range = ~np.isfinite(values) | (values < 0) | (values > 1)
+    segments = np.repeat(np.arange(len(coordinates)), lengths)
+    out_of_range_counts = np.bincount(segments[out_of_range], minlength=len(coordinates))
+
+    return [x.tolist() for x in np.split(values, np.cumsum(lengths)[:-1])], out_of_range_counts
+
+
+def _convert_items(chunk: List[ItemData], label_names: List[str]) -> List[Tuple[dict, List[str]]]:
+    """
+    Converts a chunk of items into annotations documents, along with the errors found in each of them.
+    """
+    documents = []
+    coordinates, image_sizes, targets = [], [], []
+
+    for event_id, image_size, attributes, annotations in chunk:
+        document = {field: [] for field in _SHAPE_FIELDS.values()}
+        document[+ImageAnnotations.captions] = []
+
+        for annotation_type, *values in annotations:
+            if annotation_type == AnnotationType.caption:
+                caption, annotation_attributes = values
+                document[+ImageAnnotations.captions].append({'caption': caption, 'attributes': annotation_attributes})
+                continue
+
+            label, points, annotation_attributes = values
+            field = _SHAPE_FIELDS[annotation_type]
+            obj = {'label': label_names[label], 'score': None, 'attributes': annotation_attributes}
+
+            if annotation_type == AnnotationType.bbox:
+                x, y, width, height = points
+                coordinates.append([x, y, x + width, y + height])
+                targets.append((len(documents), obj, 'box', f'{field}[{len(document[field])}]'))
+                image_sizes.append(image_size)
+            elif annotation_type != AnnotationType.label:
+                coordinates.append(points)
+                targets.append((len(documents), obj, 'points', f'{field}[{len(document[field])}]'))
+                image_sizes.append(image_size)
+
+            document[field].append(obj)
 
-    result = points[:]
-    height, width = item.image.size
+        documents.append({'event_id': event_id, 'attributes': attributes, **document})
 
-    for i in range(len(points)):
-        if i % 2 == 0:
-            result[i] /= width
-        else:
-            result[i] /= height
+    errors = [[] for _ in documents]
 
-    return result
+    if coordinates:
+        normalized, out_of_range_counts = _normalize_coordinates(coordinates, image_sizes)
 
+        for (index, obj, key, description), values, count in zip(targets, normalized, out_of_range_counts):
+            obj[key] = values
+            if count:
+                errors[index].append(f'{documents[index]["event_id"]}: {description} has {count} '
+                                     f'coordinates that are not finite or out of the [0, 1] range')
 
-def import_dataset(input_file: str, format: DatasetImportFormat, project_id: ObjectId):
+    return list(zip(documents, errors))
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_dataset_annotations(input_file: str, format: DatasetImportFormat, start: int = 0,
+                             workers: int = 1, chunk_size: int = 256) -> Iterator[Tuple[dict, List[str]]]:
+    """
+    Converts the items of the dataset file into annotations documents, skipping the first start items.
+    Every document is returned along with its errors, if any.
+    With more than one worker, chunks of items are converted in a process pool, keeping the item order.
+    """
     dataset = Dataset.import_from(input_file, format=format.value)
-    labels = dataset.categories()
-    annotations = []
+    categories = dataset.categories()
+    label_names = [x.name for x in categories[AnnotationType.label]] if AnnotationType.label in categories else []
+    items = (_get_item_data(item) for item in itertools.islice(dataset, start, None))
 
-    for row in dataset:
-        item: DatasetItem = row
-        event_id = item.image.path.split('/')[-1] if item.has_image else item.id
-        tags, detections, polygons, polylines, captions, keypoints = [], [], [], [], [], []
-
-        for annotation in item.annotations:
-            if isinstance(annotation, DatumaroCaption):
-                captions.append(Caption(
-                    caption=annotation.caption,
-                    attributes=annotation.attributes
-                ))
-                continue
+    if workers <= 1:
+        for chunk in _chunked(items, chunk_size):
+            yield from _convert_items(chunk, label_names)
+        return
+
+    # Forked workers would inherit the event loop, the mongo client and the redis connections of the job
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pending = deque()
+
+        for chunk in _chunked(items, chunk_size):
+            pending.append(executor.submit(_convert_items, chunk, label_names))
+
+            # Bounds the number of converted items waiting to be written
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
 
-            # TODO: Add support for segmentation masks
-            label = labels[AnnotationType.label][annotation.label]
-
-            if annotation.type == AnnotationType.label:
-                tags.append(
-                    Tag(label=label.name, attributes=annotation.attributes)
-                )
-
-            if annotation.type == AnnotationType.bbox:
-                box = _normalize_points(annotation.get_bbox(), item)
-                box = [box[0], box[1], box[0] + box[2], box[1] + box[3]]
-                detections.append(
-                    Detection(label=label.name, attributes=annotation.attributes, box=box)
-                )
-
-            if annotation.type == AnnotationType.polygon:
-                points = _normalize_points(annotation.points, item)
-                polygons.append(
-                    Polygon(label=label.name, attributes=annotation.attributes, points=points)
-                )
-
-            if annotation.type == AnnotationType.polyline:
-                points = _normalize_points(annotation.points, item)
-                polylines.append(
-                    Polyline(label=label.name, attributes=annotation.attributes, points=points)
-                )
-
-            if annotation.type == AnnotationType.points:
-                points = _normalize_points(annotation.points, item)
-                keypoints.append(
-                    Keypoints(label=label.name, attributes=annotation.attributes, points=points)
-                )
-
-        print(captions)
-
-        image_annotations = ImageAnnotations(
-            attributes=item.attributes,
-            event_id=event_id,
-            tags=tags,
-            polygons=polygons,
-            detections=detections,
-            polylines=polylines,
-            points=keypoints,
-            project_id=project_id,
-            captions=captions,
-            labels=[]
-        )
-
-        image_annotations.labels = image_annotations.get_labels()
-
-        annotations.append(image_annotations)
-
-    return annotations
+        while pending:
+            yield from pending.popleft().result()
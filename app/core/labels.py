@@ -0,0 +1,85 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from collections import defaultdict
+
+from app.models import ImageAnnotations, Label, Shape
+
+LabelKey = Tuple[str, Shape]
+LabelsSummary = Dict[LabelKey, Tuple[int, List[str]]]
+
+SHAPE_FIELDS = {
+    Shape.POINT: +ImageAnnotations.points,
+    Shape.BOX: +ImageAnnotations.detections,
+    Shape.POLYGON: +ImageAnnotations.polygons,
+    Shape.POLYLINE: +ImageAnnotations.polylines,
+    Shape.TAG: +ImageAnnotations.tags,
+}
+
+
+def merge_labels(labels: Iterable[Label]) -> List[Label]:
+    attributes = defaultdict(set)
+
+    for label in labels:
+        attributes[(label.name, label.shape)].update(label.attributes)
+
+    return [Label(name=name, shape=shape, attributes=sorted(label_attributes))
+            for (name, shape), label_attributes in attributes.items()]
+
+
+def get_labels_summary(annotations: Optional[ImageAnnotations]) -> LabelsSummary:
+    """
+    Returns the number of objects and the attribute keys of every label of the annotations.
+    """
+    if annotations is None:
+        return {}
+
+    counts = annotations.get_label_counts()
+    return {(label.name, label.shape): (counts[(label.name, label.shape)], label.attributes)
+            for label in annotations.get_labels()}
+
+
+def get_document_labels_summary(doc: dict) -> LabelsSummary:
+    """
+    Same as get_labels_summary, for a raw annotations document that may only include
+    the label and attributes of its objects.
+    """
+    counts = defaultdict(int)
+    attributes = defaultdict(set)
+
+    for shape, field in SHAPE_FIELDS.items():
+        for obj in doc.get(field) or []:
+            key = (obj['label'], shape)
+            counts[key] += 1
+            attributes[key].update((obj.get('attributes') or {}).keys())
+
+    return {key: (count, sorted(attributes[key])) for key, count in counts.items()}
+
+
+def encode_labels_summary(summary: LabelsSummary) -> List[list]:
+    return [[name, shape.value, count, attributes] for (name, shape), (count, attributes) in summary.items()]
+
+
+def decode_labels_summary(data: Optional[List[list]]) -> LabelsSummary:
+    return {(name, Shape(shape)): (count, attributes) for name, shape, count, attributes in data or []}
+
+
+def get_summary_labels(summary: LabelsSummary) -> List[Label]:
+    return [Label(name=name, shape=shape, attributes=attributes) for (name, shape), (_, attributes) in summary.items()]
+
+
+def get_label_stats_deltas(changes: Iterable[Tuple[LabelsSummary, LabelsSummary]]) -> Dict[LabelKey, dict]:
+    """
+    Computes the changes of the project label stats from the summaries of the annotations before and after an update.
+    """
+    deltas = defaultdict(lambda: {'object_count': 0, 'image_count': 0, 'attributes': set()})
+
+    for previous, current in changes:
+        for key in previous.keys() | current.keys():
+            previous_count, previous_attributes = previous.get(key, (0, []))
+            current_count, attributes = current.get(key, (0, []))
+            delta = deltas[key]
+            delta['object_count'] += current_count - previous_count
+            delta['image_count'] += int(current_count > 0) - int(previous_count > 0)
+            # Attributes that were already in the annotations are already in the stats
+            delta['attributes'].update(set(attributes) - set(previous_attributes))
+
+    return deltas
@@ -0,0 +1,71 @@
+from collections import defaultdict
+import asyncio
+import logging
+
+from rq.decorators import job
+
+from app.models import ImageAnnotations, ProjectLabelStats, get_engine, initialize
+from app.core.labels import get_labels_summary, get_label_stats_deltas
+from app.core.queue import redis
+from app.services.projects import ProjectService
+
+
+logger = logging.getLogger(__name__)
+
+
+@job('migrations', connection=redis)
+async def backfill_random_keys():
+    """
+    Writes the random sampling key of the annotations created before it was persisted.
+    """
+    await initialize()
+    engine = await get_engine()
+    collection = engine.get_collection(ImageAnnotations)
+    result = await collection.update_many(
+        {+ImageAnnotations.rand: {'$exists': False}},
+        [{'$set': {+ImageAnnotations.rand: {'$rand': {}}}}])
+    logger.info(f'Backfilled random key of {result.modified_count} annotations')
+    return result.modified_count
+
+
+@job('migrations', connection=redis)
+async def rebuild_label_stats(batch_size: int = 1000):
+    """
+    Recomputes the label stats of every project from its annotations.
+    """
+    await initialize()
+    engine = await get_engine()
+    await engine.get_collection(ProjectLabelStats).delete_many({})
+    changes = defaultdict(list)
+    count = 0
+
+    async for doc in engine.get_collection(ImageAnnotations).find({}):
+        annotations = ImageAnnotations.parse_doc(doc)
+        changes[annotations.project_id].append(({}, get_labels_summary(annotations)))
+        count += 1
+
+        # Stats are updated with increments, so they can be written in batches
+        if len(changes[annotations.project_id]) >= batch_size:
+            project_changes = changes.pop(annotations.project_id)
+            await ProjectService.update_label_stats(annotations.project_id, get_label_stats_deltas(project_changes))
+
+    for project_id, project_changes in changes.items():
+        await ProjectService.update_label_stats(project_id, get_label_stats_deltas(project_changes))
+
+    logger.info(f'Rebuilt label stats from {count} annotations')
+    return count
+
+
+MIGRATIONS = [
+    backfill_random_keys,
+    rebuild_label_stats,
+]
+
+
+async def run_migrations():
+    for migration in MIGRATIONS:
+        await migration()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(run_migrations())
@@ -0,0 +1,220 @@
+from typing import Any, Deque, Dict, List, Optional, Set
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+import hashlib
+import logging
+import threading
+
+import orjson
+from bson import json_util
+from cachetools import LRUCache
+from prometheus_client import Counter, Histogram
+from pymongo.monitoring import CommandListener, CommandStartedEvent, CommandSucceededEvent, CommandFailedEvent
+
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+mongo_command_duration = Histogram(
+    'mongo_command_duration_seconds', 'Duration of the commands sent to MongoDB', ['command', 'collection'])
+mongo_command_documents = Histogram(
+    'mongo_command_documents_returned', 'Number of documents returned by cursor commands', ['command', 'collection'],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, float('inf')))
+mongo_command_failures = Counter(
+    'mongo_command_failures_total', 'Number of commands that failed in MongoDB', ['command', 'collection'])
+mongo_pipeline_duration = Histogram(
+    'mongo_pipeline_duration_seconds', 'Duration of aggregations and their getMore commands by pipeline shape',
+    ['fingerprint'])
+
+# Label of the pipelines whose fingerprint doesn't get a label of its own
+OTHER_FINGERPRINTS_LABEL = 'other'
+
+# Field of the query commands that holds their pipeline or filter
+_QUERY_FIELDS = {'aggregate': 'pipeline', 'find': 'filter', 'count': 'query', 'distinct': 'query'}
+
+# Comment of the aggregations run by the current request, motor runs the commands on executor threads
+# which do not inherit the context, so the origin is sent along with the command
+_query_comment: ContextVar[Optional[str]] = ContextVar('query_comment', default=None)
+
+
+def _normalize(value):
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [_normalize(item) for item in value]
+        # Lists of values such as $in operands have the same shape whatever their length
+        return items if any(isinstance(item, (dict, list)) for item in items) else ['?']
+
+    return '?'
+
+
+def get_pipeline_fingerprint(pipeline: List[dict]) -> str:
+    """
+    Hashes the shape of the pipeline, its stages, operators and fields but none of its values.
+    """
+    normalized = orjson.dumps(_normalize(pipeline), option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha1(normalized).hexdigest()[:16]
+
+
+def _get_collection(event: CommandStartedEvent) -> str:
+    name = event.command.get('collection') if event.command_name == 'getMore' \
+        else event.command.get(event.command_name)
+    return name if isinstance(name, str) else ''
+
+
+def _get_returned_documents(reply: dict) -> Optional[int]:
+    cursor = reply.get('cursor')
+
+    if not isinstance(cursor, dict):
+        return None
+
+    return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+
+
+class CommandMonitor(CommandListener):
+    """
+    Records the duration and returned documents of every MongoDB command, and keeps the most recent
+    slow commands with the pipeline they ran and the query they came from.
+    Only the first fingerprint_labels pipeline shapes get their own metrics label, so the number of series
+    stays bounded, and the slow query log keeps the fingerprint of every command.
+    """
+
+    def __init__(self, slow_query_ms: float, slow_queries_buffer_size: int, fingerprint_labels: int):
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries: Deque[dict] = deque(maxlen=slow_queries_buffer_size)
+        self.fingerprint_labels = fingerprint_labels
+        self._labeled_fingerprints: Set[str] = set()
+        self._lock = threading.Lock()
+        self._commands: Dict[int, dict] = {}
+        # Aggregations of getMore commands, cursors that are not exhausted are evicted eventually
+        self._cursors = LRUCache(maxsize=10000)
+        self._query_origins = LRUCache(maxsize=1000)
+
+    def register_query_origin(self, comment: str, origin: Any):
+        with self._lock:
+            self._query_origins[comment] = origin
+
+    def started(self, event: CommandStartedEvent):
+        command = {'collection': _get_collection(event), 'fingerprint': None, 'pipeline': None, 'comment': None}
+
+        if event.command_name in _QUERY_FIELDS:
+            body = event.command.get(_QUERY_FIELDS[event.command_name]) or {}
+            command['pipeline'] = body if isinstance(body, list) else [{'$match': body}]
+            command['fingerprint'] = get_pipeline_fingerprint(command['pipeline'])
+            command['comment'] = event.command.get('comment')
+
+        with self._lock:
+            if event.command_name == 'getMore':
+                command['cursor_id'] = event.command.get('getMore')
+                command.update(self._cursors.get(command['cursor_id'], {}))
+
+            self._commands[event.request_id] = command
+
+    def succeeded(self, event: CommandSucceededEvent):
+        with self._lock:
+            command = self._commands.pop(event.request_id, None)
+
+            if command is None:
+                return
+
+            cursor = event.reply.get('cursor')
+
+            if isinstance(cursor, dict):
+                if cursor.get('id'):
+                    self._cursors[cursor['id']] = {
+                        key: command[key] for key in ('fingerprint', 'pipeline', 'comment')}
+                elif command.get('cursor_id'):
+                    self._cursors.pop(command['cursor_id'], None)
+
+        documents = _get_returned_documents(event.reply)
+
+        if documents is not None:
+            mongo_command_documents.labels(event.command_name, command['collection']).observe(documents)
+
+        self._record(event, command, documents)
+
+    def failed(self, event: CommandFailedEvent):
+        with self._lock:
+            command = self._commands.pop(event.request_id, None)
+
+        if command is None:
+            return
+
+        mongo_command_failures.labels(event.command_name, command['collection']).inc()
+        self._record(event, command, None, failure=str(event.failure.get('errmsg', '')))
+
+    def _get_fingerprint_label(self, fingerprint: str) -> str:
+        with self._lock:
+            if fingerprint not in self._labeled_fingerprints:
+                if len(self._labeled_fingerprints) >= self.fingerprint_labels:
+                    return OTHER_FINGERPRINTS_LABEL
+
+                self._labeled_fingerprints.add(fingerprint)
+
+        return fingerprint
+
+    def _record(self, event, command: dict, documents: Optional[int], failure: Optional[str] = None):
+        duration = event.duration_micros / 1e6
+        mongo_command_duration.labels(event.command_name, command['collection']).observe(duration)
+
+        if command['fingerprint'] and event.command_name in ('aggregate', 'getMore'):
+            mongo_pipeline_duration.labels(self._get_fingerprint_label(command['fingerprint'])).observe(duration)
+
+        if duration * 1000 >= self.slow_query_ms:
+            self._record_slow_query(event, command, duration, documents, failure)
+
+    def _record_slow_query(self, event, command: dict, duration: float, documents: Optional[int],
+                           failure: Optional[str]):
+        comment = command['comment'] if isinstance(command['comment'], str) else None
+        slow_query = {
+            'command': event.command_name,
+            'collection': command['collection'],
+            'time': datetime.utcnow(),
+            'duration_ms': duration * 1000,
+            'documents_returned': documents,
+            'fingerprint': command['fingerprint'],
+            # Values such as ObjectIds are kept as extended json
+            'pipeline': orjson.loads(json_util.dumps(command['pipeline'])) if command['pipeline'] is not None
+            else None,
+            'comment': comment,
+            'origin': self._query_origins.get(comment) if comment else None,
+            'failure': failure,
+        }
+        self.slow_queries.append(slow_query)
+        logger.warning('Slow MongoDB %s on %s took %.1fms, fingerprint %s, comment %s',
+                       event.command_name, command['collection'], slow_query['duration_ms'],
+                       command['fingerprint'], comment)
+
+    def get_slow_queries(self, limit: Optional[int] = None) -> List[dict]:
+        """
+        Returns the recorded slow commands, most recent first.
+        """
+        return list(reversed(self.slow_queries))[:limit]
+
+
+command_monitor = CommandMonitor(
+    Config.MONGO_SLOW_QUERY_MS, Config.MONGO_SLOW_QUERIES_BUFFER_SIZE, Config.MONGO_PIPELINE_FINGERPRINT_LABELS)
+
+
+@contextmanager
+def query_origin(name: str, query: List[Any]):
+    """
+    Tags the aggregations run inside the block with the query stages they were compiled from.
+    """
+    origin = [{'stage': step.stage.value, 'parameters': step.parameters} for step in query]
+    origin = orjson.loads(orjson.dumps(origin, default=str))
+    comment = f'{name}:{hashlib.sha1(orjson.dumps(origin, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]}'
+    command_monitor.register_query_origin(comment, origin)
+    token = _query_comment.set(comment)
+
+    try:
+        yield
+    finally:
+        _query_comment.reset(token)
+
+
+def get_aggregate_options() -> dict:
+    comment = _query_comment.get()
+    return {'comment': comment} if comment else {}
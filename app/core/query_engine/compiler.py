@@ -0,0 +1,86 @@
+from typing import List, Tuple
+import copy
+import hashlib
+
+import orjson
+from cachetools import LRUCache
+from prometheus_client import Counter
+
+from app.config import Config
+from app.models import Label
+from app.core.query_engine.stages import STAGES, QueryStage
+from app.core.query_engine.optimizer import optimize_pipeline
+
+
+query_plan_cache_hits = Counter(
+    'query_plan_cache_hits_total', 'Number of compiled annotation pipelines served from cache')
+query_plan_cache_misses = Counter(
+    'query_plan_cache_misses_total', 'Number of annotation pipelines compiled from scratch')
+
+
+def _hash(value) -> str:
+    return hashlib.sha256(orjson.dumps(value, default=str, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def get_query_hash(query: List[QueryStage]) -> str:
+    return _hash([[step.stage.value, step.parameters] for step in query])
+
+
+def get_pipeline_hash(pipeline: List[dict]) -> str:
+    return _hash(pipeline)
+
+
+def get_schema_version(project_labels: List[Label], project_attributes: List[str]) -> str:
+    labels = sorted([label.name, label.shape.value, sorted(label.attributes)] for label in project_labels)
+    return _hash([labels, sorted(project_attributes)])
+
+
+class CompiledPipelineCache:
+    """
+    LRU cache of compiled mongo pipelines, addressed by the hash of the query stages
+    and the version of the project schema the stages were validated against.
+    Pipelines are copied in and out, callers are free to modify the stages they get.
+    """
+
+    def __init__(self, maxsize: int):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def get(self, key: Tuple[str, str]):
+        pipeline = self._cache.get(key)
+
+        if pipeline is None:
+            query_plan_cache_misses.inc()
+            return None
+
+        query_plan_cache_hits.inc()
+        return copy.deepcopy(pipeline)
+
+    def set(self, key: Tuple[str, str], pipeline: List[dict]):
+        self._cache[key] = copy.deepcopy(pipeline)
+
+    def clear(self):
+        self._cache.clear()
+
+
+compiled_pipeline_cache = CompiledPipelineCache(maxsize=Config.QUERY_PLAN_CACHE_SIZE)
+
+
+def compile_pipeline(query: List[QueryStage],
+                     project_labels: List[Label],
+                     project_attributes: List[str]) -> List[dict]:
+    key = (get_query_hash(query), get_schema_version(project_labels, project_attributes))
+    pipeline = compiled_pipeline_cache.get(key)
+
+    if pipeline is not None:
+        return pipeline
+
+    pipeline = []
+
+    for step in query:
+        stage = STAGES[step.stage.value](**step.parameters)
+        stage.validate_stage(project_labels=project_labels, project_attributes=project_attributes)
+        pipeline.extend(stage.to_mongo())
+
+    pipeline = optimize_pipeline(pipeline)
+    compiled_pipeline_cache.set(key, pipeline)
+    return pipeline
@@ -0,0 +1,360 @@
+from typing import List, Optional, Set
+
+from pymongo import ASCENDING
+
+from app.models import ImageAnnotations
+from app.core.query_engine.stages import RANDOM_TAKE_FIELD, get_rotated_random_key_offset
+
+
+# Fields that always hold a single scalar value, where an aggregation equality behaves
+# exactly like a query equality (array fields would also match on any of their elements).
+_SCALAR_FIELDS = {
+    '_id',
+    +ImageAnnotations.event_id,
+    +ImageAnnotations.project_id,
+    +ImageAnnotations.has_image,
+}
+
+# Stages that transform every document on its own, without adding, removing or reordering documents.
+_DOCUMENT_STAGES = {'$set', '$addFields', '$unset', '$project'}
+
+_LOGICAL_OPERATORS = {'$and', '$or', '$nor'}
+
+
+def _get_stage_name(stage: dict) -> Optional[str]:
+    return next(iter(stage)) if len(stage) == 1 else None
+
+
+def _is_literal(value) -> bool:
+    if isinstance(value, str):
+        return not value.startswith('$')
+    return isinstance(value, (int, float, bool))
+
+
+def _unwrap_literal(value):
+    if isinstance(value, dict) and list(value.keys()) == ['$literal']:
+        return value['$literal']
+    return value
+
+
+def _get_field(value) -> Optional[str]:
+    if isinstance(value, str) and value.startswith('$') and not value.startswith('$$'):
+        return value[1:]
+    return None
+
+
+def _rewrite_expr(expr) -> Optional[dict]:
+    """
+    Translates an aggregation expression into an equivalent query filter when it is a simple
+    equality or $in comparison over a scalar field, so it can be resolved with an index.
+    """
+    if not isinstance(expr, dict) or len(expr) != 1:
+        return None
+
+    operator, args = next(iter(expr.items()))
+
+    if operator == '$eq' and isinstance(args, list) and len(args) == 2:
+        for field, value in (args, args[::-1]):
+            field, value = _get_field(field), _unwrap_literal(value)
+            if field in _SCALAR_FIELDS and _is_literal(value):
+                return {field: value}
+
+    if operator == '$in' and isinstance(args, list) and len(args) == 2:
+        field, values = _get_field(args[0]), _unwrap_literal(args[1])
+        if field in _SCALAR_FIELDS and isinstance(values, list) and all(_is_literal(x) for x in values):
+            return {field: {'$in': values}}
+
+    return None
+
+
+def _rewrite_match(match: dict) -> List[dict]:
+    """
+    Splits the comparisons of a $match that can be expressed as query operators into their own $match stage,
+    so they can be moved independently from the rest of the $expr.
+    """
+    if '$expr' not in match:
+        return [{'$match': match}]
+
+    expr = match['$expr']
+    clauses = expr['$and'] if isinstance(expr, dict) and list(expr.keys()) == ['$and'] else [expr]
+    filters, remaining = [], []
+
+    for clause in clauses:
+        rewritten = _rewrite_expr(clause)
+        if rewritten is None:
+            remaining.append(clause)
+        else:
+            filters.append(rewritten)
+
+    if not filters:
+        return [{'$match': match}]
+
+    query = {key: value for key, value in match.items() if key != '$expr'}
+    result = [{'$match': {'$and': filters} if len(filters) > 1 else filters[0]}]
+
+    if remaining:
+        query['$expr'] = remaining[0] if len(remaining) == 1 else {'$and': remaining}
+
+    if query:
+        result.append({'$match': query})
+
+    return result
+
+
+def _collect_expression_fields(expr, fields: Set[str]) -> bool:
+    """
+    Adds the document fields referenced by an aggregation expression to fields.
+    Returns False if the expression references the whole document.
+    """
+    if isinstance(expr, str):
+        if expr.startswith('$$ROOT') or expr.startswith('$$CURRENT'):
+            return False
+        field = _get_field(expr)
+        if field:
+            fields.add(field)
+        return True
+
+    if isinstance(expr, dict):
+        if '$literal' in expr:
+            return True
+        return all(_collect_expression_fields(value, fields) for value in expr.values())
+
+    if isinstance(expr, list):
+        return all(_collect_expression_fields(value, fields) for value in expr)
+
+    return True
+
+
+def _collect_query_fields(query: dict, fields: Set[str]) -> bool:
+    for key, value in query.items():
+        if key in _LOGICAL_OPERATORS:
+            if not all(_collect_query_fields(clause, fields) for clause in value):
+                return False
+        elif key == '$expr':
+            if not _collect_expression_fields(value, fields):
+                return False
+        elif key.startswith('$'):
+            # $where, $text, etc. can't be analyzed
+            return False
+        else:
+            fields.add(key)
+
+    return True
+
+
+def _get_match_fields(match: dict) -> Optional[Set[str]]:
+    fields = set()
+    return fields if _collect_query_fields(match, fields) else None
+
+
+def _conflicts(field: str, other: str) -> bool:
+    return field == other or field.startswith(other + '.') or other.startswith(field + '.')
+
+
+def _is_inclusion_flag(value) -> bool:
+    return isinstance(value, (bool, int)) and value in (1, True)
+
+
+def _is_exclusion_flag(value) -> bool:
+    return isinstance(value, (bool, int)) and value in (0, False)
+
+
+def _get_unset_fields(stage: dict) -> List[str]:
+    fields = stage['$unset']
+    return [fields] if isinstance(fields, str) else list(fields)
+
+
+def _is_independent(fields: Set[str], stage: dict) -> bool:
+    """
+    Whether the given fields have the same value before and after the document stage.
+    """
+    name = _get_stage_name(stage)
+
+    if name in ('$set', '$addFields'):
+        modified = list(stage[name].keys())
+    elif name == '$unset':
+        modified = _get_unset_fields(stage)
+    elif name == '$project':
+        projection = stage['$project']
+        fields_projection = [v for k, v in projection.items() if k != '_id'] or [projection['_id']]
+        is_exclusion = all(_is_exclusion_flag(v) for v in fields_projection)
+
+        if is_exclusion:
+            modified = [k for k, v in projection.items() if _is_exclusion_flag(v)]
+        else:
+            included = [k for k, v in projection.items() if _is_inclusion_flag(v)]
+            if projection.get('_id', 1) not in (0, False):
+                included.append('_id')
+            modified = [k for k, v in projection.items() if not _is_inclusion_flag(v)]
+
+            # Fields that are not included are removed by the projection
+            if not all(any(field == x or field.startswith(x + '.') for x in included) for field in fields):
+                return False
+    else:
+        return False
+
+    return not any(_conflicts(field, other) for field in fields for other in modified)
+
+
+def _merge_sets(first: dict, second: dict) -> Optional[dict]:
+    first_name, second_name = _get_stage_name(first), _get_stage_name(second)
+    first_fields, second_values = first[first_name], second[second_name]
+    referenced = set()
+
+    if not _collect_expression_fields(list(second_values.values()), referenced):
+        return None
+
+    touched = referenced | set(second_values.keys())
+
+    if any(_conflicts(field, other) for field in touched for other in first_fields):
+        return None
+
+    return {'$set': {**first_fields, **second_values}}
+
+
+def _merge_projects(first: dict, second: dict) -> Optional[dict]:
+    first_projection, second_projection = first['$project'], second['$project']
+    first_fields = {k: v for k, v in first_projection.items() if k != '_id'}
+    second_fields = {k: v for k, v in second_projection.items() if k != '_id'}
+
+    if not second_fields or not all(_is_inclusion_flag(v) for v in second_fields.values()):
+        return None
+
+    if not first_fields or all(_is_exclusion_flag(v) for v in first_fields.values()):
+        return None
+
+    if not all(field in first_projection for field in second_fields):
+        return None
+
+    merged = {field: first_projection[field] for field in second_fields}
+
+    if _is_exclusion_flag(second_projection.get('_id', 1)):
+        merged['_id'] = 0
+    elif '_id' in first_projection:
+        merged['_id'] = first_projection['_id']
+
+    return {'$project': merged}
+
+
+def _merge_adjacent(first: dict, second: dict) -> Optional[dict]:
+    first_name, second_name = _get_stage_name(first), _get_stage_name(second)
+
+    if first_name in ('$set', '$addFields') and second_name in ('$set', '$addFields'):
+        return _merge_sets(first, second)
+    if first_name == '$unset' and second_name == '$unset':
+        return {'$unset': _get_unset_fields(first) + _get_unset_fields(second)}
+    if first_name == '$project' and second_name == '$project':
+        return _merge_projects(first, second)
+    if first_name == '$limit' and second_name == '$limit':
+        return {'$limit': min(first['$limit'], second['$limit'])}
+    if first_name == '$skip' and second_name == '$skip':
+        return {'$skip': first['$skip'] + second['$skip']}
+    if first_name == '$sort' and second_name == '$sort':
+        # $sort is not stable, so the first sort is not guaranteed to break the ties of the second one.
+        # Keeping its keys after the second ones makes that tie order explicit instead of dropping it.
+        return {'$sort': {**second['$sort'], **{k: v for k, v in first['$sort'].items() if k not in second['$sort']}}}
+
+    return None
+
+
+def _should_swap(previous: dict, stage: dict) -> bool:
+    previous_name, name = _get_stage_name(previous), _get_stage_name(stage)
+
+    if name == '$match':
+        if previous_name == '$sort':
+            return True
+        # Filters commute, so index-friendly ones are moved ahead of $expr ones
+        if previous_name == '$match':
+            return '$expr' in previous['$match'] and '$expr' not in stage['$match']
+        if previous_name in _DOCUMENT_STAGES:
+            fields = _get_match_fields(stage['$match'])
+            return fields is not None and _is_independent(fields, previous)
+
+    # Moving the limit next to a preceding sort lets mongo run a top-k sort
+    if name == '$limit' and previous_name in _DOCUMENT_STAGES:
+        return True
+
+    return False
+
+
+def _optimize_step(pipeline: List[dict]) -> bool:
+    for i in range(1, len(pipeline)):
+        if _should_swap(pipeline[i - 1], pipeline[i]):
+            pipeline[i - 1], pipeline[i] = pipeline[i], pipeline[i - 1]
+            return True
+
+        merged = _merge_adjacent(pipeline[i - 1], pipeline[i])
+
+        if merged is not None:
+            pipeline[i - 1:i + 1] = [merged]
+            return True
+
+    return False
+
+
+def _get_random_take(stages: List[dict]) -> Optional[float]:
+    """
+    Returns the offset of the random key if the stages are the ones emitted by a seeded Take.
+    """
+    if len(stages) != 4 or list(stages[0]) != ['$set'] or list(stages[0]['$set']) != [RANDOM_TAKE_FIELD]:
+        return None
+
+    if stages[1] != {'$sort': {RANDOM_TAKE_FIELD: ASCENDING}} or _get_stage_name(stages[2]) != '$limit' \
+            or stages[3] != {'$unset': RANDOM_TAKE_FIELD}:
+        return None
+
+    return get_rotated_random_key_offset(stages[0]['$set'][RANDOM_TAKE_FIELD])
+
+
+def _rewrite_random_take(pipeline: List[dict]) -> List[dict]:
+    """
+    Replaces the sort of every sample by its rotated random key in a seeded Take that only follows $match stages
+    with two index range seeks over the persisted key: the samples from the offset onwards, and the ones before it
+    in case the first range runs out. Only the up to 2 * size samples they return are sorted by the rotated key.
+    The second range also holds the samples without a key, which sort first like their missing rotated key does.
+    """
+    start = 0
+
+    while start < len(pipeline) and _get_stage_name(pipeline[start]) == '$match':
+        start += 1
+
+    take = pipeline[start:start + 4]
+    offset = _get_random_take(take)
+
+    if offset is None:
+        return pipeline
+
+    filters, field, size = pipeline[:start], +ImageAnnotations.rand, take[2]['$limit']
+
+    def seek(condition: dict) -> List[dict]:
+        return [{'$match': {field: condition}}, {'$sort': {field: ASCENDING}}, {'$limit': size}]
+
+    wraparound = {'coll': ImageAnnotations.__collection__, 'pipeline': filters + seek({'$not': {'$gte': offset}})}
+    return filters + seek({'$gte': offset}) + [{'$unionWith': wraparound}] + take + pipeline[start + 4:]
+
+
+def optimize_pipeline(pipeline: List[dict]) -> List[dict]:
+    """
+    Rewrites the pipeline generated by the query stages into an equivalent one that mongo can run faster:
+    - Simple $expr equality and $in comparisons are converted into index-friendly query operators.
+    - $match stages are moved ahead of $sort, $project and $set stages that don't modify the fields they use,
+      and query operator filters are moved ahead of $expr ones.
+    - Adjacent $set, $unset, $project, $limit, $skip and $sort stages are merged, the keys of the first $sort
+      break the ties of the second one.
+    - $limit stages are moved ahead of document transformations, so they are coalesced with the previous $sort.
+    - Seeded Take stages at the start of the pipeline seek the persisted random key instead of sorting every sample.
+    """
+    pipeline = [
+        rewritten
+        for stage in pipeline
+        for rewritten in (_rewrite_match(stage['$match']) if _get_stage_name(stage) == '$match' else [stage])
+    ]
+
+    # Every step either swaps two stages towards the start of the pipeline or removes one, so this terminates
+    max_steps = len(pipeline) ** 2 + 1
+
+    for _ in range(max_steps):
+        if not _optimize_step(pipeline):
+            break
+
+    return _rewrite_random_take(pipeline)
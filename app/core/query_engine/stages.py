@@ -1,4 +1,5 @@
-from typing import List, Optional, Union, Dict, Any
+from typing import List, Optional, Union, Dict, Any, Tuple
+import base64
 import random
 from datetime import datetime
 from enum import Enum
@@ -6,6 +7,7 @@ from enum import Enum
 from odmantic import Field
 from pymongo import ASCENDING, DESCENDING
 from aenum import extend_enum
+from bson import json_util
 
 from app.core.query_engine.expressions import ViewExpression, ViewField
 from app.core.query_engine.builder import construct_view_expression
@@ -14,13 +16,34 @@ from app.models import ObjectId, EmbeddedModel, QueryExpression, ImageAnnotation
 from pydantic import root_validator, create_model
 
 
-def _get_random_generator(seed):
-    if seed is None:
-        return random
+# Field holding the rotated random key of the samples while a seeded Take sorts them
+RANDOM_TAKE_FIELD = '_rand_take'
 
+
+def _get_random_offset(seed: int) -> float:
     _random = random.Random()
     _random.seed(seed)
-    return _random
+    return _random.random()
+
+
+def get_rotated_random_key(offset: float) -> dict:
+    """
+    Returns an expression that rotates the persisted random key of the samples by the offset.
+    The result is still uniformly distributed, but its order is different for every offset.
+    """
+    return {"$mod": [{"$add": [f"${+ImageAnnotations.rand}", 1, -offset]}, 1]}
+
+
+def get_rotated_random_key_offset(expr) -> Optional[float]:
+    """
+    Returns the offset of an expression built by get_rotated_random_key, or None for any other expression.
+    """
+    try:
+        offset = -expr['$mod'][0]['$add'][2]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+    return offset if expr == get_rotated_random_key(offset) else None
 
 
 def _get_annotations_field(shape: Union[Shape, str]):
@@ -131,16 +154,18 @@ class Take(EmbeddedModel):
     seed: Optional[int] = None
 
     def to_mongo(self):
-        randint = _get_random_generator(self.seed).randint(int(1e7), int(1e10))
-
         if self.size <= 0:
             return [{"$match": {"_id": None}}]
 
+        if self.seed is None:
+            return [{"$sample": {"size": self.size}}]
+
+        # The optimizer turns this sort into index range seeks when the Take only follows $match stages
         return [
-            {"$set": {"_rand_take": {"$mod": [randint, "$_rand"]}}},
-            {"$sort": {"_rand_take": ASCENDING}},
+            {"$set": {RANDOM_TAKE_FIELD: get_rotated_random_key(_get_random_offset(self.seed))}},
+            {"$sort": {RANDOM_TAKE_FIELD: ASCENDING}},
             {"$limit": self.size},
-            {"$unset": "_rand_take"},
+            {"$unset": RANDOM_TAKE_FIELD},
         ]
 
     def validate_stage(self, *_, **__):
@@ -174,10 +199,11 @@ class Shuffle(EmbeddedModel):
     seed: Optional[int] = None
 
     def to_mongo(self):
-        randint = _get_random_generator(self.seed).randint(int(1e7), int(1e10))
+        # Unseeded keys are drawn by mongo, so the compiled pipeline is the same for every run and can be cached
+        key = {"$rand": {}} if self.seed is None else get_rotated_random_key(_get_random_offset(self.seed))
 
         return [
-            {"$set": {"_rand_shuffle": {"$mod": [randint, "$_rand"]}}},
+            {"$set": {"_rand_shuffle": key}},
             {"$sort": {"_rand_shuffle": ASCENDING}},
             {"$unset": "_rand_shuffle"},
         ]
@@ -307,7 +333,7 @@ class FilterLabels(EmbeddedModel):
     filter_empty: bool = True
 
     def to_mongo(self):
-        if not self.labels:
+        if not self.filters:
             return []
 
         project_result = {}
@@ -696,7 +722,8 @@ class SetLabelAttribute(EmbeddedModel):
         return cls.schema()
 
 
-def make_generic_paginated_pipeline(pipeline: List[dict], page_size: int = None, page: int = None):
+def make_generic_paginated_pipeline(pipeline: List[dict], page_size: int = None, page: int = None,
+                                    include_total: bool = True):
     if page is not None and page_size is not None:
         data_pipeline = [
             {'$skip': page * page_size},
@@ -705,42 +732,214 @@ def make_generic_paginated_pipeline(pipeline: List[dict], page_size: int = None,
     else:
         data_pipeline = []
 
+    if include_total:
+        metadata_pipeline = [{'$count': 'total'}]
+    else:
+        metadata_pipeline = [{'$limit': 1}, {'$replaceRoot': {'newRoot': {}}}]
+
+    metadata_pipeline.append({'$addFields': {'page': page}})
+
     stage = {
         '$facet': {
-            'metadata': [{'$count': 'total'}, {'$addFields': {'page': page}}],
+            'metadata': metadata_pipeline,
             'data': data_pipeline
         }
     }
     return pipeline + [stage]
 
 
-def make_paginated_pipeline(pipeline: List[dict], page_size: int = None, page: int = None):
-    image_lookup = {
-        '$lookup': {
-            'from': 'image',
-            'localField': 'event_id',
-            'foreignField': 'event_id',
-            'as': 'image'
-        },
-    }
+_IMAGE_LOOKUP_STAGE = {
+    '$lookup': {
+        'from': 'image',
+        'localField': 'event_id',
+        'foreignField': 'event_id',
+        'as': 'image'
+    },
+}
+
 
+def make_paginated_pipeline(pipeline: List[dict], page_size: int = None, page: int = None):
+    """
+    Returns the pipeline that retrieves a single page of annotations.
+    The total is not part of the result, it should be counted with make_count_pipeline.
+    """
     data_pipeline = []
 
+    if page and page_size is not None:
+        _check_resumable_pipeline(pipeline)
+
     if page is not None and page_size is not None:
         data_pipeline += [
             {'$skip': page * page_size},
             {'$limit': page_size},
         ]
 
-    data_pipeline.append(image_lookup)
+    data_pipeline.append(_IMAGE_LOOKUP_STAGE)
 
-    stage = {
-        '$facet': {
-            'metadata': [{'$count': 'total'}, {'$addFields': {'page': page}}],
-            'data': data_pipeline
-        }
+    return pipeline + data_pipeline
+
+
+def _check_resumable_pipeline(pipeline: List[dict]):
+    """
+    Raises a ValueError if the pipeline draws a different random sample every time it runs, so its
+    pages after the first one wouldn't continue the same results.
+    """
+    if any('$sample' in stage for stage in pipeline):
+        raise ValueError('Only the first page of an unseeded take can be retrieved, set its seed to paginate it')
+
+
+# Stages that can change the number of documents (other than filtering them) or depend on other documents.
+_NON_ESTIMABLE_STAGES = {'$limit', '$skip', '$sample', '$group', '$unwind', '$facet', '$bucket',
+                         '$bucketAuto', '$sortByCount', '$unionWith', '$replaceRoot', '$replaceWith'}
+
+
+def is_estimable_pipeline(pipeline: List[dict]) -> bool:
+    """
+    Whether the pipeline only filters or transforms documents one by one, so its result size can be
+    estimated by running it over a random sample of the collection.
+    """
+    return not any(key in _NON_ESTIMABLE_STAGES for stage in pipeline for key in stage)
+
+
+def scope_pipeline(match: dict, pipeline: List[dict]) -> List[dict]:
+    """
+    Restricts the pipeline to the documents matching the filter, including the pipelines of its $unionWith stages,
+    which read the collection on their own.
+    """
+    return [{'$match': match}] + [
+        {'$unionWith': {**stage['$unionWith'], 'pipeline': scope_pipeline(match, stage['$unionWith']['pipeline'])}}
+        if '$unionWith' in stage else stage
+        for stage in pipeline
+    ]
+
+
+def make_count_pipeline(pipeline: List[dict]):
+    return pipeline + [{'$count': 'total'}]
+
+
+def make_estimated_count_pipeline(match: dict, pipeline: List[dict], sample_size: int):
+    """
+    Counts the documents of a random sample of the ones matching the filter that pass the pipeline.
+    Sampling after the filter keeps the sample within a project however small its share of the collection is.
+    """
+    pipeline = scope_pipeline(match, pipeline)
+    return pipeline[:1] + [{'$sample': {'size': sample_size}}] + make_count_pipeline(pipeline[1:])
+
+
+KEYSET_VALUES_FIELD = '_keyset_values'
+
+
+def _split_keyset_sort(pipeline: List[dict]) -> Tuple[List[dict], List[Tuple[str, int]], List[dict]]:
+    """
+    Returns the pipeline without its trailing sort, the sort keys that keyset pagination should follow
+    and the $unset stages that came after the sort, as emitted by SortBy.
+    Only a plain-field $sort at the end of the pipeline is honoured, otherwise the results are paginated in _id order.
+    """
+    end = len(pipeline)
+
+    while end > 0 and '$unset' in pipeline[end - 1]:
+        end -= 1
+
+    sort = pipeline[end - 1].get('$sort') if end > 0 else None
+
+    if not sort or not all(isinstance(direction, int) for direction in sort.values()):
+        return pipeline, [], []
+
+    keys = []
+
+    for field, direction in sort.items():
+        keys.append((field, direction))
+        if field == '_id':
+            break
+
+    return pipeline[:end - 1], keys, pipeline[end:]
+
+
+def _make_keyset_filter(keys: List[Tuple[str, int]], values: list) -> dict:
+    clauses = []
+
+    for i, (field, direction) in enumerate(keys):
+        equal = {prev_field: prev_value for (prev_field, _), prev_value in zip(keys[:i], values[:i])}
+        value = values[i]
+
+        if value is None:
+            # Null and missing values sort first, so nothing comes before them in descending order
+            if direction == DESCENDING:
+                continue
+            clauses.append({**equal, field: {'$ne': None}})
+        elif direction == ASCENDING:
+            clauses.append({**equal, field: {'$gt': value}})
+        else:
+            # Null and missing values sort last in descending order
+            clauses.append({**equal, '$or': [{field: {'$lt': value}}, {field: None}]})
+
+    return {'$or': clauses} if clauses else {'_id': None}
+
+
+def _get_document_value(document: dict, path: str):
+    value = document
+
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+
+    return value
+
+
+def make_keyset_paginated_pipeline(pipeline: List[dict], page_size: int, continuation_token: Optional[str] = None):
+    if continuation_token:
+        _check_resumable_pipeline(pipeline)
+
+    pipeline, keys, unset_stages = _split_keyset_sort(pipeline)
+
+    if not keys or keys[-1][0] != '_id':
+        keys.append(('_id', keys[0][1] if keys else ASCENDING))
+
+    if continuation_token:
+        values = decode_continuation_token(continuation_token, keys)
+        pipeline = pipeline + [{'$match': _make_keyset_filter(keys, values)}]
+
+    data_pipeline = pipeline + [
+        {'$sort': dict(keys)},
+        {'$limit': page_size},
+    ]
+
+    if unset_stages:
+        # The continuation token is encoded from the sort keys, some of which the $unset stages remove
+        data_pipeline += [{'$set': {KEYSET_VALUES_FIELD: [f'${field}' for field, _ in keys]}}] + unset_stages
+
+    data_pipeline.append(_IMAGE_LOOKUP_STAGE)
+    return data_pipeline, keys
+
+
+def pop_keyset_values(document: dict, keys: List[Tuple[str, int]]) -> list:
+    """
+    Removes the sort key values added by the keyset pipeline from the document and returns them.
+    """
+    values = document.pop(KEYSET_VALUES_FIELD, None)
+    return values if values is not None else [_get_document_value(document, field) for field, _ in keys]
+
+
+def encode_continuation_token(values: list, keys: List[Tuple[str, int]]) -> str:
+    token = {
+        'keys': [field for field, _ in keys],
+        'values': values,
     }
-    return pipeline + [stage]
+    return base64.urlsafe_b64encode(json_util.dumps(token).encode()).decode()
+
+
+def decode_continuation_token(token: str, keys: List[Tuple[str, int]]) -> list:
+    try:
+        token = json_util.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        fields, values = token['keys'], token['values']
+    except (ValueError, TypeError, KeyError):
+        raise ValueError('Invalid continuation token')
+
+    if fields != [field for field, _ in keys] or len(values) != len(keys):
+        raise ValueError('Continuation token does not match the query sort order')
+
+    return values
 
 
 STAGES = {
@@ -16,3 +16,5 @@ datasets_started_job_registry = StartedJobRegistry(queue=datasets_queue)
 datasets_finished_job_registry = FinishedJobRegistry(queue=datasets_queue)
 datasets_failed_job_registry = FinishedJobRegistry(queue=datasets_queue)
 
+
+imports_queue = Queue('imports', connection=redis)
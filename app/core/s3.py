@@ -1,8 +1,57 @@
+from typing import List
+import time
+
 import aioboto3
+import boto3
+from cachetools import LRUCache
+
 from app.config import Config
 
 session = aioboto3.Session()
 
+_signer = None
+_signed_urls_cache = LRUCache(maxsize=Config.SIGNED_URLS_CACHE_SIZE)
+
 
 def get_s3_client():
     return session.client('s3', endpoint_url=Config.AWS_ENDPOINT_URL)
+
+
+def get_s3_signer():
+    """
+    Returns a long-lived client used only to sign urls. Signing is done locally, so the
+    same client is shared by every request instead of opening a new connection pool each time.
+    """
+    global _signer
+
+    if _signer is None:
+        _signer = boto3.session.Session().client('s3', endpoint_url=Config.AWS_ENDPOINT_URL)
+
+    return _signer
+
+
+def generate_presigned_get_urls(bucket: str, keys: List[str], expires_in: int) -> List[str]:
+    """
+    Signs get urls for all the keys of the bucket. Urls are cached for half of their
+    expiration time, so repeated views of the same objects return the same url.
+    """
+    expiration_window = max(expires_in // 2, 1)
+    expiration_bucket = int(time.time() // expiration_window)
+    signer = get_s3_signer()
+    urls = []
+
+    for key in keys:
+        cache_key = (bucket, key, expires_in, expiration_bucket)
+        url = _signed_urls_cache.get(cache_key)
+
+        if url is None:
+            url = signer.generate_presigned_url(
+                'get_object',
+                ExpiresIn=expires_in,
+                Params={'Bucket': bucket, 'Key': key},
+            )
+            _signed_urls_cache[cache_key] = url
+
+        urls.append(url)
+
+    return urls
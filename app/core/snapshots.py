@@ -0,0 +1,325 @@
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+import bisect
+import hashlib
+import itertools
+import struct
+import zlib
+
+import msgpack
+import numpy as np
+import orjson
+
+from app.schema import ImageAnnotationsData
+
+SNAPSHOT_MAGIC = b'LBSNAP'
+SNAPSHOT_VERSION = 2
+
+_FOOTER_LENGTH = struct.Struct('<Q')
+_TRAILER_LENGTH = _FOOTER_LENGTH.size + len(SNAPSHOT_MAGIC)
+
+# Bytes read from the end of the file when opening it, enough to get the footer of most snapshots in one read
+_TAIL_READ_SIZE = 64 * 1024
+
+SCALAR_COLUMNS = [
+    'event_id',
+    'has_image',
+    'thumbnail_url',
+    'image_url',
+    'image_width',
+    'image_height',
+    'attributes',
+    'labels',
+    'captions',
+]
+
+# Object columns whose geometry is stored as a flat float array
+GEOMETRY_COLUMNS = {
+    'points': 'points',
+    'polylines': 'points',
+    'detections': 'box',
+    'polygons': 'points',
+    'tags': None,
+}
+
+COLUMNS = SCALAR_COLUMNS + list(GEOMETRY_COLUMNS)
+
+# Digest of the contents of every row, written along the columns but only read when asked for
+DIGEST_COLUMN = 'digest'
+
+# Signed urls change over time, so they are not part of the contents compared between versions
+_DIGEST_EXCLUDED_FIELDS = {'thumbnail_url', 'image_url'}
+
+
+def get_row_digest(row: Dict[str, Any]) -> str:
+    data = {key: value for key, value in row.items() if key not in _DIGEST_EXCLUDED_FIELDS}
+    return hashlib.sha1(orjson.dumps(data, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def _pack(value) -> bytes:
+    return zlib.compress(msgpack.packb(value, use_bin_type=True))
+
+
+def _unpack(data: bytes):
+    return msgpack.unpackb(zlib.decompress(data), raw=False)
+
+
+def _encode_objects(rows: List[List[dict]], geometry_key: Optional[str]) -> dict:
+    """
+    Stores the objects of a column as one list per object field, plus the concatenated geometry
+    of all the objects as a single float array.
+    """
+    objects = [obj for row in rows for obj in row]
+    keys = sorted({key for obj in objects for key in obj if key != geometry_key})
+    encoded = {
+        'counts': [len(row) for row in rows],
+        'fields': {key: [obj.get(key) for obj in objects] for key in keys},
+    }
+
+    if geometry_key:
+        geometry = [obj[geometry_key] for obj in objects]
+        encoded['lengths'] = [len(x) for x in geometry]
+        encoded['geometry'] = np.fromiter(itertools.chain.from_iterable(geometry), dtype='<f8').tobytes()
+
+    return encoded
+
+
+def _decode_objects(encoded: dict, geometry_key: Optional[str]) -> List[List[dict]]:
+    fields = encoded['fields']
+    count = sum(encoded['counts'])
+    objects = [{key: values[i] for key, values in fields.items()} for i in range(count)]
+
+    if geometry_key:
+        lengths = np.array(encoded['lengths'], dtype=np.int64)
+        geometry = np.frombuffer(encoded['geometry'], dtype='<f8')
+
+        for obj, values in zip(objects, np.split(geometry, np.cumsum(lengths)[:-1]) if count else []):
+            obj[geometry_key] = values.tolist()
+
+    starts = list(itertools.accumulate([0] + encoded['counts']))
+    return [objects[start:end] for start, end in zip(starts, starts[1:])]
+
+
+class SnapshotWriter:
+    """
+    Writes annotations in the columnar snapshot format:
+    header | blocks | index pages | footer | footer length | magic
+
+    Every block holds up to block_size rows, with each column compressed on its own so readers
+    can load only the columns they need, and the digest of every row. Index pages hold the
+    (event_id, row) pairs sorted by event_id.
+    The footer holds the offsets of every column of every block and the first event_id of every index page.
+    """
+
+    def __init__(self, file: BinaryIO, block_size: int = 1000, index_page_size: int = 4096,
+                 metadata: Optional[dict] = None):
+        self._file = file
+        self._metadata = metadata or {}
+        self._block_size = block_size
+        self._index_page_size = index_page_size
+        self._offset = 0
+        self._blocks = []
+        self._rows = []
+        self._index = []
+        self._total_rows = 0
+        self._write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]))
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def _flush_block(self):
+        if not self._rows:
+            return
+
+        columns = {}
+
+        for column in COLUMNS + [DIGEST_COLUMN]:
+            if column == DIGEST_COLUMN:
+                values = [get_row_digest(row) for row in self._rows]
+            else:
+                values = [row.get(column) for row in self._rows]
+
+            if column in GEOMETRY_COLUMNS:
+                values = _encode_objects([x or [] for x in values], GEOMETRY_COLUMNS[column])
+
+            data = _pack(values)
+            columns[column] = [self._offset, len(data)]
+            self._write(data)
+
+        self._blocks.append({'rows': len(self._rows), 'columns': columns})
+        self._total_rows += len(self._rows)
+        self._rows = []
+
+    def _write_index(self) -> List[list]:
+        self._index.sort()
+        pages = []
+
+        for start in range(0, len(self._index), self._index_page_size):
+            page = self._index[start:start + self._index_page_size]
+            data = _pack(page)
+            pages.append([page[0][0], self._offset, len(data)])
+            self._write(data)
+
+        return pages
+
+    def write(self, rows: Iterable[dict]):
+        for row in rows:
+            self._index.append((row['event_id'], self._total_rows + len(self._rows)))
+            self._rows.append(row)
+
+            if len(self._rows) >= self._block_size:
+                self._flush_block()
+
+    def close(self):
+        self._flush_block()
+        index = self._write_index()
+        footer = msgpack.packb({
+            'version': SNAPSHOT_VERSION,
+            'columns': COLUMNS,
+            'rows': self._total_rows,
+            'blocks': self._blocks,
+            'index': index,
+            'metadata': self._metadata,
+        }, use_bin_type=True)
+        self._write(footer + _FOOTER_LENGTH.pack(len(footer)) + SNAPSHOT_MAGIC)
+
+
+class SnapshotReader:
+    """
+    Reads snapshots with as few reads as possible, so it can be used over S3 range requests:
+    the footer is read once (or given if it was cached), and every block or index page is a single read.
+    """
+
+    def __init__(self, file: BinaryIO, footer: Optional[dict] = None):
+        self._file = file
+        self.footer = footer or self._read_footer()
+        self._block_ends = list(itertools.accumulate(block['rows'] for block in self.footer['blocks']))
+        # Last decoded block, rows read in order across calls often fall in the same block
+        self._last_block = None
+
+    def _read(self, offset: int, length: int) -> bytes:
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def _read_footer(self) -> dict:
+        size = self._file.seek(0, 2)
+        tail_size = min(size, _TAIL_READ_SIZE)
+        tail = self._read(size - tail_size, tail_size)
+
+        if tail[-len(SNAPSHOT_MAGIC):] != SNAPSHOT_MAGIC:
+            raise ValueError('Invalid snapshot file')
+
+        footer_length, = _FOOTER_LENGTH.unpack(tail[-_TRAILER_LENGTH:-len(SNAPSHOT_MAGIC)])
+
+        if footer_length + _TRAILER_LENGTH > tail_size:
+            footer = self._read(size - _TRAILER_LENGTH - footer_length, footer_length)
+        else:
+            footer = tail[-_TRAILER_LENGTH - footer_length:-_TRAILER_LENGTH]
+
+        return msgpack.unpackb(footer, raw=False)
+
+    @property
+    def rows(self) -> int:
+        return self.footer['rows']
+
+    @property
+    def metadata(self) -> dict:
+        return self.footer.get('metadata', {})
+
+    def has_column(self, column: str) -> bool:
+        # Snapshots written before the digests were stored don't have their column
+        return all(column in block['columns'] for block in self.footer['blocks'])
+
+    def _read_block(self, block: dict, columns: List[str]) -> Dict[str, list]:
+        # The columns of a block are contiguous, so they are fetched with a single read
+        chunks = [block['columns'][column] for column in columns]
+        start = min(offset for offset, _ in chunks)
+        end = max(offset + length for offset, length in chunks)
+        data = self._read(start, end - start)
+        values = {}
+
+        for column, (offset, length) in zip(columns, chunks):
+            values[column] = _unpack(data[offset - start:offset - start + length])
+
+            if column in GEOMETRY_COLUMNS:
+                values[column] = _decode_objects(values[column], GEOMETRY_COLUMNS[column])
+
+        return values
+
+    def iter_rows(self, columns: Optional[List[str]] = None,
+                  offset: int = 0, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Reads the rows one block at a time, decoding only the given columns and the blocks in the range.
+        """
+        columns = columns or self.footer['columns']
+        end = self.rows if limit is None else min(offset + limit, self.rows)
+        block_index = bisect.bisect_right(self._block_ends, offset)
+
+        while offset < end:
+            block = self.footer['blocks'][block_index]
+            block_start = self._block_ends[block_index] - block['rows']
+            values = self._read_block(block, columns)
+
+            for i in range(offset - block_start, min(end - block_start, block['rows'])):
+                yield {column: values[column][i] for column in columns}
+
+            offset = self._block_ends[block_index]
+            block_index += 1
+
+    def get_rows(self, rows: Iterable[int],
+                 columns: Optional[List[str]] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Reads the given rows in ascending order, decoding only the given columns and the blocks that hold the rows.
+        """
+        columns = columns or self.footer['columns']
+
+        for row in sorted(rows):
+            block_index = bisect.bisect_right(self._block_ends, row)
+            block = self.footer['blocks'][block_index]
+
+            if self._last_block is None or self._last_block[:2] != (block_index, columns):
+                self._last_block = (block_index, columns, self._read_block(block, columns))
+
+            values = self._last_block[2]
+            i = row - (self._block_ends[block_index] - block['rows'])
+            yield row, {column: values[column][i] for column in columns}
+
+    def find(self, event_id: str) -> Optional[int]:
+        """
+        Returns the row of the event id, reading a single index page.
+        """
+        pages = self.footer.get('index')
+
+        if pages is None:
+            rows = (row['event_id'] for row in self.iter_rows(['event_id']))
+            return next((i for i, x in enumerate(rows) if x == event_id), None)
+
+        page_index = bisect.bisect_right([page[0] for page in pages], event_id) - 1
+
+        if page_index < 0:
+            return None
+
+        _, offset, length = pages[page_index]
+        page = _unpack(self._read(offset, length))
+        position = bisect.bisect_left(page, [event_id])
+
+        if position < len(page) and page[position][0] == event_id:
+            return page[position][1]
+
+        return None
+
+    def get(self, event_id: str, columns: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        row = self.find(event_id)
+        return None if row is None else next(self.iter_rows(columns, offset=row, limit=1))
+
+
+def write_snapshot(file: BinaryIO, annotations: Iterable[ImageAnnotationsData], block_size: int = 1000,
+                   metadata: Optional[dict] = None):
+    writer = SnapshotWriter(file, block_size, metadata=metadata)
+    writer.write(x.dict() for x in annotations)
+    writer.close()
+
+
+def iter_snapshot(file: BinaryIO, columns: Optional[List[str]] = None,
+                  offset: int = 0, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    return SnapshotReader(file).iter_rows(columns, offset, limit)
@@ -1,34 +1,286 @@
-from inspect import isclass, isroutine
-from functools import wraps
+from typing import Deque, Dict, List, Optional, Tuple
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from inspect import isasyncgenfunction, isclass, iscoroutinefunction, isroutine
+from functools import partial, wraps
+import logging
+import os
+import queue
+import random
+import threading
+import time
 
+from opencensus.trace import execution_context
+from opencensus.trace.base_exporter import Exporter
 from opencensus.trace.tracer import Tracer
 from opencensus.trace.logging_exporter import LoggingExporter
 from opencensus.trace.samplers import AlwaysOnSampler, ProbabilitySampler
+from prometheus_client import REGISTRY, Counter
 
 from app.config import Config, TracingSampler
 
-exporter = LoggingExporter()
-sampler = AlwaysOnSampler() if Config.TRACING_SAMPLER == TracingSampler.ALWAYS else ProbabilitySampler()
-tracer = Tracer(exporter=exporter, sampler=sampler)
+logger = logging.getLogger(__name__)
 
+spans_exported = Counter('tracing_spans_exported_total', 'Number of spans written by the tracing exporter')
+spans_dropped = Counter('tracing_spans_dropped_total', 'Number of spans dropped because the export queue was full')
+traces_discarded = Counter('tracing_traces_discarded_total', 'Number of recorded traces discarded by tail sampling')
+
+
+class BatchExporter(Exporter):
+    """
+    Hands spans over to a background thread, which writes them in batches. Exporting never blocks the caller,
+    spans are dropped when the queue is full.
+    """
+
+    def __init__(self, exporter: Exporter, queue_size: int, batch_size: int, interval: float):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def export(self, span_datas):
+        self._ensure_thread()
+
+        for span_data in span_datas:
+            try:
+                self._queue.put_nowait(span_data)
+            except queue.Full:
+                spans_dropped.inc()
+
+    def emit(self, span_datas):
+        self.exporter.emit(span_datas)
+
+    def _ensure_thread(self):
+        # Threads do not survive a fork, rq workers run every job in a forked process
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._thread = threading.Thread(target=self._run, name='tracing-exporter', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _get_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            traces: Dict[str, list] = {}
+
+            # The logging exporter writes every batch as a single trace
+            for span_data in batch:
+                traces.setdefault(span_data.context.trace_id, []).append(span_data)
+
+            for span_datas in traces.values():
+                try:
+                    self.emit(span_datas)
+                except Exception:
+                    logger.exception('Failed to export spans')
+
+            spans_exported.inc(len(batch))
+
+    def get_queue_size(self) -> int:
+        return self._queue.qsize()
+
+
+class _TraceBuffer(Exporter):
+    """
+    Collects the spans of a single trace until tail sampling decides whether to export them.
+    """
+
+    def __init__(self):
+        self.span_datas = []
+
+    def export(self, span_datas):
+        self.span_datas.extend(span_datas)
+
+
+exporter = BatchExporter(
+    LoggingExporter(),
+    queue_size=Config.TRACING_EXPORT_QUEUE_SIZE,
+    batch_size=Config.TRACING_EXPORT_BATCH_SIZE,
+    interval=Config.TRACING_EXPORT_INTERVAL,
+)
+
+# Most recent spans slower than TRACING_SLOW_SPAN_MS, recorded whether their trace is sampled or not
+slow_spans: Deque[dict] = deque(maxlen=Config.TRACING_SLOW_SPANS_BUFFER_SIZE)
+
+# Tracer of the trace being recorded in the current context. asyncio tasks copy the context when they are created,
+# so spans of concurrent tasks end up in the trace of the call that started them.
+_current_tracer: ContextVar[Optional[Tracer]] = ContextVar('current_tracer', default=None)
+
+
+def _create_tracer(sample_rate: Optional[float]) -> Tracer:
+    rate = Config.TRACING_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    if Config.TRACING_SAMPLER == TracingSampler.TAIL:
+        # Every span is recorded, the decision is made once the root span ends
+        return Tracer(exporter=_TraceBuffer(), sampler=AlwaysOnSampler())
+    if Config.TRACING_SAMPLER == TracingSampler.ALWAYS and sample_rate is None:
+        return Tracer(exporter=exporter, sampler=AlwaysOnSampler())
+
+    return Tracer(exporter=exporter, sampler=ProbabilitySampler(rate))
+
+
+def _finish_trace(tracer: Tracer, duration_ms: float, failed: bool, sample_rate: Optional[float]):
+    if not isinstance(tracer.exporter, _TraceBuffer):
+        return
+
+    rate = Config.TRACING_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    # Slow and failed traces are always kept, the rest are sampled
+    if failed or duration_ms >= Config.TRACING_SLOW_SPAN_MS or random.random() < rate:
+        exporter.export(tracer.exporter.span_datas)
+    else:
+        traces_discarded.inc()
+
+
+def _record_slow_span(name: str, tracer: Tracer, span, start_time: datetime, duration_ms: float, failed: bool):
+    slow_spans.append({
+        'name': name,
+        'trace_id': tracer.span_context.trace_id,
+        'span_id': span.span_id,
+        'start_time': start_time,
+        'duration_ms': duration_ms,
+        'failed': failed,
+    })
+
+
+def get_slow_spans(limit: Optional[int] = None, min_duration_ms: float = 0) -> List[dict]:
+    """
+    Returns the recorded slow spans, most recent first.
+    """
+    spans = [x for x in reversed(slow_spans) if x['duration_ms'] >= min_duration_ms]
+    return spans[:limit]
+
+
+def get_exporter_stats() -> dict:
+    return {
+        'sampler': Config.TRACING_SAMPLER.value,
+        'queued_spans': exporter.get_queue_size(),
+        'exported_spans': int(REGISTRY.get_sample_value('tracing_spans_exported_total')),
+        'dropped_spans': int(REGISTRY.get_sample_value('tracing_spans_dropped_total')),
+        'discarded_traces': int(REGISTRY.get_sample_value('tracing_traces_discarded_total')),
+    }
+
+
+@contextmanager
+def _span(name: str, sample_rate: Optional[float] = None):
+    parent_tracer = _current_tracer.get()
+    # Nested calls join the trace of their caller, whose sampling decision applies to the whole trace
+    tracer = parent_tracer or _create_tracer(sample_rate)
+    _current_tracer.set(tracer)
+    start_time = datetime.utcnow()
+    start = time.perf_counter()
+    duration_ms = 0.0
+    failed = False
+
+    try:
+        with tracer.span(name) as span:
+            try:
+                yield
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                duration_ms = (time.perf_counter() - start) * 1000
+
+                if duration_ms >= Config.TRACING_SLOW_SPAN_MS:
+                    _record_slow_span(name, tracer, span, start_time, duration_ms, failed)
+    finally:
+        # Not reset with a token, async generators can be resumed from a different context
+        _current_tracer.set(parent_tracer)
+
+        if parent_tracer is None:
+            _finish_trace(tracer, duration_ms, failed, sample_rate)
+
+
+def _swap_trace_context(context: Tuple[Optional[Tracer], object]) -> Tuple[Optional[Tracer], object]:
+    """
+    Makes the tracer and the span of the context the current ones, and returns the ones it replaces.
+    """
+    previous = _current_tracer.get(), execution_context.get_current_span()
+    _current_tracer.set(context[0])
+    execution_context.set_current_span(context[1])
+    return previous
+
+
+def _traced(func, prefix='', sample_rate: Optional[float] = None):
+    name = f'{prefix}.{func.__name__}'
+
+    # Coroutines and async generators keep the span open until they finish running, not until they are created
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with _span(name, sample_rate):
+                return await func(*args, **kwargs)
+    elif isasyncgenfunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            # The generator runs in the context of its consumer, so the consumer gets its own tracer and span back
+            # while the generator is suspended, otherwise its code between items would be traced as the generator
+            consumer = _current_tracer.get(), execution_context.get_current_span()
+
+            try:
+                with _span(name, sample_rate):
+                    generator = func(*args, **kwargs)
+
+                    try:
+                        async for item in generator:
+                            own = _swap_trace_context(consumer)
+
+                            try:
+                                yield item
+                            finally:
+                                consumer = _swap_trace_context(own)
+                    finally:
+                        await generator.aclose()
+            finally:
+                _swap_trace_context(consumer)
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _span(name, sample_rate):
+                return func(*args, **kwargs)
 
-def _traced(func, prefix=''):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        with tracer.span(f'{prefix}.{func.__name__}'):
-            return func(*args, **kwargs)
     return wrapper
 
 
-def traced(*args):
+def traced(*args, sample_rate: Optional[float] = None):
+    """
+    Records a span for every call of the function, or of every method of the class.
+    sample_rate overrides the configured sampler for the traces started by the decorated class or function.
+    """
     obj = args[0] if args else None
 
     if obj is None:
-        return traced
+        return partial(traced, sample_rate=sample_rate)
     if isclass(obj):
-        return _install_traceable_methods(obj)
+        return _install_traceable_methods(obj, sample_rate)
     elif isroutine(obj):
-        return _traced(obj)
+        return _traced(obj, sample_rate=sample_rate)
 
 
 def _is_special_name(name):
@@ -45,19 +297,20 @@ def _get_default_traceable_method_names(class_):
     return default_traceable_method_names
 
 
-def _install_traceable_methods(class_,):
+def _install_traceable_methods(class_, sample_rate: Optional[float] = None):
     traceable_method_names = _get_default_traceable_method_names(class_)
 
     for method_name in traceable_method_names:
         descriptor = class_.__dict__[method_name]
         descriptor_type = type(descriptor)
+        kwargs = {'prefix': class_.__name__, 'sample_rate': sample_rate}
 
         if descriptor_type is classmethod:
-            tracing_proxy_descriptor = _make_traceable_classmethod(descriptor, prefix=class_.__name__)
+            tracing_proxy_descriptor = _make_traceable_classmethod(descriptor, **kwargs)
         elif descriptor_type is staticmethod:
-            tracing_proxy_descriptor = _make_traceable_staticmethod(descriptor, prefix=class_.__name__)
+            tracing_proxy_descriptor = _make_traceable_staticmethod(descriptor, **kwargs)
         else:
-            tracing_proxy_descriptor = _traced(descriptor, class_.__name__)
+            tracing_proxy_descriptor = _traced(descriptor, **kwargs)
 
         setattr(class_, method_name, tracing_proxy_descriptor)
 
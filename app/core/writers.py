@@ -0,0 +1,176 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from pathlib import Path
+from xml.sax.saxutils import escape
+import os
+import shutil
+import tempfile
+
+import orjson
+
+from app.core.exporters import DatasetExportFormat, get_image_filename, get_label_index, get_pixel_scale, to_pixels
+
+Row = Dict[str, Any]
+
+
+def _get_item_id(row: Row) -> str:
+    return Path(row['event_id']).stem
+
+
+def _get_pixel_box(box: List[float], width: int, height: int) -> List[float]:
+    return [box[0] * width, box[1] * height, box[2] * width, box[3] * height]
+
+
+def _get_polygon_area(points: List[float]) -> float:
+    xs, ys = points[0::2], points[1::2]
+    return abs(sum(xs[i - 1] * ys[i] - xs[i] * ys[i - 1] for i in range(len(xs)))) / 2
+
+
+def _move_image(row: Row, images_dir: Optional[str], destination_dir: str, filename: Optional[str] = None):
+    """
+    Moves the downloaded image of the row into the export, the downloaded copy is not needed afterwards.
+    """
+    if not images_dir or not row.get('has_image'):
+        return
+
+    source = f'{images_dir}/{get_image_filename(row["event_id"])}'
+
+    if os.path.exists(source):
+        os.makedirs(destination_dir, exist_ok=True)
+        os.replace(source, f'{destination_dir}/{filename or get_image_filename(row["event_id"])}')
+
+
+def write_coco_instances(rows: Iterable[Row], labels: List[str], save_dir: str, images_dir: Optional[str] = None):
+    """
+    Writes the detections and polygons of the rows in the COCO instances format. The json is written incrementally,
+    buffering the annotations array in a temporary file while the images array is written.
+    """
+    labels_index = {label: i + 1 for i, label in enumerate(labels)}
+    os.makedirs(f'{save_dir}/annotations', exist_ok=True)
+    annotation_id = 0
+
+    with open(f'{save_dir}/annotations/instances_default.json', 'wb') as file, \
+            tempfile.TemporaryFile(dir=save_dir) as annotations_file:
+        file.write(b'{"licenses":[{"name":"","id":0,"url":""}],'
+                   b'"info":{"contributor":"","date_created":"","description":"","url":"","version":"","year":""},'
+                   b'"categories":')
+        file.write(orjson.dumps([{'id': i, 'name': label, 'supercategory': ''} for label, i in labels_index.items()]))
+        file.write(b',"images":[')
+
+        for image_id, row in enumerate(rows, 1):
+            width, height = get_pixel_scale(row.get('image_width'), row.get('image_height'))
+            file.write(b',' if image_id > 1 else b'')
+            file.write(orjson.dumps({
+                'id': image_id,
+                'width': row.get('image_width') or 0,
+                'height': row.get('image_height') or 0,
+                'file_name': get_image_filename(row['event_id']),
+                'license': 0,
+                'flickr_url': '',
+                'coco_url': '',
+                'date_captured': 0,
+            }))
+
+            instances = [(x, _get_pixel_box(x['box'], width, height), None) for x in row.get('detections') or []]
+
+            for polygon in row.get('polygons') or []:
+                points = to_pixels(polygon['points'], width, height)
+                xs, ys = points[0::2], points[1::2]
+                instances.append((polygon, [min(xs), min(ys), max(xs), max(ys)], points))
+
+            for instance, (x0, y0, x1, y1), points in instances:
+                annotation_id += 1
+                annotations_file.write(b',' if annotation_id > 1 else b'')
+                annotations_file.write(orjson.dumps({
+                    'id': annotation_id,
+                    'image_id': image_id,
+                    'category_id': get_label_index(labels_index, instance['label'], row['event_id']),
+                    'segmentation': [points] if points else [],
+                    'area': _get_polygon_area(points) if points else (x1 - x0) * (y1 - y0),
+                    'bbox': [x0, y0, x1 - x0, y1 - y0],
+                    'iscrowd': 0,
+                    'attributes': instance.get('attributes') or {},
+                }))
+
+            _move_image(row, images_dir, f'{save_dir}/images')
+
+        file.write(b'],"annotations":[')
+        annotations_file.seek(0)
+        shutil.copyfileobj(annotations_file, file)
+        file.write(b']}')
+
+
+_VOC_OBJECT_TEMPLATE = \
+    '<object><name>{label}</name><pose>Unspecified</pose><truncated>0</truncated><difficult>0</difficult>' \
+    '<bndbox><xmin>{:.2f}</xmin><ymin>{:.2f}</ymin><xmax>{:.2f}</xmax><ymax>{:.2f}</ymax></bndbox></object>'
+
+_VOC_ANNOTATION_TEMPLATE = \
+    '<annotation><folder>VOC</folder><filename>{filename}</filename>' \
+    '<size><width>{width}</width><height>{height}</height><depth>3</depth></size>' \
+    '<segmented>0</segmented>{objects}</annotation>\n'
+
+
+def write_voc_detection(rows: Iterable[Row], labels: List[str], save_dir: str, images_dir: Optional[str] = None):
+    """
+    Writes the detections of the rows in the Pascal VOC detection format, one xml file per image.
+    """
+    os.makedirs(f'{save_dir}/Annotations', exist_ok=True)
+    os.makedirs(f'{save_dir}/ImageSets/Main', exist_ok=True)
+
+    with open(f'{save_dir}/labelmap.txt', 'w') as file:
+        file.write('# label:color_rgb:parts:actions\n')
+        file.writelines(f'{label}:::\n' for label in labels)
+
+    with open(f'{save_dir}/ImageSets/Main/default.txt', 'w') as subset_file:
+        for row in rows:
+            item_id = _get_item_id(row)
+            width, height = get_pixel_scale(row.get('image_width'), row.get('image_height'))
+            objects = ''.join(
+                _VOC_OBJECT_TEMPLATE.format(*_get_pixel_box(x['box'], width, height), label=escape(x['label']))
+                for x in row.get('detections') or [])
+
+            with open(f'{save_dir}/Annotations/{item_id}.xml', 'w') as file:
+                file.write(_VOC_ANNOTATION_TEMPLATE.format(
+                    filename=escape(get_image_filename(row['event_id'])), width=row.get('image_width') or 0,
+                    height=row.get('image_height') or 0, objects=objects))
+
+            subset_file.write(f'{item_id}\n')
+            _move_image(row, images_dir, f'{save_dir}/JPEGImages')
+
+
+def write_yolo(rows: Iterable[Row], labels: List[str], save_dir: str, images_dir: Optional[str] = None):
+    """
+    Writes the detections of the rows in the darknet YOLO format, with one text file per image holding
+    the class and the relative center and size of every box.
+    """
+    labels_index = {label: i for i, label in enumerate(labels)}
+    os.makedirs(f'{save_dir}/obj_train_data', exist_ok=True)
+
+    with open(f'{save_dir}/obj.names', 'w') as file:
+        file.writelines(f'{label}\n' for label in labels)
+
+    with open(f'{save_dir}/obj.data', 'w') as file:
+        file.write(f'classes = {len(labels)}\ntrain = data/train.txt\nnames = data/obj.names\nbackup = backup/\n')
+
+    with open(f'{save_dir}/train.txt', 'w') as subset_file:
+        for row in rows:
+            item_id = _get_item_id(row)
+
+            with open(f'{save_dir}/obj_train_data/{item_id}.txt', 'w') as file:
+                for detection in row.get('detections') or []:
+                    x0, y0, x1, y1 = detection['box']
+                    label_index = get_label_index(labels_index, detection['label'], row['event_id'])
+                    file.write(f'{label_index} '
+                               f'{(x0 + x1) / 2:.6f} {(y0 + y1) / 2:.6f} {x1 - x0:.6f} {y1 - y0:.6f}\n')
+
+            if row.get('has_image'):
+                filename = item_id + Path(get_image_filename(row['event_id'])).suffix
+                subset_file.write(f'data/obj_train_data/{filename}\n')
+                _move_image(row, images_dir, f'{save_dir}/obj_train_data', filename)
+
+
+# Formats written straight from the snapshot rows, the rest go through datumaro converters
+NATIVE_WRITERS: Dict[DatasetExportFormat, Callable[[Iterable[Row], List[str], str, Optional[str]], None]] = {
+    DatasetExportFormat.COCO_INSTANCES: write_coco_instances,
+    DatasetExportFormat.VOC_DETECTION: write_voc_detection,
+    DatasetExportFormat.YOLO: write_yolo,
+}
@@ -1,16 +1,18 @@
 from __future__ import annotations
 from typing import Optional, Dict, Any, Tuple, Union, List
 import enum
+import random
 from collections import defaultdict
 from datetime import datetime
 
-from odmantic import Model, ObjectId, EmbeddedModel, AIOEngine
+from odmantic import Model, ObjectId, EmbeddedModel, AIOEngine, Field
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo import DESCENDING
 from pydantic import validator, BaseModel
 
 from app.utils import json_loads, json_dumps
 from app.config import Config
+from app.core.monitoring import command_monitor
 
 
 def check_relative_points(values: List[float]):
@@ -20,6 +22,18 @@ def check_relative_points(values: List[float]):
     return values
 
 
+# Id of the import batch that last wrote a document, a retried batch skips what it already wrote
+IMPORT_BATCH_FIELD = '_import_batch'
+# Labels summary of a document before the import batch wrote it, so a retried batch can still count it in the stats
+IMPORT_PREVIOUS_LABELS_FIELD = '_import_previous_labels'
+# Incremented by every bulk write of a document, which only applies if the document is at the version it read
+VERSION_FIELD = '_version'
+
+
+def generate_random_key(value: Optional[float]):
+    return random.random() if value is None else value
+
+
 class ModelConfig:
     json_loads = json_loads
     json_dumps = json_dumps
@@ -99,6 +113,10 @@ class ImageAnnotations(Model):
     captions: List[Caption] = []
     attributes: Dict[str, Any] = {}
     labels: List[Label] = []
+    # Uniform random key used by the random sampling stages, persisted so samples are reproducible for a seed
+    rand: float = Field(None, key_name='_rand')
+
+    _generate_rand = validator('rand', pre=True, always=True, allow_reuse=True)(generate_random_key)
 
     @staticmethod
     def _extract_labels(objects: List[Prediction], shape: Shape, labels: set, attributes):
@@ -107,6 +125,22 @@ class ImageAnnotations(Model):
             attributes[key].update(obj.attributes.keys())
             labels.add(key)
 
+    @staticmethod
+    def _count_labels(objects: List[Prediction], shape: Shape, counts: Dict[Tuple[str, Shape], int]):
+        for obj in objects:
+            counts[(obj.label, shape)] += 1
+
+    def get_label_counts(self) -> Dict[Tuple[str, Shape], int]:
+        counts = defaultdict(int)
+
+        ImageAnnotations._count_labels(self.points, Shape.POINT, counts)
+        ImageAnnotations._count_labels(self.detections, Shape.BOX, counts)
+        ImageAnnotations._count_labels(self.polygons, Shape.POLYGON, counts)
+        ImageAnnotations._count_labels(self.polylines, Shape.POLYLINE, counts)
+        ImageAnnotations._count_labels(self.tags, Shape.TAG, counts)
+
+        return counts
+
     def get_labels(self):
         labels = set()
         attributes = defaultdict(set)
@@ -134,6 +168,12 @@ class Dataset(Model):
     parent_id: Optional[ObjectId] = None
     child_id: Optional[ObjectId] = None
     created_at: datetime
+    # Labels of the snapshot annotations, missing for datasets created before they were stored
+    labels: Optional[List[Label]] = None
+    # Format of the snapshot file, datasets created before it was versioned use legacy json snapshots
+    snapshot_version: int = 1
+    # Number of delta snapshots between this version and the last one with a full snapshot
+    snapshot_depth: int = 0
 
     Config = ModelConfig
 
@@ -173,6 +213,18 @@ class Project(Model):
     Config = ModelConfig
 
 
+class ProjectLabelStats(Model):
+    project_id: ObjectId
+    name: str
+    shape: Shape
+    object_count: int = 0
+    image_count: int = 0
+    attributes: List[str] = []
+
+    class Config(ModelConfig):
+        collection = 'project_label_stats'
+
+
 class Image(Model):
     project_id: ObjectId
     event_id: str
@@ -267,7 +319,7 @@ async def get_engine() -> AIOEngine:
 async def initialize():
     global client
     global engine
-    client = AsyncIOMotorClient(Config.MONGO_HOST)
+    client = AsyncIOMotorClient(Config.MONGO_HOST, event_listeners=[command_monitor])
     engine = AIOEngine(motor_client=client, database=Config.MONGO_DATABASE)
 
     await engine.get_collection(Project).create_index('user_id')
@@ -281,8 +333,23 @@ async def initialize():
         ('has_image', DESCENDING),
         ('event_id', DESCENDING),
     ])
+    # A bulk write of a document that changed since it was read upserts a second document, which breaks this index
+    await engine.get_collection(ImageAnnotations).create_index([
+        ('project_id', DESCENDING),
+        ('event_id', DESCENDING),
+    ], unique=True)
+    # Seeded random samples seek the persisted random key within the project
+    await engine.get_collection(ImageAnnotations).create_index([
+        ('project_id', DESCENDING),
+        ('_rand', DESCENDING),
+    ])
     await engine.get_collection(ImageAnnotations).create_index('attributes.$**')
     await engine.get_collection(ImageAnnotations).create_index('labels.$**')
+    await engine.get_collection(ProjectLabelStats).create_index([
+        ('project_id', DESCENDING),
+        ('shape', DESCENDING),
+        ('name', DESCENDING),
+    ], unique=True)
     await engine.get_collection(Image).create_index([
         ('project_id', DESCENDING),
         ('event_id', DESCENDING)
@@ -139,9 +139,16 @@ class SortDirection(str, Enum):
     DESCENDING = 'descending'
 
 
+class PaginationMode(str, Enum):
+    OFFSET = 'offset'
+    KEYSET = 'keyset'
+
+
 class Pagination(BaseModel):
     page: Optional[int]
     total: Optional[int]
+    estimated: Optional[bool] = None
+    next_token: Optional[str] = None
 
 
 class AnnotationsQueryResult(SchemaBase):
@@ -150,6 +157,35 @@ class AnnotationsQueryResult(SchemaBase):
     pipeline_id: Optional[str] = None
 
 
+class AnnotationsCount(SchemaBase):
+    total: int
+    estimated: bool = False
+
+
+class AnnotationsImportStatus(SchemaBase):
+    job_id: str
+    status: str
+    items_done: int = 0
+    items_failed: int = 0
+    items_per_second: float = 0
+    error: Optional[str] = None
+    errors: List[str] = []
+
+
+class AnnotationsStreamError(SchemaBase):
+    line: int
+    detail: str
+
+
+class AnnotationsStreamResult(SchemaBase):
+    lines: int
+    written: int
+    failed: int
+    errors: List[AnnotationsStreamError]
+    elapsed_time: float
+    annotations_per_second: float
+
+
 class ApiKey(SchemaBase):
     key: str
     scopes: List[str]
@@ -195,6 +231,12 @@ class JobId(SchemaBase):
     job_id: str
 
 
+class DatasetDiff(SchemaBase):
+    added: List[str]
+    removed: List[str]
+    changed: List[str]
+
+
 class PostPutRevisionComment(SchemaBase):
     content: str
 
@@ -231,3 +273,33 @@ class RevisionQueryResult(SchemaBase):
 class RevisionChangesQueryResult(SchemaBase):
     data: List[RevisionChange]
     pagination: Pagination
+
+
+class SlowSpan(SchemaBase):
+    name: str
+    trace_id: str
+    span_id: str
+    start_time: datetime
+    duration_ms: float
+    failed: bool
+
+
+class TracingStats(SchemaBase):
+    sampler: str
+    queued_spans: int
+    exported_spans: int
+    dropped_spans: int
+    discarded_traces: int
+
+
+class SlowQuery(SchemaBase):
+    command: str
+    collection: str
+    time: datetime
+    duration_ms: float
+    documents_returned: Optional[int]
+    fingerprint: Optional[str]
+    pipeline: Optional[List[Dict[str, Any]]]
+    comment: Optional[str]
+    origin: Optional[List[Dict[str, Any]]]
+    failure: Optional[str]
@@ -8,7 +8,7 @@ from jose import JWTError, jwt
 from starlette import status
 
 from app.config import Config
-from app.models import User, get_engine, Project, ObjectId, FastToken
+from app.models import User, get_engine, Project, ObjectId, FastToken, UserRoleType
 
 API_KEY_NAME = 'X-API-Key'
 API_KEY_HEADER = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
@@ -91,6 +91,16 @@ async def get_current_user(token: str = Depends(OAUTH2_SCHEME_OPTIONAL),
     return user
 
 
+async def get_admin_user(user: User = Depends(get_current_user)):
+    if user.role != UserRoleType.ADMIN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Admin role required',
+        )
+
+    return user
+
+
 def create_fast_jwt_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
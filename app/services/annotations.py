@@ -1,22 +1,106 @@
-from typing import List, Optional, Union
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple, Union
 from enum import Enum
-
-from fastapi import HTTPException
+import logging
+import tempfile
+import time
+import uuid
+import zlib
+
+import orjson
+import s3fs
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from odmantic import ObjectId
-from pymongo import ASCENDING, DESCENDING
-
-from app.schema import ImageAnnotationsPostSchema, AnnotationsQueryResult,\
-    PredictionPostData, CaptionPostData, ImageAnnotationsPatchSchema, ImageAnnotationsPutSchema
-from app.models import ImageAnnotations, Project, get_engine, Image, Prediction, Caption
-from app.core.importers import DatasetImportFormat, import_dataset
-from app.core.query_engine.stages import STAGES, QueryStage, make_paginated_pipeline
+from pydantic import ValidationError
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from rq import Retry, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from app.schema import ImageAnnotationsPostSchema, AnnotationsQueryResult, PaginationMode, Pagination,\
+    AnnotationsCount, AnnotationsStreamResult, AnnotationsStreamError, AnnotationsImportStatus, PredictionPostData,\
+    CaptionPostData, ImageAnnotationsPatchSchema, ImageAnnotationsPutSchema
+from app.models import ImageAnnotations, Project, get_engine, initialize, Image, Prediction, Caption, Label, \
+    IMPORT_BATCH_FIELD, IMPORT_PREVIOUS_LABELS_FIELD, VERSION_FIELD
+from app.core.importers import DatasetImportFormat, iter_dataset_annotations
+from app.core.query_engine.stages import STAGES, QueryStage, make_paginated_pipeline, \
+    make_keyset_paginated_pipeline, encode_continuation_token, pop_keyset_values, make_count_pipeline, \
+    make_estimated_count_pipeline, is_estimable_pipeline, scope_pipeline
+from app.core.query_engine.compiler import compile_pipeline, get_pipeline_hash
+from app.core.labels import LabelsSummary, get_labels_summary, get_document_labels_summary, get_summary_labels, \
+    get_label_stats_deltas, encode_labels_summary, decode_labels_summary
+from app.core.cache import get_annotations_generation, get_cached_count, set_cached_count, \
+    invalidate_annotations
+from app.core.queue import redis, imports_queue
+from app.config import Config
 from app.services.projects import ProjectService
 from app.services.storage import StorageService
 from app.core.tracing import traced
+from app.core.monitoring import query_origin, get_aggregate_options
+
+
+s3_fs = s3fs.S3FileSystem()
+logger = logging.getLogger(__name__)
+
+_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+_OBJECT_FIELDS = [
+    +ImageAnnotations.detections,
+    +ImageAnnotations.polygons,
+    +ImageAnnotations.points,
+    +ImageAnnotations.tags,
+    +ImageAnnotations.polylines,
+    +ImageAnnotations.captions,
+]
+
+_LABEL_KEYS = ['label', 'group', 'attributes']
+
+# Times the documents changed by concurrent writes are read and written again before giving up
+_BULK_WRITE_ATTEMPTS = 5
+
+
+def _add_group_to_annotations(annotations: List[Union[PredictionPostData, CaptionPostData, dict]], group: str):
+    return [{**(x if isinstance(x, dict) else x.dict()), 'group': group} for x in annotations]
+
+
+def _merge_objects(previous: List[dict], new: List[dict], replace: bool, group: str) -> List[dict]:
+    if replace:
+        previous = [x for x in previous if x.get('group') != group]
+    return previous + new
+
 
+def _make_annotations_update(new_objects: Dict[str, List[dict]], replace: bool, group: str,
+                             has_image: bool, labels: List[Label], import_batch: Optional[str] = None,
+                             previous_labels: Optional[LabelsSummary] = None) -> List[dict]:
+    """
+    Returns the update pipeline that adds the new objects to an annotations document, removing first
+    the objects of the group when replacing. It also initializes the document when it is upserted,
+    and increments its version.
+    """
+    values = {}
 
-def _add_group_to_annotations(annotations: List[Union[PredictionPostData, CaptionPostData]], group: str):
-    return [{**x.dict(), 'group': group} for x in annotations]
+    for field, objects in new_objects.items():
+        previous = {'$ifNull': [f'${field}', []]}
+
+        if replace:
+            previous = {'$filter': {'input': previous, 'cond': {'$ne': ['$$this.group', group]}}}
+
+        values[field] = {'$concatArrays': [previous, {'$literal': objects}]}
+
+    values[+ImageAnnotations.has_image] = has_image
+    values[+ImageAnnotations.labels] = {'$literal': [
+        {'name': label.name, 'shape': label.shape.value, 'attributes': label.attributes} for label in labels
+    ]}
+    values[+ImageAnnotations.attributes] = {'$ifNull': [f'${+ImageAnnotations.attributes}', {'$literal': {}}]}
+    values[+ImageAnnotations.rand] = {'$ifNull': [f'${+ImageAnnotations.rand}', {'$rand': {}}]}
+    values[VERSION_FIELD] = {'$add': [{'$ifNull': [f'${VERSION_FIELD}', 0]}, 1]}
+
+    if import_batch:
+        values[IMPORT_BATCH_FIELD] = {'$literal': import_batch}
+        values[IMPORT_PREVIOUS_LABELS_FIELD] = {'$literal': encode_labels_summary(previous_labels or {})}
+
+    return [{'$set': values}]
 
 
 def _replace_annotations(previous: List[Union[Prediction, Caption]],
@@ -25,6 +109,132 @@ def _replace_annotations(previous: List[Union[Prediction, Caption]],
     return [x for x in previous if x.group != group] + new_annotations
 
 
+def _decompress_members(decompressor, data: bytes):
+    """
+    Decompresses the data of a gzip stream, which may be made of several concatenated members.
+    Returns the decompressed bytes and the decompressor for the rest of the stream.
+    """
+    output = decompressor.decompress(data)
+
+    # A new member starts after the end of the previous one
+    while decompressor.eof and decompressor.unused_data:
+        data = decompressor.unused_data
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output += decompressor.decompress(data)
+
+    return output, decompressor
+
+
+async def _iter_lines(chunks: AsyncIterator[bytes], compressed: bool) -> AsyncIterator[bytes]:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+    buffer = b''
+
+    async for chunk in chunks:
+        if decompressor:
+            data, decompressor = _decompress_members(decompressor, chunk)
+            buffer += data
+        else:
+            buffer += chunk
+
+        *lines, buffer = buffer.split(b'\n')
+
+        for line in lines:
+            yield line
+
+    if decompressor:
+        buffer += decompressor.flush()
+
+    if buffer:
+        for line in buffer.split(b'\n'):
+            yield line
+
+
+def _get_import_file_key(project_id: ObjectId, filename: str) -> str:
+    return f'{Config.DATASET_ARTIFACTS_BUCKET}/' \
+           f'{Config.DATASET_IMPORT_FOLDER}/' \
+           f'{project_id}/{uuid.uuid4().hex}/{filename}'
+
+
+async def _import_annotations_file(key: str, annotations_format: DatasetImportFormat,
+                                   replace: bool, group: str, project_id: ObjectId):
+    """
+    Imports the annotations file in batches. The number of processed items is saved in the job
+    meta after every batch, so a retried job resumes from the last written batch. Batches are
+    identified by the job and their first item, so writing again a batch interrupted before its
+    checkpoint doesn't count its labels twice.
+    Items with invalid annotations are skipped and their errors are reported in the job meta
+    with the checkpoint of their batch, so a retried job doesn't report them twice.
+    """
+    await initialize()
+    job = get_current_job()
+    items_done = items_seen = start = job.meta.get('items_done', 0)
+    job.meta.setdefault('items_failed', 0)
+    job.meta.setdefault('errors', [])
+    # Failures of the items after the checkpoint, rq saves the job meta again when it retries the job
+    batch_failed = 0
+    batch_errors = []
+    start_time = time.perf_counter()
+
+    def save_progress():
+        nonlocal batch_failed, batch_errors
+        elapsed_time = time.perf_counter() - start_time
+        job.meta['items_done'] = items_done
+        job.meta['items_failed'] += batch_failed
+        job.meta['errors'].extend(batch_errors)
+        job.meta['items_per_second'] = (items_done - start) / elapsed_time if elapsed_time else 0
+        job.save_meta()
+        batch_failed = 0
+        batch_errors = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = f'{temp_dir}/{key.split("/")[-1]}'
+        s3_fs.get(key, file_path)
+        batch = []
+
+        annotations = iter_dataset_annotations(
+            file_path, annotations_format, start, workers=Config.IMPORT_WORKERS, chunk_size=Config.IMPORT_CHUNK_SIZE)
+
+        for annotation, errors in annotations:
+            items_seen += 1
+
+            if errors:
+                batch_failed += 1
+                remaining_errors = max(
+                    Config.IMPORT_MAX_REPORTED_ERRORS - len(job.meta['errors']) - len(batch_errors), 0)
+                batch_errors.extend(errors[:remaining_errors])
+            else:
+                # Documents built by the importer are already normalized and validated
+                batch.append(ImageAnnotationsPostSchema.construct(**annotation))
+
+            if len(batch) >= Config.IMPORT_BATCH_SIZE:
+                await AnnotationsService.add_annotations_bulk(
+                    batch, replace, group, project_id, import_batch=f'{job.id}:{items_done}')
+                items_done = items_seen
+                batch = []
+                save_progress()
+
+        if batch:
+            await AnnotationsService.add_annotations_bulk(
+                batch, replace, group, project_id, import_batch=f'{job.id}:{items_done}')
+
+        items_done = items_seen
+        save_progress()
+
+    s3_fs.rm(key)
+    return items_done
+
+
+def _on_import_failure(job: Job, *_):
+    # The callback runs after every failed attempt, the file is kept for the retries
+    if job.retries_left:
+        return
+
+    try:
+        s3_fs.rm(job.kwargs['key'])
+    except FileNotFoundError:
+        pass
+
+
 class AnnotationSortField(str, Enum):
     IMAGE_NAME = 'event_id'
     # CREATED_TIME = 'created_time'
@@ -50,41 +260,141 @@ class AnnotationsService:
 
         return annotations
 
+    @staticmethod
+    async def _add_image_data(items: List[dict], project_id: ObjectId):
+        items = [item for item in items if item['image']]
+        thumbnail_urls, image_urls = await StorageService.create_presigned_get_urls_for_images(
+            [item['event_id'] for item in items], project_id)
+
+        for item, thumbnail_url, image_url in zip(items, thumbnail_urls, image_urls):
+            image = item['image'][0]
+            item['thumbnail_url'] = thumbnail_url
+            item['image_url'] = image_url
+            item['image_width'] = image['width']
+            item['image_height'] = image['height']
+            item['has_image'] = True
+
+    @staticmethod
+    async def count_raw_annotations_pipeline(pipeline: List[dict],
+                                             project_id: ObjectId,
+                                             estimate: bool = False) -> AnnotationsCount:
+        estimate = estimate and bool(pipeline) and is_estimable_pipeline(pipeline)
+        pipeline_hash = get_pipeline_hash([{'$match': {'project_id': project_id}}] + pipeline)
+        # The redis client is synchronous, so it is kept off the event loop
+        generation = await run_in_threadpool(get_annotations_generation, project_id)
+        # An exact count answers estimated counts too, small projects are always counted exactly
+        total = await run_in_threadpool(get_cached_count, project_id, generation, pipeline_hash, False)
+
+        if total is not None:
+            return AnnotationsCount(total=total, estimated=False)
+
+        if estimate:
+            total = await run_in_threadpool(get_cached_count, project_id, generation, pipeline_hash, True)
+
+            if total is not None:
+                return AnnotationsCount(total=total, estimated=True)
+
+        engine = await get_engine()
+        collection = engine.get_collection(ImageAnnotations)
+        # Exact count of the whole project, cached like any other count
+        project_size = (await AnnotationsService.count_raw_annotations_pipeline([], project_id)).total \
+            if estimate else 0
+        estimated = project_size > Config.COUNT_ESTIMATE_SAMPLE_SIZE
+
+        if estimated:
+            count_pipeline = make_estimated_count_pipeline(
+                {'project_id': project_id}, pipeline, Config.COUNT_ESTIMATE_SAMPLE_SIZE)
+        else:
+            count_pipeline = make_count_pipeline(scope_pipeline({'project_id': project_id}, pipeline))
+
+        result = await collection.aggregate(count_pipeline, **get_aggregate_options()).to_list(length=None)
+        total = result[0]['total'] if result else 0
+
+        if estimated:
+            total = round(total * project_size / Config.COUNT_ESTIMATE_SAMPLE_SIZE)
+
+        await run_in_threadpool(set_cached_count, project_id, generation, pipeline_hash, estimated, total)
+        return AnnotationsCount(total=total, estimated=estimated)
+
     @staticmethod
     async def run_raw_annotations_pipeline(pipeline: List[dict],
                                            page_size: Optional[int],
                                            page: Optional[int],
-                                           project_id: ObjectId) -> AnnotationsQueryResult:
-        pipeline = [{'$match': {'project_id': project_id}}] + pipeline
-        pipeline = make_paginated_pipeline(pipeline, page_size, page)
+                                           project_id: ObjectId,
+                                           include_total: bool = True,
+                                           estimate: bool = False) -> AnnotationsQueryResult:
+        data_pipeline = scope_pipeline({'project_id': project_id}, pipeline)
+
+        try:
+            data_pipeline = make_paginated_pipeline(data_pipeline, page_size, page)
+        except ValueError as error:
+            raise HTTPException(400, detail=str(error))
         engine = await get_engine()
         collection = engine.get_collection(ImageAnnotations)
-        result, *_ = await collection.aggregate(pipeline).to_list(length=None)
+        data = await collection.aggregate(data_pipeline, **get_aggregate_options()).to_list(length=None)
 
-        for item in result['data']:
-            image = item['image'] and item['image'][0]
+        await AnnotationsService._add_image_data(data, project_id)
 
-            if image:
-                item['thumbnail_url'] = await StorageService.create_presigned_get_url_for_thumbnail(
-                    item['event_id'], project_id)
-                item['image_url'] = await StorageService.create_presigned_get_url_for_image(
-                    item['event_id'], project_id)
-                item['image_width'] = image['width']
-                item['image_height'] = image['height']
-                item['has_image'] = True
+        pagination = Pagination(page=page)
 
-        pagination = result['metadata'][0] if result['metadata'] else {'page': 0, 'total': 0}
-        data = result['data']
+        if include_total:
+            count = await AnnotationsService.count_raw_annotations_pipeline(pipeline, project_id, estimate)
+            pagination.total, pagination.estimated = count.total, count.estimated
 
         return AnnotationsQueryResult(data=data, pagination=pagination)
 
     @staticmethod
-    async def get_annotations(page_size: int,
-                              page: int,
-                              only_with_images: bool,
-                              sort_field: AnnotationSortField,
-                              sort_direction: AnnotationSortDirection,
-                              project: Project) -> AnnotationsQueryResult:
+    async def run_keyset_annotations_pipeline(pipeline: List[dict],
+                                              page_size: int,
+                                              continuation_token: Optional[str],
+                                              project_id: ObjectId,
+                                              include_total: bool = True,
+                                              estimate: bool = False) -> AnnotationsQueryResult:
+        data_pipeline = scope_pipeline({'project_id': project_id}, pipeline)
+
+        try:
+            data_pipeline, keys = make_keyset_paginated_pipeline(data_pipeline, page_size, continuation_token)
+        except ValueError as error:
+            raise HTTPException(400, detail=str(error))
+
+        engine = await get_engine()
+        collection = engine.get_collection(ImageAnnotations)
+        data = await collection.aggregate(data_pipeline, **get_aggregate_options()).to_list(length=None)
+        values = [pop_keyset_values(item, keys) for item in data]
+
+        await AnnotationsService._add_image_data(data, project_id)
+
+        pagination = Pagination(
+            next_token=encode_continuation_token(values[-1], keys) if len(data) == page_size else None)
+
+        if include_total:
+            count = await AnnotationsService.count_raw_annotations_pipeline(pipeline, project_id, estimate)
+            pagination.total, pagination.estimated = count.total, count.estimated
+
+        return AnnotationsQueryResult(data=data, pagination=pagination)
+
+    @staticmethod
+    async def _run_paginated_pipeline(pipeline: List[dict],
+                                      pagination: PaginationMode,
+                                      page_size: Optional[int],
+                                      page: Optional[int],
+                                      continuation_token: Optional[str],
+                                      include_total: bool,
+                                      estimate: bool,
+                                      project_id: ObjectId) -> AnnotationsQueryResult:
+        if pagination == PaginationMode.KEYSET:
+            return await AnnotationsService.run_keyset_annotations_pipeline(
+                pipeline, page_size=page_size, continuation_token=continuation_token,
+                project_id=project_id, include_total=include_total, estimate=estimate)
+
+        return await AnnotationsService.run_raw_annotations_pipeline(
+            pipeline, page_size=page_size, page=page, project_id=project_id,
+            include_total=include_total, estimate=estimate)
+
+    @staticmethod
+    def _get_annotations_pipeline(only_with_images: bool,
+                                  sort_field: AnnotationSortField,
+                                  sort_direction: AnnotationSortDirection) -> List[dict]:
         pipeline = []
 
         if only_with_images:
@@ -93,41 +403,79 @@ class AnnotationsService:
         sort_dir = DESCENDING if sort_direction == AnnotationSortDirection.DESCENDING else ASCENDING
         pipeline += [{'$sort': {sort_field.value: sort_dir}}]
 
-        return await AnnotationsService.run_raw_annotations_pipeline(
-            pipeline, page_size=page_size, page=page, project_id=project.id)
+        return pipeline
+
+    @staticmethod
+    async def get_annotations(page_size: int,
+                              page: int,
+                              only_with_images: bool,
+                              sort_field: AnnotationSortField,
+                              sort_direction: AnnotationSortDirection,
+                              project: Project,
+                              pagination: PaginationMode = PaginationMode.OFFSET,
+                              continuation_token: Optional[str] = None,
+                              include_total: bool = True,
+                              estimate: bool = False) -> AnnotationsQueryResult:
+        pipeline = AnnotationsService._get_annotations_pipeline(only_with_images, sort_field, sort_direction)
+
+        return await AnnotationsService._run_paginated_pipeline(
+            pipeline, pagination=pagination, page_size=page_size, page=page,
+            continuation_token=continuation_token, include_total=include_total, estimate=estimate,
+            project_id=project.id)
+
+    @staticmethod
+    async def count_annotations(only_with_images: bool, project: Project, estimate: bool = False) -> AnnotationsCount:
+        pipeline = [{'$match': {'has_image': True}}] if only_with_images else []
+        return await AnnotationsService.count_raw_annotations_pipeline(pipeline, project.id, estimate)
+
+    @staticmethod
+    async def _compile_annotations_pipeline(query: List[QueryStage], project: Project) -> List[dict]:
+        project_labels, project_attributes = await ProjectService.get_project_schema(project.id)
+
+        try:
+            return compile_pipeline(query, project_labels, project_attributes)
+        except ValueError as error:
+            logger.info('Invalid annotations query for project %s: %s', project.id, error)
+            raise HTTPException(400, detail=str(error))
 
     @staticmethod
     async def run_annotations_pipeline(query: List[QueryStage],
                                        page_size: Optional[int],
                                        page: Optional[int],
-                                       project: Project) -> AnnotationsQueryResult:
-        pipeline = []
-
-        project_labels = await ProjectService.get_project_labels(project.id)
-        project_attributes = await ProjectService.get_project_attributes(project.id)
+                                       project: Project,
+                                       pagination: PaginationMode = PaginationMode.OFFSET,
+                                       continuation_token: Optional[str] = None,
+                                       include_total: bool = True,
+                                       estimate: bool = False) -> AnnotationsQueryResult:
+        pipeline = await AnnotationsService._compile_annotations_pipeline(query, project)
+
+        with query_origin('run_annotations_pipeline', query):
+            return await AnnotationsService._run_paginated_pipeline(
+                pipeline, pagination=pagination, page_size=page_size, page=page,
+                continuation_token=continuation_token, include_total=include_total, estimate=estimate,
+                project_id=project.id)
 
-        for step in query:
-            try:
-                stage = STAGES[step.stage.value](**step.parameters)
-                stage.validate_stage(project_labels=project_labels, project_attributes=project_attributes)
-                pipeline.extend(stage.to_mongo())
-            except ValueError as error:
-                print(error)
-                raise HTTPException(400, detail=str(error))
+    @staticmethod
+    async def count_annotations_pipeline(query: List[QueryStage],
+                                         project: Project,
+                                         estimate: bool = False) -> AnnotationsCount:
+        pipeline = await AnnotationsService._compile_annotations_pipeline(query, project)
 
-        return await AnnotationsService.run_raw_annotations_pipeline(
-            pipeline, page_size=page_size, page=page, project_id=project.id)
+        with query_origin('count_annotations_pipeline', query):
+            return await AnnotationsService.count_raw_annotations_pipeline(pipeline, project.id, estimate)
 
     @staticmethod
     async def add_annotations(annotation: ImageAnnotationsPostSchema,
                               replace: bool, group: str, project_id: ObjectId) -> ImageAnnotations:
-        result = await AnnotationsService.add_annotations_bulk([annotation], replace, group, project_id)
-        return result[0]
+        await AnnotationsService.add_annotations_bulk([annotation], replace, group, project_id)
+        return await AnnotationsService.get_annotations_by_event_id(annotation.event_id, project_id)
 
     @staticmethod
     async def update_annotations(instance: ImageAnnotations,
                                  annotation: Union[ImageAnnotationsPatchSchema, ImageAnnotationsPutSchema],
                                  group: str) -> ImageAnnotations:
+        previous_labels = get_labels_summary(instance)
+
         for attribute in ['tags', 'points', 'polygons', 'polylines', 'captions', 'detections']:
             new_data = getattr(annotation, attribute)
 
@@ -142,76 +490,247 @@ class AnnotationsService:
 
         instance.labels = instance.get_labels()
         engine = await get_engine()
-        return await engine.save(instance)
+        instance = await engine.save(instance)
+        await ProjectService.update_label_stats(
+            instance.project_id, get_label_stats_deltas([(previous_labels, get_labels_summary(instance))]))
+        await run_in_threadpool(invalidate_annotations, instance.project_id)
+        return instance
 
     @staticmethod
-    async def add_annotations_bulk(annotations: List[ImageAnnotationsPostSchema],
-                                   replace: bool, group: str, project_id: ObjectId) -> List[ImageAnnotations]:
-        event_ids = [annotation.event_id for annotation in annotations]
+    async def _write_annotations_documents(annotations: List[ImageAnnotationsPostSchema], replace: bool, group: str,
+                                           project_id: ObjectId, import_batch: Optional[str]
+                                           ) -> Tuple[List[Tuple[LabelsSummary, LabelsSummary]], Set[str],
+                                                      Optional[BulkWriteError]]:
+        """
+        Writes the annotations to their documents, each one only if it is still at the version that was read.
+        Returns the label changes of the written documents, the event ids of the documents that changed
+        since they were read, and the error of the documents that failed for any other reason.
+        """
+        event_ids = list({annotation.event_id: True for annotation in annotations})
         engine = await get_engine()
-        previous_instances = await engine.find(
-            ImageAnnotations,
-            ImageAnnotations.project_id == project_id,
-            ImageAnnotations.event_id.in_(event_ids))
-
-        event_id_to_instance = {ins.event_id: ins for ins in previous_instances}
-
-        images = await engine.find(Image, Image.event_id.in_(event_ids))
-        images = {ins.event_id: True for ins in images}
-
-        result = []
+        collection = engine.get_collection(ImageAnnotations)
+        label_changes: Dict[str, Tuple[LabelsSummary, LabelsSummary]] = {}
+
+        # Only the fields needed to compute the labels of the annotations are loaded
+        previous_documents = await collection.find(
+            {'project_id': project_id, 'event_id': {'$in': event_ids}},
+            {'event_id': 1, VERSION_FIELD: 1, IMPORT_BATCH_FIELD: 1, IMPORT_PREVIOUS_LABELS_FIELD: 1,
+             **{f'{field}.{key}': 1 for field in _OBJECT_FIELDS for key in _LABEL_KEYS}},
+        ).to_list(length=None)
+        previous_documents = {doc['event_id']: doc for doc in previous_documents}
+
+        if import_batch:
+            written = {event_id for event_id, doc in previous_documents.items()
+                       if doc.get(IMPORT_BATCH_FIELD) == import_batch}
+            # Documents written by an earlier attempt of the batch still count in its stats, the stats
+            # that attempt already incremented are marked with the batch and skip them
+            for event_id in written:
+                doc = previous_documents[event_id]
+                label_changes[event_id] = (
+                    decode_labels_summary(doc.get(IMPORT_PREVIOUS_LABELS_FIELD)), get_document_labels_summary(doc))
+
+            event_ids = [event_id for event_id in event_ids if event_id not in written]
+            annotations = [annotation for annotation in annotations if annotation.event_id not in written]
+
+        images = await engine.get_collection(Image).find(
+            {'project_id': project_id, 'event_id': {'$in': event_ids}}, {'event_id': 1}).to_list(length=None)
+        images = {doc['event_id'] for doc in images}
+
+        new_objects = {event_id: {field: [] for field in _OBJECT_FIELDS} for event_id in event_ids}
 
         for annotation in annotations:
-            if annotation.event_id in event_id_to_instance:
-                instance = event_id_to_instance.get(annotation.event_id)
-            else:
-                instance = ImageAnnotations(event_id=annotation.event_id, project_id=project_id)
-
-            if replace:
-                instance.detections = _replace_annotations(instance.detections, annotation.detections, group)
-                instance.polygons = _replace_annotations(instance.polygons, annotation.polygons, group)
-                instance.points = _replace_annotations(instance.points, annotation.points, group)
-                instance.tags = _replace_annotations(instance.tags, annotation.tags, group)
-                instance.polylines = _replace_annotations(instance.polylines, annotation.polylines, group)
-                instance.captions = _replace_annotations(instance.captions, annotation.captions, group)
-            else:
-                instance.detections += _add_group_to_annotations(annotation.detections, group)
-                instance.polygons += _add_group_to_annotations(annotation.polygons, group)
-                instance.points += _add_group_to_annotations(annotation.points, group)
-                instance.tags += _add_group_to_annotations(annotation.tags, group)
-                instance.polylines += _add_group_to_annotations(annotation.polylines, group)
-                instance.captions += _add_group_to_annotations(annotation.captions, group)
+            for field in _OBJECT_FIELDS:
+                objects = _add_group_to_annotations(getattr(annotation, field), group)
+                # Replacing twice the same group only keeps the last annotations
+                new_objects[annotation.event_id][field] = \
+                    objects if replace else new_objects[annotation.event_id][field] + objects
+
+        requests = []
+
+        for event_id in event_ids:
+            previous = previous_documents.get(event_id, {})
+            current = {
+                field: _merge_objects(previous.get(field) or [], objects, replace, group)
+                for field, objects in new_objects[event_id].items()
+            }
+            previous_labels = get_document_labels_summary(previous)
+            current_labels = get_document_labels_summary(current)
+            label_changes[event_id] = (previous_labels, current_labels)
+
+            update = _make_annotations_update(
+                new_objects[event_id], replace, group, event_id in images, get_summary_labels(current_labels),
+                import_batch, previous_labels)
+            # The labels are computed from the objects that were read, so the document is only written if it
+            # didn't change since. Otherwise the filter doesn't match and the upsert breaks the unique index.
+            requests.append(UpdateOne(
+                {'project_id': project_id, 'event_id': event_id, VERSION_FIELD: previous.get(VERSION_FIELD)},
+                update, upsert=True))
+
+        failed = {}
+        error = None
+
+        try:
+            if requests:
+                await collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as bulk_error:
+            failed = {event_ids[x['index']]: x['code'] for x in bulk_error.details['writeErrors']}
+            error = bulk_error if any(code != 11000 for code in failed.values()) else None
+
+        conflicts = {event_id for event_id, code in failed.items() if code == 11000}
+        return [change for event_id, change in label_changes.items() if event_id not in failed], conflicts, error
 
-            instance.has_image = images.get(annotation.event_id, False)
-            instance.labels = instance.get_labels()
-            result.append(instance)
+    @staticmethod
+    async def add_annotations_bulk(annotations: List[ImageAnnotationsPostSchema],
+                                   replace: bool, group: str, project_id: ObjectId, import_batch: Optional[str] = None):
+        """
+        Adds the annotations to their documents, and then updates the label stats of the project with the
+        changes of the documents that were written. Documents changed by concurrent writes after they were
+        read are read and written again.
+        Documents written by an import batch are marked with it, so writing again the same batch
+        skips the documents it already wrote and doesn't apply their label stats twice.
+        """
+        label_changes = []
+        pending = annotations
+        error = None
+
+        for _ in range(_BULK_WRITE_ATTEMPTS):
+            changes, conflicts, error = await AnnotationsService._write_annotations_documents(
+                pending, replace, group, project_id, import_batch)
+            label_changes.extend(changes)
+            pending = [annotation for annotation in pending if annotation.event_id in conflicts]
+
+            if error is not None or not pending:
+                break
+
+        # A failed import batch is retried as a whole, and its stats are then applied from all its documents
+        if error is None or not import_batch:
+            await ProjectService.update_label_stats(project_id, get_label_stats_deltas(label_changes), import_batch)
+
+        # The redis client is synchronous, so it is kept off the event loop
+        generation = await run_in_threadpool(invalidate_annotations, project_id)
+
+        if not replace:
+            # Appending annotations can only add labels to the project schema
+            labels = [label for _, current_labels in label_changes for label in get_summary_labels(current_labels)]
+            await run_in_threadpool(ProjectService.extend_project_schema, project_id, generation, labels)
+
+        if error is not None:
+            raise error
+
+        if pending:
+            raise HTTPException(409, detail=f'{len(pending)} annotations were modified by concurrent writes')
 
-        return await engine.save_all(result)
+    @staticmethod
+    async def add_annotations_stream(chunks: AsyncIterator[bytes], compressed: bool,
+                                     replace: bool, group: str, project_id: ObjectId) -> AnnotationsStreamResult:
+        start_time = time.perf_counter()
+        batch = []
+        errors = []
+        lines = written = failed = 0
+
+        try:
+            async for line in _iter_lines(chunks, compressed):
+                lines += 1
+
+                if not line.strip():
+                    continue
+
+                try:
+                    batch.append(ImageAnnotationsPostSchema.parse_obj(orjson.loads(line)))
+                except (orjson.JSONDecodeError, ValidationError) as error:
+                    failed += 1
+                    if len(errors) < Config.STREAM_MAX_REPORTED_ERRORS:
+                        errors.append(AnnotationsStreamError(line=lines, detail=str(error)))
+                    continue
+
+                if len(batch) >= Config.STREAM_BATCH_SIZE:
+                    await AnnotationsService.add_annotations_bulk(batch, replace, group, project_id)
+                    written += len(batch)
+                    batch = []
+        except zlib.error as error:
+            raise HTTPException(400, detail=f'Invalid gzip stream after {written} annotations: {error}')
+
+        if batch:
+            await AnnotationsService.add_annotations_bulk(batch, replace, group, project_id)
+            written += len(batch)
+
+        elapsed_time = time.perf_counter() - start_time
+
+        return AnnotationsStreamResult(
+            lines=lines,
+            written=written,
+            failed=failed,
+            errors=errors,
+            elapsed_time=elapsed_time,
+            annotations_per_second=written / elapsed_time if elapsed_time else 0)
 
     @staticmethod
     async def delete_annotations(annotations: ImageAnnotations, group: Optional[str]):
         engine = await get_engine()
         if not group:
             await engine.delete(annotations)
+            await ProjectService.update_label_stats(
+                annotations.project_id, get_label_stats_deltas([(get_labels_summary(annotations), {})]))
+            await run_in_threadpool(invalidate_annotations, annotations.project_id)
         else:
             new_annotations = ImageAnnotationsPatchSchema(
                 tags=[], captions=[], detections=[], polygons=[], polylines=[], points=[])
             return await AnnotationsService.update_annotations(annotations, new_annotations, group)
 
     @staticmethod
-    async def add_annotations_file(file: str,
+    async def add_annotations_file(file: UploadFile,
                                    annotations_format: DatasetImportFormat,
                                    replace: bool,
                                    group: str,
-                                   project_id: ObjectId):
-        annotations = import_dataset(file, annotations_format, project_id)
-        return await AnnotationsService.add_annotations_bulk(annotations, replace, group, project_id)
+                                   project_id: ObjectId) -> str:
+        key = _get_import_file_key(project_id, file.filename)
+
+        # The s3 file is written with blocking calls, which run in the thread pool
+        output = await run_in_threadpool(s3_fs.open, key, 'wb')
+
+        try:
+            while True:
+                chunk = await file.read(_UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await run_in_threadpool(output.write, chunk)
+        finally:
+            await run_in_threadpool(output.close)
+
+        job = imports_queue.enqueue(
+            _import_annotations_file,
+            key=key, annotations_format=annotations_format, replace=replace, group=group, project_id=project_id,
+            meta={'project_id': str(project_id)},
+            job_timeout=Config.IMPORT_JOB_TIMEOUT,
+            retry=Retry(max=Config.IMPORT_JOB_RETRIES),
+            on_failure=_on_import_failure)
+        return job.id
+
+    @staticmethod
+    async def get_annotations_file_import_status(job_id: str, project_id: ObjectId) -> AnnotationsImportStatus:
+        try:
+            job = Job.fetch(job_id, connection=redis)
+        except NoSuchJobError:
+            raise HTTPException(404)
+
+        if job.meta.get('project_id') != str(project_id):
+            raise HTTPException(404)
+
+        error = job.exc_info.strip().split('\n')[-1] if job.exc_info else None
+
+        return AnnotationsImportStatus(
+            job_id=job.id,
+            status=job.get_status(),
+            items_done=job.meta.get('items_done', 0),
+            items_failed=job.meta.get('items_failed', 0),
+            items_per_second=job.meta.get('items_per_second', 0),
+            error=error,
+            errors=job.meta.get('errors', []))
 
     @staticmethod
     async def get_stages_schema(project_id: ObjectId):
         result = {}
-        project_labels = await ProjectService.get_project_labels(project_id)
-        project_attributes = await ProjectService.get_project_attributes(project_id)
+        project_labels, project_attributes = await ProjectService.get_project_schema(project_id)
 
         for stage_id, stage_class in STAGES.items():
             try:
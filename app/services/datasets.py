@@ -1,8 +1,19 @@
-from typing import List, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta
 from enum import Enum
+import itertools
 import json
+import logging
+import os
+import shutil
 import tempfile
+import time
+
+import orjson
+from cachetools import LRUCache
 
 from fastapi import HTTPException
 from odmantic import ObjectId
@@ -10,18 +21,21 @@ from zipfile import ZipFile, ZIP_DEFLATED
 import cloudpickle
 
 import s3fs
-from datumaro.components.dataset import DatasetItem
-from datumaro.util.image import Image
+from rq import get_current_job
 from rq.decorators import job
-from rq.job import Job
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
 
 from app.schema import DatasetPostSchema, DatasetGetSortQuery, DatasetToken, \
-    ImageAnnotationsData, DatasetPatchSchema
-from app.models import ImageAnnotations, Dataset, Label, get_engine, FastToken
+    ImageAnnotationsData, DatasetPatchSchema, DatasetDiff
+from app.models import ImageAnnotations, Dataset, Label, get_engine, initialize, FastToken
 from app.services.storage import StorageService
 from app.services.annotations import AnnotationsService
-from app.core.aggregations import GET_LABELS_PIPELINE
-from app.core.exporters import create_datumaro_dataset, DatasetExportFormat
+from app.core.labels import merge_labels
+from app.core.exporters import EXPORTER_VERSION, AnnotationsExtractor, DatasetExportFormat, \
+    export_annotations, get_image_filename, get_label_names
+from app.core.writers import NATIVE_WRITERS
+from app.core.snapshots import SNAPSHOT_VERSION, DIGEST_COLUMN, SnapshotReader, get_row_digest, write_snapshot
 from app.security import create_fast_jwt_token
 from app.config import Config
 from app.utils import zip_dir
@@ -29,7 +43,20 @@ from app.core.queue import redis
 from app.core.tracing import traced
 
 
-s3_fs = s3fs.S3FileSystem()
+s3_fs = s3fs.S3FileSystem(config_kwargs={'max_pool_connections': Config.EXPORT_DOWNLOAD_CONCURRENCY})
+
+logger = logging.getLogger(__name__)
+
+# Number of downloaded images between progress updates of the export job
+_DOWNLOAD_PROGRESS_INTERVAL = 1000
+
+# Seconds during which an export being enqueued can't be enqueued again by another request
+_EXPORT_ENQUEUE_LOCK_TTL = 60
+
+_EXPORT_IN_PROGRESS_STATUSES = {JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED}
+
+# Snapshots are never modified once written, so their footers can be kept by every worker
+_snapshot_footers = LRUCache(maxsize=Config.SNAPSHOT_FOOTER_CACHE_SIZE)
 
 
 class DatasetExportingStatus(Enum):
@@ -42,48 +69,162 @@ def _get_dataset_exporting_zip_name(dataset: Dataset, format: DatasetExportForma
     return f'{dataset.name}_{format.value}_v{dataset.version}.zip'
 
 
-def _get_dataset_exporting_result_key(dataset: Dataset, format: DatasetExportFormat):
+def _get_dataset_export_job_id(dataset: Dataset, format: DatasetExportFormat):
+    return f'export-{dataset.id}-v{dataset.version}-{format.value}-e{EXPORTER_VERSION}'
+
+
+def _get_dataset_exporting_result_folder(dataset: Dataset, format: DatasetExportFormat):
     return f'{Config.DATASET_ARTIFACTS_BUCKET}/' \
            f'{Config.DATASET_EXPORTING_RESULTS_FOLDER}/' \
-           f'{dataset.project_id}/{dataset.name}/{_get_dataset_exporting_zip_name(dataset, format)}'
+           f'{dataset.project_id}/{_get_dataset_export_job_id(dataset, format)}'
 
 
-def _get_dataset_snapshot_key(dataset: Dataset):
+def _get_dataset_exporting_result_key(dataset: Dataset, format: DatasetExportFormat):
+    return f'{_get_dataset_exporting_result_folder(dataset, format)}/{_get_dataset_exporting_zip_name(dataset, format)}'
+
+
+def _get_dataset_export_artifact_key(job_id: str):
+    return f'dataset:export:artifact:{job_id}'
+
+
+def _get_dataset_export_lock_key(job_id: str):
+    return f'dataset:export:lock:{job_id}'
+
+
+def _find_dataset_export_artifact(dataset: Dataset, format: DatasetExportFormat) -> Optional[str]:
+    """
+    Returns the key of the zip already exported for the dataset version, format and exporter version, if any.
+    The folder identifies the contents, the zip name only changes the name of the downloaded file.
+    """
+    try:
+        keys = s3_fs.ls(_get_dataset_exporting_result_folder(dataset, format), refresh=True)
+    except FileNotFoundError:
+        return None
+
+    return next((key for key in keys if key.endswith('.zip')), None)
+
+
+def _get_snapshot_key(project_id: ObjectId, dataset_id: Union[ObjectId, str], extension: str = 'snapshot'):
     return f'{Config.DATASET_ARTIFACTS_BUCKET}/' \
            f'{Config.DATASET_SNAPSHOT_FOLDER}/' \
-           f'{dataset.project_id}/' \
-           f'{dataset.id}.json'
+           f'{project_id}/' \
+           f'{dataset_id}.{extension}'
+
+
+def _get_dataset_snapshot_key(dataset: Dataset):
+    extension = 'json' if dataset.snapshot_version == 1 else 'snapshot'
+    return _get_snapshot_key(dataset.project_id, dataset.id, extension)
+
+
+def _get_annotations_digest(annotations: ImageAnnotationsData) -> str:
+    return get_row_digest(annotations.dict())
+
+
+def _download_image(source: str, destination: str) -> int:
+    for attempt in range(Config.EXPORT_DOWNLOAD_RETRIES + 1):
+        try:
+            s3_fs.get(source, destination)
+            return os.path.getsize(destination)
+        except FileNotFoundError:
+            raise
+        except Exception:
+            if attempt == Config.EXPORT_DOWNLOAD_RETRIES:
+                raise
+            time.sleep(Config.EXPORT_DOWNLOAD_RETRY_DELAY * 2 ** attempt)
+
+
+def _download_images(downloads: List[Tuple[str, str]]):
+    """
+    Downloads the (source, destination) pairs concurrently, retrying failed downloads with exponential backoff.
+    The progress and throughput are reported in the meta of the current job.
+    """
+    current_job = get_current_job()
+    start_time = time.time()
+    total_bytes = 0
+
+    with ThreadPoolExecutor(max_workers=Config.EXPORT_DOWNLOAD_CONCURRENCY) as executor:
+        sizes = executor.map(lambda x: _download_image(*x), downloads)
+
+        for i, size in enumerate(sizes, 1):
+            total_bytes += size
+
+            if current_job and (i % _DOWNLOAD_PROGRESS_INTERVAL == 0 or i == len(downloads)):
+                elapsed_time = max(time.time() - start_time, 1e-6)
+                current_job.meta['images_downloaded'] = i
+                current_job.meta['images_per_second'] = i / elapsed_time
+                current_job.meta['download_bytes_per_second'] = total_bytes / elapsed_time
+                current_job.save_meta()
+
+    elapsed_time = max(time.time() - start_time, 1e-6)
+    logger.info(f'Downloaded {len(downloads)} images ({total_bytes / 2 ** 20:.1f} MiB) in {elapsed_time:.1f}s, '
+                f'{len(downloads) / elapsed_time:.1f} images/s, {total_bytes / 2 ** 20 / elapsed_time:.1f} MiB/s')
+
+
+def _upload_dir_as_zip(path: str, key: str):
+    """
+    Writes the zip of the directory straight into a multipart upload, removing every file once it is added,
+    so the zip never touches the local disk and parts are uploaded while it is being built.
+    """
+    file = s3_fs.open(key, 'wb', block_size=Config.EXPORT_UPLOAD_PART_SIZE)
+
+    try:
+        with ZipFile(file, 'w', ZIP_DEFLATED) as zip_file:
+            zip_dir(path, zip_file, remove=True)
+    except BaseException:
+        # Aborts the multipart upload, so a broken zip is never published
+        file.discard()
+        raise
+
+    file.close()
 
 
 @job('dataset', connection=redis)
 async def _create_dataset_zip(dataset_binary: bytes, format: DatasetExportFormat):
     dataset: Dataset = cloudpickle.loads(dataset_binary)
-    annotations = await DatasetService._get_dataset_snapshot(dataset)
-    dataset_datumaro = create_datumaro_dataset(annotations)
+
+    if dataset.labels is None:
+        await initialize()
+
+    labels = get_label_names(await DatasetService.get_dataset_labels(dataset))
     zip_name = _get_dataset_exporting_zip_name(dataset, format)
 
     with tempfile.TemporaryDirectory() as tmpdir:
-        for row in dataset_datumaro:
-            item: DatasetItem = row
+        images_dir = f'{tmpdir}/images'
+        os.makedirs(images_dir)
+        downloads = {}
+        count = 0
 
-            if not item.has_image:
-                continue
+        for row in DatasetService._iter_dataset_snapshot(dataset, columns=['event_id', 'has_image']):
+            count += 1
+
+            if row['has_image']:
+                image_filename = get_image_filename(row['event_id'])
+                downloads[f'{images_dir}/{image_filename}'] = \
+                    f'{Config.IMAGE_STORAGE_BUCKET}/raw/{dataset.project_id}/{image_filename}'
 
-            image_filename = item.image.path.split('/')[-1]
-            image_path = f'{tmpdir}/{image_filename}'
-            s3_fs.get(f'{Config.IMAGE_STORAGE_BUCKET}/raw/{dataset.project_id}/{image_filename}', image_path)
-            item.image = Image(path=image_path, size=item.image.size)
+        _download_images([(source, destination) for destination, source in downloads.items()])
 
-        dataset_folder = f'/tmp/{zip_name}'
-        dataset_datumaro.export(dataset_folder, format.value, save_images=True)
+        dataset_folder = f'{tmpdir}/export/{zip_name}'
+        writer = NATIVE_WRITERS.get(format)
 
-        zip_filename = f'/tmp/{dataset.id}.zip'
-        zip_file = ZipFile(zip_filename, 'w', ZIP_DEFLATED)
-        zip_dir(dataset_folder, zip_file)
-        zip_file.close()
+        # Annotations are decoded from the snapshot while they are exported, so memory doesn't grow with the dataset
+        if writer is not None:
+            writer(DatasetService._iter_dataset_snapshot(dataset), labels, dataset_folder, images_dir)
+        else:
+            extractor = AnnotationsExtractor(
+                lambda: (ImageAnnotationsData.parse_obj(x) for x in DatasetService._iter_dataset_snapshot(dataset)),
+                labels, count, images_dir)
+            export_annotations(extractor, dataset_folder, format, save_images=True)
+
+        # The export has its own copy of the images
+        shutil.rmtree(images_dir)
 
         output_key = _get_dataset_exporting_result_key(dataset, format)
-        s3_fs.put(zip_filename, output_key)
+        _upload_dir_as_zip(dataset_folder, output_key)
+
+        current_job = get_current_job()
+        if current_job:
+            redis.set(_get_dataset_export_artifact_key(current_job.id), output_key, ex=Config.EXPORT_ARTIFACT_TTL)
 
         return output_key
 
@@ -101,9 +242,44 @@ class DatasetService:
         return dataset
 
     @staticmethod
-    async def get_annotations_by_dataset_id(dataset_id: ObjectId, project_id: ObjectId) -> List[ImageAnnotationsData]:
+    async def get_annotations_by_dataset_id(dataset_id: ObjectId, project_id: ObjectId,
+                                            offset: int = 0, limit: Optional[int] = None) -> List[ImageAnnotationsData]:
+        dataset = await DatasetService.get_dataset_by_id(dataset_id, project_id)
+        return await DatasetService._get_dataset_snapshot(dataset, offset, limit)
+
+    @staticmethod
+    async def get_annotations_by_event_id(dataset_id: ObjectId, project_id: ObjectId,
+                                          event_id: str) -> ImageAnnotationsData:
+        dataset = await DatasetService.get_dataset_by_id(dataset_id, project_id)
+        row = None
+
+        if dataset.snapshot_version == 1:
+            rows = DatasetService._iter_dataset_snapshot(dataset)
+            row = next((x for x in rows if x['event_id'] == event_id), None)
+        elif event_id in dataset.event_ids:
+            # The latest snapshot of the chain holding the event has its annotations for this version
+            for key in reversed(DatasetService._get_snapshot_chain(dataset)):
+                with DatasetService._open_dataset_snapshot(key) as reader:
+                    row = reader.get(event_id)
+                if row is not None:
+                    break
+
+        if row is None:
+            raise HTTPException(404, f'Annotations for event {event_id} not found in dataset')
+
+        return ImageAnnotationsData.parse_obj(row)
+
+    @staticmethod
+    async def stream_annotations_by_dataset_id(dataset_id: ObjectId, project_id: ObjectId,
+                                               offset: int = 0, limit: Optional[int] = None) -> Iterator[bytes]:
+        """
+        Returns the dataset annotations as newline delimited json, decoding the snapshot as it is consumed.
+        """
         dataset = await DatasetService.get_dataset_by_id(dataset_id, project_id)
-        return await DatasetService._get_dataset_snapshot(dataset)
+        aliases = {name: field.alias for name, field in ImageAnnotationsData.__fields__.items()}
+
+        return (orjson.dumps({aliases.get(key, key): value for key, value in row.items()}) + b'\n'
+                for row in DatasetService._iter_dataset_snapshot(dataset, offset=offset, limit=limit))
 
     @staticmethod
     async def delete_dataset(dataset_id: ObjectId, project_id: ObjectId):
@@ -121,7 +297,7 @@ class DatasetService:
     async def check_event_ids_exist(event_ids: List[str], project_id: ObjectId):
         results = await AnnotationsService.run_raw_annotations_pipeline([
             {'$match': {'event_id': {'$in': event_ids}}}
-        ], page_size=None, page=None, project_id=project_id)
+        ], page_size=None, page=None, project_id=project_id, include_total=False)
 
         annotations = results.data
         annotations_ids = [x.event_id for x in annotations]
@@ -140,6 +316,8 @@ class DatasetService:
             **dataset.dict(),
             created_at=now,
             project_id=project_id,
+            labels=merge_labels(label for x in annotations for label in x.labels),
+            snapshot_version=SNAPSHOT_VERSION,
         )
         engine = await get_engine()
         instance = await engine.save(instance)
@@ -150,10 +328,15 @@ class DatasetService:
     async def update_dataset(dataset: Dataset, new_data: Union[DatasetPatchSchema, DatasetPostSchema]) -> Dataset:
         engine = await get_engine()
 
-        annotations = await DatasetService.check_event_ids_exist(
-            dataset.event_ids, dataset.project_id)
-
         if new_data.event_ids is not None:
+            annotations = await DatasetService.check_event_ids_exist(
+                new_data.event_ids, dataset.project_id)
+
+            # New versions are stored as deltas of their parent, with a full snapshot every few versions
+            snapshot_depth = dataset.snapshot_depth + 1 if dataset.snapshot_version != 1 else 0
+            if snapshot_depth >= Config.SNAPSHOT_COMPACTION_INTERVAL:
+                snapshot_depth = 0
+
             new_data_dict = {k: v for k, v in new_data.dict().items() if v is not None}
             new_data_dict = {
                 **dataset.dict(exclude={'id', 'child_id'}),
@@ -162,12 +345,15 @@ class DatasetService:
                 'parent_id': dataset.id,
                 'created_at': datetime.utcnow(),
                 'project_id': dataset.project_id,
+                'labels': merge_labels(label for x in annotations for label in x.labels),
+                'snapshot_version': SNAPSHOT_VERSION,
+                'snapshot_depth': snapshot_depth,
             }
             instance = Dataset(**new_data_dict)
             instance = await engine.save(instance)
             dataset.child_id = instance.id
             await engine.save(dataset)
-            await DatasetService._create_dataset_snapshot(instance, annotations)
+            await DatasetService._create_dataset_snapshot(instance, annotations, parent=dataset)
             return instance
 
         if new_data.name is not None:
@@ -210,6 +396,48 @@ class DatasetService:
                [dataset] + \
                [Dataset.parse_doc(x) for x in result['children']]
 
+    @staticmethod
+    async def get_datasets_diff(dataset: Dataset, other: Dataset) -> DatasetDiff:
+        """
+        Compares two versions of a dataset. The changed annotations are taken from the snapshot metadata
+        of the versions in between, so only their footers are read, and include the events that were modified
+        or removed and added back at any of those versions.
+        """
+        old, new = sorted([dataset, other], key=lambda x: x.version)
+        revisions = await DatasetService.get_dataset_revisions(new)
+
+        if old.id not in {x.id for x in revisions}:
+            raise HTTPException(400, 'Datasets are not revisions of the same dataset')
+
+        old_event_ids, new_event_ids = set(old.event_ids), set(new.event_ids)
+        modified = set()
+
+        for revision in revisions:
+            if not old.version < revision.version <= new.version:
+                continue
+
+            metadata = {} if revision.snapshot_version == 1 else \
+                DatasetService._get_snapshot_metadata(_get_dataset_snapshot_key(revision))
+
+            if 'parent_id' not in metadata:
+                modified = None
+                break
+
+            modified.update(metadata['added'])
+            modified.update(metadata['changed'])
+
+        if modified is None:
+            # Revisions created before the metadata was stored are compared annotation by annotation
+            old_digests = DatasetService._get_snapshot_digests(old)
+            modified = {event_id for event_id, digest in DatasetService._get_snapshot_digests(new).items()
+                        if old_digests.get(event_id) != digest}
+
+        return DatasetDiff(
+            added=[x for x in new.event_ids if x not in old_event_ids],
+            removed=[x for x in old.event_ids if x not in new_event_ids],
+            changed=[x for x in new.event_ids if x in old_event_ids and x in modified],
+        )
+
     @staticmethod
     async def get_datasets(project_id: ObjectId,
                            name: Optional[str] = None,
@@ -228,22 +456,31 @@ class DatasetService:
 
     @staticmethod
     async def get_dataset_labels(dataset: Dataset) -> List[Label]:
-        labels_pipeline = [{
-            '$match': {
-                'project_id': dataset.project_id,
-                'event_id': {'$in': dataset.event_ids}
-            }
-        }] + GET_LABELS_PIPELINE
+        """
+        Returns the labels of the dataset snapshot. Datasets created before the labels were stored get them
+        from the snapshot annotations, since the project annotations may have changed since, and keep them.
+        """
+        if dataset.labels is not None:
+            return dataset.labels
+
+        annotations = (ImageAnnotationsData.parse_obj(x) for x in DatasetService._iter_dataset_snapshot(dataset))
+        dataset.labels = merge_labels(label for x in annotations for label in x.get_labels())
         engine = await get_engine()
-        collection = engine.get_collection(ImageAnnotations)
-        labels = await collection.aggregate(labels_pipeline).to_list(length=None)
-        return [Label(name=doc['name'], attributes=doc['attributes'], shape=doc['shape']) for doc in labels]
+        await engine.get_collection(Dataset).update_one(
+            {'_id': dataset.id}, {'$set': {+Dataset.labels: [label.doc() for label in dataset.labels]}})
+        return dataset.labels
 
     @staticmethod
-    async def get_dataset_download_url(job_id: str) -> Optional[str]:
+    async def get_dataset_download_url(dataset: Dataset, job_id: str) -> Optional[str]:
+        """
+        Returns the url of the zip exported by the job, which must be an export of the dataset version.
+        """
+        if job_id not in {_get_dataset_export_job_id(dataset, format) for format in DatasetExportFormat}:
+            raise HTTPException(404)
+
         try:
-            job = Job.fetch(job_id, connection=redis)
-            key = job.result
+            key = redis.get(_get_dataset_export_artifact_key(job_id))
+            key = key.decode() if key else Job.fetch(job_id, connection=redis).result
             if not key:
                 return None
             return await StorageService.create_presigned_get_url_for_object_download(key)
@@ -251,9 +488,34 @@ class DatasetService:
             return None
 
     @staticmethod
-    async def download_dataset(dataset: Dataset, format: DatasetExportFormat) -> DatasetExportingStatus:
+    async def download_dataset(dataset: Dataset, format: DatasetExportFormat) -> str:
+        """
+        Returns the id of the job exporting the dataset version in the given format.
+        The job id is derived from the export contents, so an export that already exists or is
+        being built is reused instead of enqueuing a new job.
+        """
+        job_id = _get_dataset_export_job_id(dataset, format)
+        artifact = _find_dataset_export_artifact(dataset, format)
+
+        if artifact is not None:
+            redis.set(_get_dataset_export_artifact_key(job_id), artifact, ex=Config.EXPORT_ARTIFACT_TTL)
+            return job_id
+
+        try:
+            status = Job.fetch(job_id, connection=redis).get_status()
+        except NoSuchJobError:
+            status = None
+
+        if status in _EXPORT_IN_PROGRESS_STATUSES:
+            return job_id
+
+        # Concurrent requests for the same export are coalesced onto the job enqueued by the first one
+        if not redis.set(_get_dataset_export_lock_key(job_id), 1, nx=True, ex=_EXPORT_ENQUEUE_LOCK_TTL):
+            return job_id
+
+        redis.delete(_get_dataset_export_artifact_key(job_id))
         dataset_binary = cloudpickle.dumps(dataset)
-        job = _create_dataset_zip.delay(dataset_binary=dataset_binary, format=format)
+        job = _create_dataset_zip.delay(dataset_binary=dataset_binary, format=format, job_id=job_id)
         return job.id
 
     @staticmethod
@@ -269,15 +531,146 @@ class DatasetService:
         return DatasetToken(token=token)
 
     @staticmethod
-    async def _create_dataset_snapshot(dataset: Dataset, annotations: List[ImageAnnotationsData]):
+    async def _create_dataset_snapshot(dataset: Dataset, annotations: List[ImageAnnotationsData],
+                                       parent: Optional[Dataset] = None):
+        """
+        Writes the snapshot of the dataset. Revisions store the event ids added and changed since their parent
+        in the snapshot metadata, and delta snapshots only hold the annotations of those events.
+        """
         key = _get_dataset_snapshot_key(dataset)
-        with s3_fs.open(key, 'w') as file:
-            data = [x.dict() for x in annotations]
-            json.dump(data, file)
+        metadata = {}
+        # Rows are stored in the order of the dataset events, which delta snapshot chains are read in too
+        order = {event_id: i for i, event_id in reversed(list(enumerate(dataset.event_ids)))}
+        annotations = sorted(annotations, key=lambda x: order[x.event_id])
+
+        if parent is not None:
+            previous = DatasetService._get_snapshot_digests(parent)
+            added = [x.event_id for x in annotations if x.event_id not in previous]
+            changed = [x.event_id for x in annotations
+                       if x.event_id in previous and previous[x.event_id] != _get_annotations_digest(x)]
+            metadata = {'parent_id': str(parent.id), 'added': added, 'changed': changed}
+
+            if dataset.snapshot_depth > 0:
+                modified = set(added) | set(changed)
+                annotations = [x for x in annotations if x.event_id in modified]
+
+        with s3_fs.open(key, 'wb') as file:
+            write_snapshot(file, annotations, block_size=Config.SNAPSHOT_BLOCK_SIZE, metadata=metadata)
+
+    @staticmethod
+    @contextmanager
+    def _open_dataset_snapshot(key: str) -> Iterator[SnapshotReader]:
+        # Readers fetch exactly the byte ranges they need, so each read is a single S3 range request
+        with s3_fs.open(key, 'rb', cache_type='none') as file:
+            reader = SnapshotReader(file, _snapshot_footers.get(key))
+            _snapshot_footers[key] = reader.footer
+            yield reader
+
+    @staticmethod
+    def _get_snapshot_reader(key: str) -> SnapshotReader:
+        # Readers built from a cached footer can answer questions about the snapshot without reading it
+        footer = _snapshot_footers.get(key)
+
+        if footer is None:
+            with DatasetService._open_dataset_snapshot(key) as reader:
+                footer = reader.footer
+
+        return SnapshotReader(None, footer)
+
+    @staticmethod
+    def _get_snapshot_metadata(key: str) -> dict:
+        return DatasetService._get_snapshot_reader(key).metadata
+
+    @staticmethod
+    def _get_snapshot_chain(dataset: Dataset) -> List[str]:
+        """
+        Returns the keys of the snapshots that make up the dataset annotations, from the last full snapshot
+        to the one of the dataset. Every delta snapshot points to the snapshot of its parent.
+        """
+        keys = [_get_dataset_snapshot_key(dataset)]
+
+        for _ in range(dataset.snapshot_depth):
+            parent_id = DatasetService._get_snapshot_metadata(keys[0])['parent_id']
+            keys.insert(0, _get_snapshot_key(dataset.project_id, parent_id))
+
+        return keys
 
     @staticmethod
-    async def _get_dataset_snapshot(dataset: Dataset):
+    def _iter_snapshot_chain(keys: List[str], event_ids: List[str], columns: Optional[List[str]] = None,
+                             offset: int = 0, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Reads the rows of the events from a chain of snapshots, in the order of the events. The row of an event
+        is taken from the last snapshot that holds it, and only the blocks with the requested rows are decoded.
+        """
+        with ExitStack() as stack:
+            readers = [stack.enter_context(DatasetService._open_dataset_snapshot(key)) for key in keys]
+            locations = {}
+
+            for index, reader in enumerate(readers):
+                for row, x in enumerate(reader.iter_rows(['event_id'])):
+                    locations[x['event_id']] = (index, row)
+
+            event_ids = [x for x in dict.fromkeys(event_ids) if x in locations]
+            end = None if limit is None else offset + limit
+            event_ids = event_ids[offset:end]
+
+            # Rows are read a block worth of events at a time, so a whole chain is never held in memory
+            for start in range(0, len(event_ids), Config.SNAPSHOT_BLOCK_SIZE):
+                window = event_ids[start:start + Config.SNAPSHOT_BLOCK_SIZE]
+                rows = defaultdict(list)
+
+                for event_id in window:
+                    index, row = locations[event_id]
+                    rows[index].append(row)
+
+                values = {
+                    (index, row): value
+                    for index, index_rows in rows.items()
+                    for row, value in readers[index].get_rows(index_rows, columns)
+                }
+
+                for event_id in window:
+                    yield values[locations[event_id]]
+
+    @staticmethod
+    def _iter_dataset_snapshot(dataset: Dataset, columns: Optional[List[str]] = None,
+                               offset: int = 0, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
         key = _get_dataset_snapshot_key(dataset)
-        with s3_fs.open(key, 'r') as file:
-            data = json.load(file)
-            return [ImageAnnotationsData.parse_obj(x) for x in data]
+
+        if dataset.snapshot_version == 1:
+            with s3_fs.open(key, 'r') as file:
+                rows = json.load(file)
+                end = None if limit is None else offset + limit
+                for row in itertools.islice(rows, offset, end):
+                    yield {column: row.get(column) for column in columns} if columns else row
+            return
+
+        if dataset.snapshot_depth > 0:
+            keys = DatasetService._get_snapshot_chain(dataset)
+            yield from DatasetService._iter_snapshot_chain(keys, dataset.event_ids, columns, offset, limit)
+            return
+
+        with DatasetService._open_dataset_snapshot(key) as reader:
+            yield from reader.iter_rows(columns, offset, limit)
+
+    @staticmethod
+    def _get_snapshot_digests(dataset: Dataset) -> Dict[str, str]:
+        """
+        Returns the digest of the annotations of every event of the dataset. They are read from the digest
+        column of the snapshots, and only computed from the annotations of snapshots written without it.
+        """
+        if dataset.snapshot_version != 1:
+            keys = DatasetService._get_snapshot_chain(dataset)
+
+            if all(DatasetService._get_snapshot_reader(key).has_column(DIGEST_COLUMN) for key in keys):
+                rows = DatasetService._iter_dataset_snapshot(dataset, columns=['event_id', DIGEST_COLUMN])
+                return {row['event_id']: row[DIGEST_COLUMN] for row in rows}
+
+        rows = DatasetService._iter_dataset_snapshot(dataset)
+        return {row['event_id']: _get_annotations_digest(ImageAnnotationsData.parse_obj(row)) for row in rows}
+
+    @staticmethod
+    async def _get_dataset_snapshot(dataset: Dataset, offset: int = 0,
+                                    limit: Optional[int] = None) -> List[ImageAnnotationsData]:
+        rows = DatasetService._iter_dataset_snapshot(dataset, offset=offset, limit=limit)
+        return [ImageAnnotationsData.parse_obj(x) for x in rows]
@@ -1,15 +1,28 @@
-from typing import List
+from typing import Dict, List, Optional, Tuple
 import secrets
 
 from fastapi import HTTPException
-from odmantic import ObjectId
+from fastapi.concurrency import run_in_threadpool
+from odmantic import ObjectId, query
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from app.schema import ProjectPostSchema, ApiKey
-from app.models import get_engine, Project, ImageAnnotations, Label
-from app.core.aggregations import GET_LABELS_PIPELINE, GET_IMAGE_ATTRIBUTES_PIPELINE
+from app.models import get_engine, Project, ImageAnnotations, Label, ProjectLabelStats, IMPORT_BATCH_FIELD
+from app.core.aggregations import GET_IMAGE_ATTRIBUTES_PIPELINE
+from app.core.labels import LabelKey, merge_labels
+from app.core.cache import get_annotations_generation, get_cached_schema, set_cached_schema
 from app.core.tracing import traced
 
 
+def _label_to_dict(label: Label) -> dict:
+    return {'name': label.name, 'shape': label.shape.value, 'attributes': sorted(label.attributes)}
+
+
+def _merge_labels(labels: List[dict], new_labels: List[Label]) -> List[dict]:
+    return [_label_to_dict(label) for label in merge_labels([Label(**x) for x in labels] + new_labels)]
+
+
 @traced
 class ProjectService:
     @staticmethod
@@ -56,18 +69,93 @@ class ProjectService:
         return ApiKey(key=api_key, scopes=['all'])
 
     @staticmethod
-    async def get_project_labels(project_id: ObjectId) -> List[Label]:
-        labels_pipeline = [{'$match': {'project_id': project_id}}] + GET_LABELS_PIPELINE
+    async def get_project_label_stats(project_id: ObjectId) -> List[ProjectLabelStats]:
         engine = await get_engine()
-        collection = engine.get_collection(ImageAnnotations)
-        labels = await collection.aggregate(labels_pipeline).to_list(length=None)
-        return [Label(name=doc['name'], attributes=doc['attributes'], shape=doc['shape']) for doc in labels]
+        return await engine.find(ProjectLabelStats,
+                                 ProjectLabelStats.project_id == project_id,
+                                 sort=query.desc(ProjectLabelStats.object_count))
 
     @staticmethod
-    async def get_project_attributes(project_id: ObjectId) -> List[str]:
+    async def update_label_stats(project_id: ObjectId, deltas: Dict[LabelKey, dict],
+                                 import_batch: Optional[str] = None):
+        """
+        Increments the label stats of the project. The stats updated by an import batch are marked with it,
+        so the deltas of a retried batch are only applied to the labels it didn't update yet.
+        """
+        batch_filter = {IMPORT_BATCH_FIELD: {'$ne': import_batch}} if import_batch else {}
+        batch_update = {'$set': {IMPORT_BATCH_FIELD: import_batch}} if import_batch else {}
+        requests = [
+            UpdateOne(
+                {'project_id': project_id, 'name': name, 'shape': shape.value, **batch_filter},
+                {
+                    '$inc': {'object_count': delta['object_count'], 'image_count': delta['image_count']},
+                    '$addToSet': {'attributes': {'$each': sorted(delta['attributes'])}},
+                    **batch_update,
+                },
+                upsert=True)
+            for (name, shape), delta in deltas.items()
+            if delta['object_count'] or delta['image_count'] or delta['attributes']
+        ]
+
+        if not requests:
+            return
+
+        engine = await get_engine()
+        collection = engine.get_collection(ProjectLabelStats)
+
+        try:
+            await collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as error:
+            # The stats already marked with the batch don't match the filter, their upsert breaks the unique index
+            if not import_batch or any(x['code'] != 11000 for x in error.details['writeErrors']):
+                raise
+        await collection.delete_many({'project_id': project_id, 'object_count': {'$lte': 0}})
+
+    @staticmethod
+    async def _get_project_labels_from_stats(project_id: ObjectId) -> List[Label]:
+        stats = await ProjectService.get_project_label_stats(project_id)
+        return [Label(name=x.name, shape=x.shape, attributes=x.attributes) for x in stats]
+
+    @staticmethod
+    async def _aggregate_project_attributes(project_id: ObjectId) -> List[str]:
         labels_pipeline = [{'$match': {'project_id': project_id}}] + GET_IMAGE_ATTRIBUTES_PIPELINE
         engine = await get_engine()
         collection = engine.get_collection(ImageAnnotations)
         attributes = await collection.aggregate(labels_pipeline).to_list(length=None)
         attributes = [doc['_id'] for doc in attributes]
         return [attr for attr in attributes if attr is not None]
+
+    @staticmethod
+    async def get_project_schema(project_id: ObjectId) -> Tuple[List[Label], List[str]]:
+        generation = await run_in_threadpool(get_annotations_generation, project_id)
+        schema = await run_in_threadpool(get_cached_schema, project_id, generation)
+
+        if schema is None:
+            labels = await ProjectService._get_project_labels_from_stats(project_id)
+            attributes = await ProjectService._aggregate_project_attributes(project_id)
+            schema = {'labels': [_label_to_dict(label) for label in labels], 'attributes': attributes}
+            await run_in_threadpool(set_cached_schema, project_id, generation, schema)
+
+        return [Label(**label) for label in schema['labels']], list(schema['attributes'])
+
+    @staticmethod
+    def extend_project_schema(project_id: ObjectId, generation: int, labels: List[Label]):
+        """
+        Carries the schema cached for the previous generation over to the given one after a write
+        that only added labels, so it doesn't have to be aggregated again.
+        """
+        schema = get_cached_schema(project_id, generation - 1)
+
+        if schema is not None:
+            schema = {**schema, 'labels': _merge_labels(schema['labels'], labels)}
+            set_cached_schema(project_id, generation, schema)
+
+    @staticmethod
+    async def get_project_labels(project_id: ObjectId) -> List[Label]:
+        labels, _ = await ProjectService.get_project_schema(project_id)
+        return labels
+
+    @staticmethod
+    async def get_project_attributes(project_id: ObjectId) -> List[str]:
+        _, attributes = await ProjectService.get_project_schema(project_id)
+        return attributes
@@ -1,12 +1,14 @@
-from typing import List
+from typing import List, Tuple
 import os
 from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
 
 from app.config import Config
 from app.models import ObjectId, Image, ImageAnnotations, get_engine
 from app.schema import ImageData
 from app.core.tracing import traced
-from app.core.s3 import get_s3_client
+from app.core.s3 import get_s3_client, generate_presigned_get_urls
+from app.core.cache import invalidate_annotations
 
 
 @traced
@@ -62,27 +64,26 @@ class StorageService:
 
     @staticmethod
     async def create_presigned_get_url_for_thumbnail(event_id: str, project_id: ObjectId) -> str:
-        async with get_s3_client() as s3_client:
-            return await s3_client.generate_presigned_url(
-                'get_object',
-                ExpiresIn=Config.SIGNED_GET_THUMBNAIL_URL_EXPIRATION,
-                Params={
-                    'Bucket': Config.IMAGE_STORAGE_BUCKET,
-                    'Key': f'{Config.THUMBNAILS_FOLDER}/{project_id}/{event_id}'
-                },
-            )
+        thumbnail_urls, _ = await StorageService.create_presigned_get_urls_for_images([event_id], project_id)
+        return thumbnail_urls[0]
 
     @staticmethod
     async def create_presigned_get_url_for_image(event_id: str, project_id: ObjectId) -> str:
-        async with get_s3_client() as s3_client:
-            return await s3_client.generate_presigned_url(
-                'get_object',
-                ExpiresIn=Config.SIGNED_GET_IMAGE_URL_EXPIRATION,
-                Params={
-                    'Bucket': Config.IMAGE_STORAGE_BUCKET,
-                    'Key': f'{Config.RAW_IMAGES_FOLDER}/{project_id}/{event_id}'
-                },
-            )
+        _, image_urls = await StorageService.create_presigned_get_urls_for_images([event_id], project_id)
+        return image_urls[0]
+
+    @staticmethod
+    async def create_presigned_get_urls_for_images(event_ids: List[str],
+                                                   project_id: ObjectId) -> Tuple[List[str], List[str]]:
+        thumbnail_urls = generate_presigned_get_urls(
+            Config.IMAGE_STORAGE_BUCKET,
+            [f'{Config.THUMBNAILS_FOLDER}/{project_id}/{event_id}' for event_id in event_ids],
+            Config.SIGNED_GET_THUMBNAIL_URL_EXPIRATION)
+        image_urls = generate_presigned_get_urls(
+            Config.IMAGE_STORAGE_BUCKET,
+            [f'{Config.RAW_IMAGES_FOLDER}/{project_id}/{event_id}' for event_id in event_ids],
+            Config.SIGNED_GET_IMAGE_URL_EXPIRATION)
+        return thumbnail_urls, image_urls
 
     @staticmethod
     async def create_presigned_get_url_for_object_download(key: str) -> str:
@@ -119,6 +120,7 @@ class StorageService:
         if annotations:
             annotations.has_image = False
             await engine.save(annotations)
+            await run_in_threadpool(invalidate_annotations, project_id)
 
     @staticmethod
     async def get_images(event_id: str, page: int, page_size: int, project_id: ObjectId) -> List[ImageData]:
@@ -135,13 +137,10 @@ class StorageService:
                                    limit=page_size)
 
         result = []
+        thumbnail_urls, original_urls = await StorageService.create_presigned_get_urls_for_images(
+            [image.event_id for image in images], project_id)
 
-        for image in images:
-            thumbnail_url = await StorageService.create_presigned_get_url_for_thumbnail(
-                image.event_id, project_id)
-            original_url = await StorageService.create_presigned_get_url_for_image(
-                image.event_id, project_id)
-
+        for image, thumbnail_url, original_url in zip(images, thumbnail_urls, original_urls):
             result.append(ImageData(
                 event_id=image.event_id,
                 width=image.width,
@@ -1,17 +1,24 @@
+from zipfile import ZIP_STORED
 import orjson
 import os
 
+# Already compressed files gain nothing from deflate, so they are stored as they are
+_STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.zip', '.gz'}
+
 
 def json_dumps(v, *, default):
     return orjson.dumps(v, default=default).decode()
 
 
-def zip_dir(path, zip_handler):
+def zip_dir(path, zip_handler, remove=False):
     for root, dirs, files in os.walk(path):
         for file in files:
-            zip_handler.write(
-                os.path.join(root, file),
-                os.path.relpath(os.path.join(root, file), os.path.join(path, '..')))
+            filename = os.path.join(root, file)
+            compress_type = ZIP_STORED if os.path.splitext(file)[1].lower() in _STORED_EXTENSIONS else None
+            zip_handler.write(filename, os.path.relpath(filename, os.path.join(path, '..')), compress_type)
+
+            if remove:
+                os.remove(filename)
 
 
 json_loads = orjson.loads
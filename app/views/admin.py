@@ -0,0 +1,33 @@
+from typing import List, Optional
+
+from fastapi_utils.cbv import cbv
+from fastapi_utils.inferring_router import InferringRouter
+from fastapi import Depends, Query
+
+from app.models import User
+from app.schema import SlowSpan, SlowQuery, TracingStats
+from app.security import get_admin_user
+from app.config import Config
+from app.core.tracing import get_exporter_stats, get_slow_spans
+from app.core.monitoring import command_monitor
+
+router = InferringRouter(tags=["admin"])
+
+
+@cbv(router)
+class AdminView:
+    user: User = Depends(get_admin_user)
+
+    @router.get("/admin/tracing/slow_spans")
+    def get_slow_spans(self, limit: Optional[int] = Query(100, ge=1, le=Config.TRACING_SLOW_SPANS_BUFFER_SIZE),
+                       min_duration_ms: float = 0) -> List[SlowSpan]:
+        return get_slow_spans(limit, min_duration_ms)
+
+    @router.get("/admin/tracing/stats")
+    def get_tracing_stats(self) -> TracingStats:
+        return get_exporter_stats()
+
+    @router.get("/admin/mongo/slow_queries")
+    def get_slow_queries(self, limit: Optional[int] = Query(100, ge=1, le=Config.MONGO_SLOW_QUERIES_BUFFER_SIZE)) \
+            -> List[SlowQuery]:
+        return command_monitor.get_slow_queries(limit)
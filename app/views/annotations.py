@@ -1,13 +1,13 @@
-from typing import List, Dict, Union
-import tempfile
+from typing import List, Dict, Union, Optional
 
 from fastapi_utils.api_model import APIMessage
 from fastapi_utils.cbv import cbv
 from fastapi_utils.inferring_router import InferringRouter
-from fastapi import Depends, HTTPException, status, File, UploadFile
+from fastapi import Depends, HTTPException, status, File, UploadFile, Request
 
 from app.schema import ImageAnnotationsPostSchema, AnnotationsQueryResult, \
-    ImageAnnotationsPutSchema, ImageAnnotationsPatchSchema, PipelinePostData
+    ImageAnnotationsPutSchema, ImageAnnotationsPatchSchema, PipelinePostData, PaginationMode, \
+    AnnotationsCount, AnnotationsStreamResult, AnnotationsImportStatus, JobId
 from app.models import ImageAnnotations, Project
 from app.security import get_project
 from app.config import Config
@@ -32,6 +32,10 @@ class AnnotationsView:
                               only_with_images: bool = True,
                               sort_field: AnnotationSortField = AnnotationSortField.IMAGE_NAME,
                               sort_direction: AnnotationSortDirection = AnnotationSortDirection.DESCENDING,
+                              pagination: PaginationMode = PaginationMode.OFFSET,
+                              continuation_token: Optional[str] = None,
+                              include_total: bool = True,
+                              estimate: bool = False,
                               ) -> AnnotationsQueryResult:
         return await AnnotationsService.get_annotations(
             page_size=page_size,
@@ -39,16 +43,42 @@ class AnnotationsView:
             project=self.project,
             only_with_images=only_with_images,
             sort_field=sort_field,
-            sort_direction=sort_direction)
+            sort_direction=sort_direction,
+            pagination=pagination,
+            continuation_token=continuation_token,
+            include_total=include_total,
+            estimate=estimate)
+
+    @router.get("/annotations/count")
+    async def count_annotations(self, only_with_images: bool = True, estimate: bool = False) -> AnnotationsCount:
+        return await AnnotationsService.count_annotations(
+            only_with_images=only_with_images,
+            project=self.project,
+            estimate=estimate)
 
     @router.post("/annotations/pipeline")
     async def run_annotations_pipeline(self, query: PipelinePostData,
-                                       page: int = 0, page_size: int = 10) -> AnnotationsQueryResult:
+                                       page: int = 0, page_size: int = 10,
+                                       pagination: PaginationMode = PaginationMode.OFFSET,
+                                       continuation_token: Optional[str] = None,
+                                       include_total: bool = True,
+                                       estimate: bool = False) -> AnnotationsQueryResult:
         return await AnnotationsService.run_annotations_pipeline(
             query=query.nodes,
             page_size=int(page_size),
             page=int(page),
-            project=self.project)
+            project=self.project,
+            pagination=pagination,
+            continuation_token=continuation_token,
+            include_total=include_total,
+            estimate=estimate)
+
+    @router.post("/annotations/pipeline/count")
+    async def count_annotations_pipeline(self, query: PipelinePostData, estimate: bool = False) -> AnnotationsCount:
+        return await AnnotationsService.count_annotations_pipeline(
+            query=query.nodes,
+            project=self.project,
+            estimate=estimate)
 
     @router.post("/annotations")
     async def add_annotations(self, annotation: ImageAnnotationsPostSchema,
@@ -66,25 +96,37 @@ class AnnotationsView:
 
         await AnnotationsService.add_annotations_bulk(annotations, replace, group, self.project.id)
 
+    @router.post("/annotations/stream")
+    async def add_annotations_stream(self, request: Request,
+                                     group: str = 'ground_truth',
+                                     replace: bool = True) -> AnnotationsStreamResult:
+        content_type = request.headers.get('content-type', '').split(';')[0].strip()
+
+        if content_type != 'application/x-ndjson':
+            raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                                'Annotations should be sent as newline delimited json (application/x-ndjson)')
+
+        compressed = request.headers.get('content-encoding') == 'gzip'
+        return await AnnotationsService.add_annotations_stream(
+            request.stream(), compressed, replace, group, self.project.id)
+
     @router.post("/annotations_file")
     async def add_annotations_file(self,
                                    annotations_format: DatasetImportFormat,
                                    replace: bool,
                                    file: UploadFile = File(...),
-                                   group: str = 'group_truth'):
+                                   group: str = 'group_truth') -> JobId:
         if file.content_type not in ['application/xml', 'application/json', 'text/xml']:
             raise HTTPException(status.HTTP_400_BAD_REQUEST,
                                 'File should be one of the supported mime types (xml or json)')
 
-        file_content = await file.read()
+        job_id = await AnnotationsService.add_annotations_file(
+            file, annotations_format, replace, group, self.project.id)
+        return JobId(job_id=job_id)
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            with open(f'{temp_dir}/{file.filename}', 'wb') as temp_file:
-                temp_file.write(file_content)
-                temp_file.flush()
-                print(temp_file.name)
-                await AnnotationsService.add_annotations_file(
-                    temp_file.name, annotations_format, replace, group, self.project.id)
+    @router.get("/annotations_file/jobs/{job_id}")
+    async def get_annotations_file_import_status(self, job_id: str) -> AnnotationsImportStatus:
+        return await AnnotationsService.get_annotations_file_import_status(job_id, self.project.id)
 
     @router.get("/annotations/{event_id}")
     async def get_annotations_by_event_id(self, event_id: str) -> ImageAnnotations:
@@ -1,17 +1,19 @@
-from typing import List
+from typing import List, Optional, Union
 
 from fastapi_utils.api_model import APIMessage
 from fastapi_utils.cbv import cbv
 from fastapi_utils.inferring_router import InferringRouter
-from fastapi import Depends, Response
+from fastapi import Depends, Query, Response
+from fastapi.responses import StreamingResponse
 from odmantic import ObjectId
 
 from app.schema import DatasetPostSchema, DatasetGetSortQuery, \
-    DatasetToken, ImageAnnotationsData, DatasetPatchSchema, JobId
+    DatasetToken, ImageAnnotationsData, DatasetPatchSchema, JobId, DatasetDiff
 from app.models import Dataset, Label, Project, FastToken
 from app.security import get_project, get_dataset_token
 from app.services.datasets import DatasetService, DatasetExportFormat
 from app.core.tracing import traced
+from app.config import Config
 
 router = InferringRouter(
     tags=["datasets"],
@@ -25,8 +27,18 @@ class DatasetsViewBase:
         return await DatasetService.get_dataset_by_id(id, project_id)
 
     @staticmethod
-    async def get_annotations_by_dataset_id(id: ObjectId, project_id: ObjectId) -> List[ImageAnnotationsData]:
-        return await DatasetService.get_annotations_by_dataset_id(id, project_id)
+    async def get_annotations_by_dataset_id(id: ObjectId, project_id: ObjectId, stream: bool = False,
+                                            offset: int = 0, limit: Optional[int] = None
+                                            ) -> Union[List[ImageAnnotationsData], Response]:
+        if stream:
+            rows = await DatasetService.stream_annotations_by_dataset_id(id, project_id, offset, limit)
+            return StreamingResponse(rows, media_type='application/x-ndjson')
+
+        return await DatasetService.get_annotations_by_dataset_id(id, project_id, offset, limit)
+
+    @staticmethod
+    async def get_annotations_by_event_id(id: ObjectId, project_id: ObjectId, event_id: str) -> ImageAnnotationsData:
+        return await DatasetService.get_annotations_by_event_id(id, project_id, event_id)
 
     @staticmethod
     async def get_datasets(project_id: ObjectId, name: str = None,
@@ -69,8 +81,9 @@ class DatasetsViewBase:
         return JobId(job_id=job_id)
 
     @staticmethod
-    async def get_dataset_download_url(job_id: str) -> APIMessage:
-        url = await DatasetService.get_dataset_download_url(job_id)
+    async def get_dataset_download_url(id: ObjectId, project_id: ObjectId, job_id: str) -> APIMessage:
+        dataset = await DatasetService.get_dataset_by_id(id, project_id)
+        url = await DatasetService.get_dataset_download_url(dataset, job_id)
         return APIMessage(detail=url)
 
     @staticmethod
@@ -78,8 +91,8 @@ class DatasetsViewBase:
         return [x.value for x in DatasetExportFormat]
 
 
-@cbv(router)
 @traced
+@cbv(router)
 class DatasetsView:
     project: Project = Depends(get_project)
 
@@ -87,9 +100,14 @@ class DatasetsView:
     async def get_dataset_by_id(self, id: ObjectId) -> Dataset:
         return await DatasetsViewBase.get_dataset_by_id(id, self.project.id)
 
-    @router.get("/dataset/{id}/annotations")
-    async def get_annotations_by_dataset_id(self, id: ObjectId) -> List[ImageAnnotationsData]:
-        return await DatasetsViewBase.get_annotations_by_dataset_id(id, self.project.id)
+    @router.get("/dataset/{id}/annotations", response_model=List[ImageAnnotationsData])
+    async def get_annotations_by_dataset_id(self, id: ObjectId, stream: bool = False, offset: int = Query(0, ge=0),
+                                            limit: Optional[int] = Query(None, ge=1, le=Config.SNAPSHOT_MAX_PAGE_SIZE)):
+        return await DatasetsViewBase.get_annotations_by_dataset_id(id, self.project.id, stream, offset, limit)
+
+    @router.get("/dataset/{id}/annotations/{event_id}")
+    async def get_annotations_by_event_id(self, id: ObjectId, event_id: str) -> ImageAnnotationsData:
+        return await DatasetsViewBase.get_annotations_by_event_id(id, self.project.id, event_id)
 
     @router.get("/dataset")
     async def get_datasets(self, name: str = None, include_all_revisions: bool = False,
@@ -127,21 +145,27 @@ class DatasetsView:
         return await DatasetsViewBase.download_dataset(id, self.project.id, format)
 
     @router.get("/dataset/{id}/download_url")
-    async def get_download_dataset_url(self, job_id: str) -> APIMessage:
-        return await DatasetsViewBase.get_dataset_download_url(job_id)
+    async def get_download_dataset_url(self, id: ObjectId, job_id: str) -> APIMessage:
+        return await DatasetsViewBase.get_dataset_download_url(id, self.project.id, job_id)
 
     @router.get("/dataset/{id}/revisions")
     async def get_dataset_revisions(self, id: ObjectId) -> List[Dataset]:
         dataset = await self.get_dataset_by_id(id)
         return await DatasetService.get_dataset_revisions(dataset)
 
+    @router.get("/dataset/{id}/diff/{other_id}")
+    async def get_datasets_diff(self, id: ObjectId, other_id: ObjectId) -> DatasetDiff:
+        dataset = await self.get_dataset_by_id(id)
+        other = await self.get_dataset_by_id(other_id)
+        return await DatasetService.get_datasets_diff(dataset, other)
+
     @router.get("/meta/dataset/formats")
     def get_export_formats(self) -> List[str]:
         return DatasetsViewBase.get_export_formats()
 
 
-@cbv(router)
 @traced
+@cbv(router)
 class DatasetsSharedView:
     dataset_token: FastToken = Depends(get_dataset_token)
 
@@ -150,10 +174,17 @@ class DatasetsSharedView:
         return await DatasetsViewBase.get_dataset_by_id(
             self.dataset_token.dataset_id, self.dataset_token.project_id)
 
-    @router.get("/dataset_shared/annotations")
-    async def get_annotations_by_dataset_id(self) -> List[ImageAnnotationsData]:
+    @router.get("/dataset_shared/annotations", response_model=List[ImageAnnotationsData])
+    async def get_annotations_by_dataset_id(self, stream: bool = False, offset: int = Query(0, ge=0),
+                                            limit: Optional[int] = Query(None, ge=1, le=Config.SNAPSHOT_MAX_PAGE_SIZE)):
         return await DatasetsViewBase.get_annotations_by_dataset_id(
-            self.dataset_token.dataset_id, self.dataset_token.project_id
+            self.dataset_token.dataset_id, self.dataset_token.project_id, stream, offset, limit
+        )
+
+    @router.get("/dataset_shared/annotations/{event_id}")
+    async def get_annotations_by_event_id(self, event_id: str) -> ImageAnnotationsData:
+        return await DatasetsViewBase.get_annotations_by_event_id(
+            self.dataset_token.dataset_id, self.dataset_token.project_id, event_id
         )
 
     @router.get("/dataset_shared/labels")
@@ -163,14 +194,16 @@ class DatasetsSharedView:
         )
 
     @router.get("/dataset_shared/download")
-    async def download_dataset(self, format: DatasetExportFormat, response: Response) -> JobId:
+    async def download_dataset(self, format: DatasetExportFormat) -> JobId:
         return await DatasetsViewBase.download_dataset(
-            self.dataset_token.dataset_id, self.dataset_token.project_id, format, response
+            self.dataset_token.dataset_id, self.dataset_token.project_id, format
         )
 
-    @router.get("/dataset/{id}/download_url")
-    async def download_dataset(self, job_id: str) -> APIMessage:
-        return await DatasetsViewBase.get_dataset_download_url(job_id)
+    @router.get("/dataset_shared/download_url")
+    async def get_download_dataset_url(self, job_id: str) -> APIMessage:
+        return await DatasetsViewBase.get_dataset_download_url(
+            self.dataset_token.dataset_id, self.dataset_token.project_id, job_id
+        )
 
     @router.get("/meta/dataset_shared/formats")
     def get_export_formats(self) -> List[str]:
@@ -7,7 +7,7 @@ from fastapi import Depends
 from odmantic import ObjectId
 
 from app.schema import ProjectPostSchema, ApiKey
-from app.models import Project, Label, User
+from app.models import Project, Label, User, ProjectLabelStats
 from app.security import get_current_user
 from app.services.projects import ProjectService
 from app.core.tracing import traced
@@ -52,6 +52,10 @@ class ProjectsView:
     async def get_project_labels(self, id: ObjectId) -> List[Label]:
         return await ProjectService.get_project_labels(id)
 
+    @router.get("/project/{id}/labels/stats")
+    async def get_project_label_stats(self, id: ObjectId) -> List[ProjectLabelStats]:
+        return await ProjectService.get_project_label_stats(id)
+
     @router.get("/project/{id}/attributes")
     async def get_project_attributes(self, id: ObjectId) -> List[str]:
         return await ProjectService.get_project_attributes(id)
@@ -0,0 +1,104 @@
+"""
+Compares the throughput and peak memory of the native export writers against the datumaro converters
+on a synthetic dataset. Every run happens in its own process, so peak RSS is measured independently.
+
+    python -m benchmarks.export_writers --images 200000
+
+Needs the same environment variables as the service, since it imports the app configuration.
+"""
+from typing import Iterator
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+LABELS = ['car', 'person', 'bicycle', 'dog', 'traffic light']
+FORMATS = ['coco_instances', 'voc_detection', 'yolo']
+WRITERS = ['native', 'datumaro']
+
+
+def _random_box():
+    x0, y0 = random.random() * 0.8, random.random() * 0.8
+    return [x0, y0, x0 + random.random() * 0.2, y0 + random.random() * 0.2]
+
+
+def generate_rows(images: int, seed: int = 0) -> Iterator[dict]:
+    random.seed(seed)
+
+    for i in range(images):
+        box = _random_box()
+        yield {
+            'event_id': f'{i:08d}.jpg',
+            'has_image': True,
+            'image_width': 1280,
+            'image_height': 720,
+            'attributes': {},
+            'detections': [{'label': random.choice(LABELS), 'box': _random_box(), 'attributes': {}, 'id': j}
+                           for j in range(3)],
+            'polygons': [{'label': random.choice(LABELS), 'attributes': {}, 'id': 3,
+                          'points': [box[0], box[1], box[2], box[1], box[2], box[3], box[0], box[3]]}],
+            'tags': [],
+            'points': [],
+            'polylines': [],
+            'captions': [],
+        }
+
+
+def run(images: int, format: str, writer: str) -> dict:
+    from app.schema import ImageAnnotationsData
+    from app.core.exporters import AnnotationsExtractor, DatasetExportFormat, export_annotations
+    from app.core.writers import NATIVE_WRITERS
+
+    format = DatasetExportFormat(format)
+    start_time = time.time()
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        if writer == 'native':
+            NATIVE_WRITERS[format](generate_rows(images), LABELS, save_dir)
+        else:
+            extractor = AnnotationsExtractor(
+                lambda: (ImageAnnotationsData.parse_obj(x) for x in generate_rows(images)), LABELS, images)
+            export_annotations(extractor, save_dir, format)
+
+    elapsed_time = time.time() - start_time
+    return {
+        'format': format.value,
+        'writer': writer,
+        'images': images,
+        'seconds': round(elapsed_time, 2),
+        'images_per_second': round(images / elapsed_time),
+        # ru_maxrss is in kilobytes on linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=200000)
+    parser.add_argument('--formats', nargs='+', default=FORMATS, choices=FORMATS)
+    parser.add_argument('--writers', nargs='+', default=WRITERS, choices=WRITERS)
+    parser.add_argument('--run', nargs=2, metavar=('FORMAT', 'WRITER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.images, *args.run)))
+        return
+
+    print(f'{"format":<16}{"writer":<10}{"seconds":>10}{"images/s":>12}{"peak RSS MB":>14}')
+
+    for format in args.formats:
+        for writer in args.writers:
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.export_writers', '--images', str(args.images), '--run', format, writer],
+                check=True, stdout=subprocess.PIPE).stdout
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print(f'{format:<16}{writer:<10}{result["seconds"]:>10}{result["images_per_second"]:>12}'
+                  f'{result["peak_rss_mb"]:>14}')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ from app.views.projects import router as projects_router
 from app.views.datasets import router as datasets_router
 from app.views.storage import router as storage_router
 from app.views.revisions import router as revisions_router
+from app.views.admin import router as admin_router
 from app.core.logger import RouteLoggerMiddleware
 
 app = FastAPI(title='Labelity.ai API Service', default_response_class=ORJSONResponse)
@@ -35,6 +36,7 @@ app.include_router(projects_router)
 app.include_router(datasets_router)
 app.include_router(storage_router)
 app.include_router(revisions_router)
+app.include_router(admin_router)
 
 prometheus_instrumentator = Instrumentator(
     should_group_status_codes=False,
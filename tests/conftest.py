@@ -0,0 +1,13 @@
+import os
+
+# Settings the app configuration requires at import time, the tests don't connect to any of these services
+for name, value in {
+    'REDIS_HOST': 'localhost',
+    'REDIS_PORT': '6379',
+    'REDIS_PASSWORD': '',
+    'REDIS_DATABASE': '0',
+    'IMAGE_STORAGE_BUCKET': 'images',
+    'DATASET_ARTIFACTS_BUCKET': 'datasets',
+    'PIPELINES_BUCKET': 'pipelines',
+}.items():
+    os.environ.setdefault(name, value)
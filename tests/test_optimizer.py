@@ -0,0 +1,290 @@
+import random
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+from app.core.query_engine.expressions import ViewField
+from app.core.query_engine.optimizer import optimize_pipeline
+from app.core.query_engine.stages import STAGES, _get_projection_stage, get_rotated_random_key, scope_pipeline, \
+    make_paginated_pipeline, make_keyset_paginated_pipeline
+
+PROJECT_ID = ObjectId()
+OTHER_PROJECT_ID = ObjectId()
+LABELS = ['car', 'person', 'dog']
+
+
+@pytest.mark.parametrize('pipeline, expected', [
+    (
+        [{'$sort': {'event_id': 1}}, {'$match': {'$expr': {'$eq': ['$has_image', True]}}}],
+        [{'$match': {'has_image': True}}, {'$sort': {'event_id': 1}}],
+    ),
+    (
+        [{'$match': {'$expr': {'$in': ['$event_id', ['a', 'b']]}}}],
+        [{'$match': {'event_id': {'$in': ['a', 'b']}}}],
+    ),
+    (
+        [{'$set': {'x': 1}}, {'$match': {'$expr': {'$and': [{'$eq': ['$event_id', 'a']}, {'$gt': ['$x', 0]}]}}}],
+        [{'$match': {'event_id': 'a'}}, {'$set': {'x': 1}}, {'$match': {'$expr': {'$gt': ['$x', 0]}}}],
+    ),
+    (
+        # Array fields match any of their elements with query operators, so the $expr is kept
+        [{'$match': {'$expr': {'$eq': ['$tags', 1]}}}],
+        [{'$match': {'$expr': {'$eq': ['$tags', 1]}}}],
+    ),
+    (
+        [{'$match': {'$expr': {'$gt': ['$attributes.index', 1]}}}, {'$match': {'has_image': True}}],
+        [{'$match': {'has_image': True}}, {'$match': {'$expr': {'$gt': ['$attributes.index', 1]}}}],
+    ),
+    (
+        [{'$set': {'x': 1}}, {'$match': {'x': 1}}],
+        [{'$set': {'x': 1}}, {'$match': {'x': 1}}],
+    ),
+    (
+        # The projection removes has_image, so the filter can't run before it
+        [{'$project': {'event_id': 1}}, {'$match': {'has_image': True}}],
+        [{'$project': {'event_id': 1}}, {'$match': {'has_image': True}}],
+    ),
+    (
+        [{'$project': {'event_id': 1, 'has_image': 1}}, {'$match': {'has_image': True}}],
+        [{'$match': {'has_image': True}}, {'$project': {'event_id': 1, 'has_image': 1}}],
+    ),
+    (
+        [{'$unset': 'a'}, {'$match': {'a.b': 1}}],
+        [{'$unset': 'a'}, {'$match': {'a.b': 1}}],
+    ),
+    (
+        [{'$set': {'x': 1}}, {'$set': {'y': 2}}],
+        [{'$set': {'x': 1, 'y': 2}}],
+    ),
+    (
+        [{'$set': {'x': 1}}, {'$set': {'y': '$x'}}],
+        [{'$set': {'x': 1}}, {'$set': {'y': '$x'}}],
+    ),
+    (
+        [{'$unset': 'a'}, {'$unset': ['b', 'c']}],
+        [{'$unset': ['a', 'b', 'c']}],
+    ),
+    (
+        [{'$project': {'a': 1, 'b': {'$size': '$c'}}}, {'$project': {'b': 1}}],
+        [{'$project': {'b': {'$size': '$c'}}}],
+    ),
+    (
+        [{'$project': {'a': 0}}, {'$project': {'b': 1}}],
+        [{'$project': {'a': 0}}, {'$project': {'b': 1}}],
+    ),
+    (
+        [{'$sort': {'a': 1}}, {'$set': {'x': 1}}, {'$limit': 5}, {'$limit': 3}, {'$skip': 1}, {'$skip': 2}],
+        [{'$sort': {'a': 1}}, {'$limit': 3}, {'$set': {'x': 1}}, {'$skip': 3}],
+    ),
+    (
+        [{'$sort': {'a': 1, 'b': 1}}, {'$sort': {'b': -1}}],
+        [{'$sort': {'b': -1, 'a': 1}}],
+    ),
+    (
+        [
+            {'$match': {'has_image': True}},
+            {'$set': {'_rand_take': get_rotated_random_key(0.25)}},
+            {'$sort': {'_rand_take': 1}},
+            {'$limit': 10},
+            {'$unset': '_rand_take'},
+        ],
+        [
+            {'$match': {'has_image': True}},
+            {'$match': {'_rand': {'$gte': 0.25}}},
+            {'$sort': {'_rand': 1}},
+            {'$limit': 10},
+            {'$unionWith': {'coll': 'image_annotations', 'pipeline': [
+                {'$match': {'has_image': True}},
+                {'$match': {'_rand': {'$not': {'$gte': 0.25}}}},
+                {'$sort': {'_rand': 1}},
+                {'$limit': 10},
+            ]}},
+            {'$set': {'_rand_take': get_rotated_random_key(0.25)}},
+            {'$sort': {'_rand_take': 1}},
+            {'$limit': 10},
+            {'$unset': '_rand_take'},
+        ],
+    ),
+    (
+        # After a projection the random key can't be sought with an index
+        [
+            {'$project': {'_rand': 1}},
+            {'$set': {'_rand_take': get_rotated_random_key(0.25)}},
+            {'$sort': {'_rand_take': 1}},
+            {'$limit': 10},
+            {'$unset': '_rand_take'},
+        ],
+        [
+            {'$project': {'_rand': 1}},
+            {'$set': {'_rand_take': get_rotated_random_key(0.25)}},
+            {'$sort': {'_rand_take': 1}},
+            {'$limit': 10},
+            {'$unset': '_rand_take'},
+        ],
+    ),
+])
+def test_optimize_pipeline(pipeline, expected):
+    assert optimize_pipeline(pipeline) == expected
+
+
+def _make_annotations(count: int) -> list:
+    generator = random.Random(0)
+    documents = []
+
+    for i in range(count):
+        document = {
+            '_id': ObjectId(),
+            'event_id': f'{i:04d}.jpg',
+            'project_id': PROJECT_ID if i % 5 else OTHER_PROJECT_ID,
+            'has_image': generator.random() < 0.7,
+            '_rand': generator.random(),
+            'tags': [generator.randrange(3) for _ in range(generator.randrange(3))],
+            'attributes': {'index': i, 'weather': generator.choice(['sunny', 'rainy'])},
+            'detections': [
+                {'label': generator.choice(LABELS), 'score': generator.random(), 'box': [0, 0, 1, 1]}
+                for _ in range(generator.randrange(4))
+            ],
+            'polygons': [],
+            'points': [],
+            'polylines': [],
+        }
+
+        if i % 7 == 0:
+            document['attributes']['weather'] = None
+
+        documents.append(document)
+
+    return documents
+
+
+@pytest.fixture(scope='module')
+def collection():
+    collection = mongomock.MongoClient().db.image_annotations
+    collection.insert_many(_make_annotations(300))
+    return collection
+
+
+def _aggregate(collection, pipeline: list) -> list:
+    # mongomock doesn't implement the $unset stage, it's equivalent to an exclusion projection
+    pipeline = [
+        {'$project': {field: 0 for field in ([x['$unset']] if isinstance(x['$unset'], str) else x['$unset'])}}
+        if '$unset' in x else x
+        for x in pipeline
+    ]
+
+    # Nor the $unionWith stage, the rest of the pipeline runs over both results in a temporary collection
+    for i, stage in enumerate(pipeline):
+        if '$unionWith' in stage:
+            union = stage['$unionWith']
+            documents = _aggregate(collection, pipeline[:i]) + \
+                _aggregate(collection.database[union['coll']], union['pipeline'])
+            temporary = mongomock.MongoClient().db.union
+
+            if documents:
+                temporary.insert_many(documents)
+
+            return _aggregate(temporary, pipeline[i + 1:])
+
+    return list(collection.aggregate(pipeline))
+
+
+def _stages(*stages) -> list:
+    return [mongo_stage for name, parameters in stages for mongo_stage in STAGES[name](**parameters).to_mongo()]
+
+
+def _filter_detections(cond) -> list:
+    # Equivalent to the output of FilterLabels, whose expressions are built from ViewFields
+    detections = ViewField('$detections').filter(cond).to_mongo()
+    is_not_empty = ViewField('detections').length() > 0
+
+    return [_get_projection_stage({'detections': detections}), {'$match': {'$expr': is_not_empty.to_mongo()}}]
+
+
+def _match(expr) -> list:
+    return [{'$match': {'$expr': expr.to_mongo()}}]
+
+
+SEQUENCES = {
+    'sort_then_match': _stages(('sort_by', {'field_or_expression': 'attributes.index', 'reverse': True})) +
+    _match(ViewField('has_image') == True),  # noqa: E712
+    'match_sort_limit': _match(ViewField('attributes.weather') == 'sunny') +
+    _stages(('sort_by', {'field_or_expression': 'attributes.index'}), ('limit', {'limit': 20})),
+    'filter_labels_then_match': _filter_detections(ViewField('score') > 0.5) +
+    _match(ViewField('event_id').is_in(['0001.jpg', '0002.jpg', '0003.jpg', '0011.jpg'])),
+    'filter_labels_sort_skip_limit': _filter_detections(ViewField('label') == 'car') + _stages(
+        ('sort_by', {'field_or_expression': 'attributes.index', 'reverse': True}),
+        ('skip', {'skip': 5}), ('skip', {'skip': 5}), ('limit', {'limit': 30}), ('limit', {'limit': 10})),
+    'select_exclude_sort': _stages(
+        ('select', {'samples': [f'{i:04d}.jpg' for i in range(0, 300, 3)]}),
+        ('exclude', {'samples': [f'{i:04d}.jpg' for i in range(0, 300, 4)]}),
+        ('sort_by', {'field_or_expression': 'event_id'}),
+        ('sort_by', {'field_or_expression': 'attributes.weather'})),
+    'shuffle_then_match': _stages(('shuffle', {'seed': 3})) + _match(ViewField('has_image') == False),  # noqa: E712
+    'take_then_filter_labels': _stages(('take', {'size': 50, 'seed': 7})) +
+    _filter_detections(ViewField('score') < 0.3) + _match(ViewField('attributes.index') > 100),
+    'match_take_sort': _match(ViewField('attributes.weather') == 'rainy') + _stages(
+        ('take', {'size': 40, 'seed': 1}), ('sort_by', {'field_or_expression': 'attributes.index'})),
+    'exists_shuffle_limit': _stages(
+        ('exists', {'field': 'attributes.weather'}), ('shuffle', {'seed': 11}), ('limit', {'limit': 25})),
+    # The offset of seed 2 is above 0.95, so the sample wraps around to the start of the random key
+    'take_wraparound': _stages(('take', {'size': 40, 'seed': 2})),
+    'match_take_wraparound': _match(ViewField('has_image') == True) +  # noqa: E712
+    _stages(('take', {'size': 20, 'seed': 2}), ('sort_by', {'field_or_expression': 'event_id'})),
+}
+
+
+@pytest.mark.parametrize('name', SEQUENCES)
+def test_optimized_pipeline_results(collection, name):
+    # The project filter is added when the pipeline runs, after it has been compiled and optimized
+    match = {'project_id': PROJECT_ID}
+    expected = _aggregate(collection, scope_pipeline(match, SEQUENCES[name]))
+
+    assert _aggregate(collection, scope_pipeline(match, optimize_pipeline(SEQUENCES[name]))) == expected
+    assert all(x.get('project_id', PROJECT_ID) == PROJECT_ID for x in expected)
+
+
+def test_unseeded_take_results(collection):
+    pipeline = [{'$match': {'project_id': PROJECT_ID}}] + _stages(('take', {'size': 30})) + \
+        _match(ViewField('has_image') == True)  # noqa: E712
+    optimized = optimize_pipeline(pipeline)
+    documents = {x['_id']: x for x in _aggregate(collection, [pipeline[0]])}
+    result = _aggregate(collection, optimized)
+
+    assert len(result) <= 30
+    assert all(x['has_image'] and documents[x['_id']] == x for x in result)
+
+
+def test_seeded_take_without_random_keys():
+    # Annotations created before the random key was persisted keep the results of the unoptimized Take
+    documents = _make_annotations(100)
+
+    for document in documents[::9]:
+        del document['_rand']
+
+    collection = mongomock.MongoClient().db.image_annotations
+    collection.insert_many(documents)
+    pipeline = scope_pipeline({'project_id': PROJECT_ID}, _stages(('take', {'size': 20, 'seed': 5})))
+
+    assert _aggregate(collection, optimize_pipeline(pipeline)) == _aggregate(collection, pipeline)
+
+
+def test_unseeded_take_pagination():
+    # Every run draws another sample, so only its first page can be retrieved
+    pipeline = _stages(('take', {'size': 30}))
+    make_paginated_pipeline(pipeline, page_size=10, page=0)
+    make_keyset_paginated_pipeline(pipeline, page_size=10)
+
+    with pytest.raises(ValueError):
+        make_paginated_pipeline(pipeline, page_size=10, page=1)
+
+    with pytest.raises(ValueError):
+        make_keyset_paginated_pipeline(pipeline, page_size=10, continuation_token='token')
+
+
+def test_unseeded_shuffle_is_cacheable():
+    # The random key is drawn by the server, so compiled pipelines can be cached and reused
+    pipeline = _stages(('shuffle', {}))
+
+    assert pipeline == _stages(('shuffle', {}))
+    assert {'$rand': {}} in [value for stage in pipeline for value in stage.get('$set', {}).values()]
@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime
+
+import fsspec
+import pytest
+from bson import ObjectId
+
+from app.config import Config
+from app.core.snapshots import SnapshotReader
+from app.models import Dataset
+from app.schema import ImageAnnotationsData
+from app.services import datasets
+from app.services.datasets import DatasetService
+
+PROJECT_ID = ObjectId()
+
+
+@pytest.fixture(autouse=True)
+def snapshots_fs(monkeypatch):
+    fs = fsspec.filesystem('memory')
+    fs.store.clear()
+    monkeypatch.setattr(datasets, 's3_fs', fs)
+    monkeypatch.setattr(datasets, '_snapshot_footers', {})
+    # Small blocks, so the rows of a page are spread over several of them
+    monkeypatch.setattr(Config, 'SNAPSHOT_BLOCK_SIZE', 3)
+    return fs
+
+
+def _annotations(event_ids, version):
+    return [ImageAnnotationsData(event_id=x, attributes={'version': version}) for x in event_ids]
+
+
+def _create_revision(parent, event_ids, annotations, snapshot_depth):
+    dataset = Dataset(
+        id=ObjectId(), name='dataset', description='', event_ids=event_ids, project_id=PROJECT_ID,
+        parent_id=parent.id if parent else None, created_at=datetime.utcnow(),
+        version=parent.version + 1 if parent else 1, snapshot_version=2, snapshot_depth=snapshot_depth)
+    asyncio.get_event_loop().run_until_complete(
+        DatasetService._create_dataset_snapshot(dataset, annotations, parent=parent))
+    return dataset
+
+
+def _read(dataset, **kwargs):
+    return [(x['event_id'], x['attributes']['version'])
+            for x in DatasetService._iter_dataset_snapshot(dataset, ['event_id', 'attributes'], **kwargs)]
+
+
+@pytest.fixture
+def revisions():
+    first_ids = [f'{i:02d}' for i in range(10)]
+    first = _create_revision(None, first_ids, _annotations(reversed(first_ids), 1), 0)
+
+    # Changes two events, removes one and adds two, one of them before the existing ones
+    second_ids = ['10'] + [x for x in first_ids if x != '04'] + ['11']
+    second_annotations = _annotations(['10', '11', '02', '07'], 2) + \
+        _annotations([x for x in first_ids if x not in {'02', '04', '07'}], 1)
+    second = _create_revision(first, second_ids, second_annotations, 1)
+
+    third_ids = second_ids[::-1]
+    third_annotations = _annotations(['07'], 3) + [x for x in second_annotations if x.event_id != '07']
+    third = _create_revision(second, third_ids, third_annotations, 2)
+
+    compacted = _create_revision(third, third_ids, third_annotations, 0)
+    return first, second, third, compacted
+
+
+def test_full_snapshot_round_trip(revisions):
+    first, *_ = revisions
+
+    assert _read(first) == [(f'{i:02d}', 1) for i in range(10)]
+    assert _read(first, offset=4, limit=3) == [(f'{i:02d}', 1) for i in range(4, 7)]
+
+
+def test_delta_snapshot_round_trip(revisions):
+    _, second, third, _ = revisions
+    expected = [(x, 2 if x in {'10', '11', '02', '07'} else 1) for x in second.event_ids]
+
+    assert _read(second) == expected
+    assert _read(second, offset=2, limit=5) == expected[2:7]
+
+    expected = [(x, 3 if x == '07' else version) for x, version in expected[::-1]]
+
+    assert _read(third) == expected
+    assert _read(third, offset=9) == expected[9:]
+
+
+def test_compacted_snapshot_round_trip(revisions):
+    *_, third, compacted = revisions
+
+    assert _read(compacted) == _read(third)
+    assert _read(compacted, offset=3, limit=4) == _read(third, offset=3, limit=4)
+
+
+def test_delta_snapshot_page_decodes_its_blocks(revisions, monkeypatch):
+    _, _, third, _ = revisions
+    blocks = []
+    read_block = SnapshotReader._read_block
+
+    def spy(self, block, columns):
+        if columns != ['event_id']:
+            blocks.append(block)
+        return read_block(self, block, columns)
+
+    monkeypatch.setattr(SnapshotReader, '_read_block', spy)
+
+    # The first two events of the third version are in the last blocks of the first and second snapshots
+    assert _read(third, limit=2) == [('11', 2), ('09', 1)]
+    assert len(blocks) == 2